@@ -0,0 +1,513 @@
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Iterator, TextIO
+import setup
+import utilities as util
+import webscraper
+from database import db_connect
+from fund import Fund
+from host_scheduler import HostScheduler
+from session_pool import SessionPool
+from parse_pool import ParsePool
+from constants import *
+
+try:
+    import resource
+except ImportError:     # not available on Windows
+    resource = None
+
+class FakeFundSite:
+    """Local HTTP server that serves synthetic fund pages, for benchmarking the webscraper.
+
+    Page `/fund/<n>` is an html page of about `page_bytes` bytes. Each request is delayed
+    by `latency` seconds, and may instead time out, fail with a 412 or 5xx error, or
+    return a non-html page, at the given rates. Pages only change when `change_pages`
+    is called, and support conditional requests via `ETag`.
+    """
+
+    def __init__(
+        self,
+        latency: float =0.05,
+        page_bytes: int =50 * 1024,
+        timeout_rate: float =0.0,
+        e412_rate: float =0.0,
+        e5xx_rate: float =0.0,
+        non_html_rate: float =0.0,
+        change_rate: float =0.1,
+        timeout_delay: float =16.0,
+        seed: int =0
+    ) -> None:
+        """
+        Args:
+            latency: The delay, in seconds, before each response
+            page_bytes: The approximate size of each page
+            timeout_rate: The fraction of requests that are answered after `timeout_delay`
+            e412_rate: The fraction of requests answered with a 412 error
+            e5xx_rate: The fraction of requests answered with a 503 error
+            non_html_rate: The fraction of requests answered with a non-html page
+            change_rate: The fraction of pages changed by each call to `change_pages`
+            timeout_delay: The delay, in seconds, of a timed out request. Should exceed the
+                read timeout of `webscraper.fetch_page`
+            seed: The random seed, for repeatable runs
+        """
+        self.latency = latency
+        self.page_bytes = page_bytes
+        self.timeout_rate = timeout_rate
+        self.e412_rate = e412_rate
+        self.e5xx_rate = e5xx_rate
+        self.non_html_rate = non_html_rate
+        self.change_rate = change_rate
+        self.timeout_delay = timeout_delay
+        self.requests = 0
+        self.bytes_sent = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._server = None
+
+    def __enter__(self) -> 'FakeFundSite':
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        """Start serving on a free local port, in a background thread."""
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                site._handle(self)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        """Stop the server."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def url(
+        self,
+        n: int
+    ) -> str:
+        """Return the url of page `n`."""
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/fund/{n}"
+
+    def change_pages(self) -> int:
+        """Change a `change_rate` fraction of the pages served so far.
+
+        Returns:
+            The number of pages changed
+        """
+        with self._lock:
+            changed = [path for path in self._versions if self._rng.random() < self.change_rate]
+            for path in changed:
+                self._versions[path] += 1
+        return len(changed)
+
+    def _outcome(self) -> str:
+        with self._lock:
+            self.requests += 1
+            r = self._rng.random()
+        for outcome, rate in (
+            ('timeout', self.timeout_rate),
+            ('412', self.e412_rate),
+            ('5xx', self.e5xx_rate),
+            ('non_html', self.non_html_rate)
+        ):
+            if r < rate:
+                return outcome
+            r -= rate
+        return 'ok'
+
+    def _page(
+        self,
+        path: str,
+        version: int
+    ) -> bytes:
+        rng = random.Random(f"{path}:{version}")
+        words = ('fund', 'grant', 'deadline', 'apply', 'eligible', 'award', 'round', 'open', 'closed', 'research')
+        parts = [f"<html><head><title>{path}</title><style>p {{ margin: 0 }}</style></head><body><h1>Fund {path}</h1>"]
+        size = len(parts[0])
+        while size < self.page_bytes:
+            part = f"<p>{' '.join(rng.choice(words) for _ in range(40))}</p>\n"
+            parts.append(part)
+            size += len(part)
+        parts.append(f"<p>Version {version}</p><script>var v = {version};</script></body></html>")
+        return ''.join(parts).encode('utf-8')
+
+    def _send(
+        self,
+        handler: BaseHTTPRequestHandler,
+        status: int,
+        body: bytes =b'',
+        headers: dict[str, str] | None =None
+    ) -> None:
+        handler.send_response(status)
+        for k, v in (headers or {}).items():
+            handler.send_header(k, v)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        if body:
+            handler.wfile.write(body)
+            with self._lock:
+                self.bytes_sent += len(body)
+
+    def _handle(
+        self,
+        handler: BaseHTTPRequestHandler
+    ) -> None:
+        time.sleep(self.latency)
+        outcome = self._outcome()
+        try:
+            if outcome == 'timeout':
+                time.sleep(self.timeout_delay)
+            elif outcome == '412':
+                return self._send(handler, 412, headers={'Content-Type': 'text/html'})
+            elif outcome == '5xx':
+                return self._send(handler, 503, headers={'Content-Type': 'text/html', 'Retry-After': '1'})
+            elif outcome == 'non_html':
+                return self._send(handler, 200, b'%PDF-1.4', headers={'Content-Type': 'application/pdf'})
+
+            path = handler.path
+            with self._lock:
+                version = self._versions.setdefault(path, 0)
+            etag = f'"{version}"'
+            if handler.headers.get('If-None-Match') == etag:
+                return self._send(handler, 304, headers={'ETag': etag})
+            self._send(handler, 200, self._page(path, version), headers={
+                'Content-Type': 'text/html; charset=utf-8',
+                'ETag': etag
+            })
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+def percentile(
+    values: list[float],
+    p: float
+) -> float:
+    """Return the `p`th percentile of `values`, or 0.0 if there are none."""
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[min(max(round(p) - 1, 0), 98)]
+
+def peak_memory_mb() -> float | None:
+    """Return the peak resident memory of this process so far, in MiB, if available."""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def make_benchmark_db(
+    path: str,
+    site: FakeFundSite,
+    n_funds: int,
+    urls_per_fund: int =1
+) -> sqlite3.Connection:
+    """Create a webscraper database at `path` holding `n_funds` funds served by `site`.
+
+    Args:
+        path: The sqlite3 .db file to create
+        site: The running fake fund site
+        n_funds: The number of funds to add
+        urls_per_fund: The number of urls of each fund
+    Returns:
+        An open connection to the new database
+    """
+    conn = db_connect(path)
+    setup.init_table_funds(conn)
+    setup.init_table_fund_urls(conn)
+    setup.init_table_check_journal(conn)
+    setup.init_table_snapshots(conn)
+    setup.init_table_users(conn)
+    setup.add_funds(conn, [
+        {
+            'name': f"Fund {i}",
+            'url': DELIM.join(site.url(i * urls_per_fund + j) for j in range(urls_per_fund)),
+            'status': OPEN
+        }
+        for i in range(n_funds)
+    ])
+    return conn
+
+@contextmanager
+def quiet() -> Iterator[TextIO]:
+    """Silence the per-url progress printed by the webscraper, yielding a null audit log."""
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        yield devnull
+
+@contextmanager
+def timed_check_fund(
+    latencies: list[float]
+) -> Iterator[None]:
+    """Record the time per url of every `webscraper.check_fund` call in `latencies`."""
+    check_fund = webscraper.check_fund
+
+    def timed(log, fund, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return check_fund(log, fund, *args, **kwargs)
+        finally:
+            n_urls = len(fund['urls'])
+            latencies.extend([(time.perf_counter() - start) / n_urls] * n_urls)
+
+    webscraper.check_fund = timed
+    try:
+        yield
+    finally:
+        webscraper.check_fund = check_fund
+
+def bench_check_funds(
+    funds: list[Fund],
+    workers: int,
+    parse_workers: int =0
+) -> dict[str, Any]:
+    """Check every fund in `funds` as `webscraper.main` does, and time it.
+
+    With `parse_workers`, pages are parsed in a `ParsePool` of that many processes.
+
+    Returns:
+        A dict of results, including the funds to update
+    """
+    latencies = []
+    funds_to_check = []
+    funds_to_update = []
+    pool = SessionPool(size=workers, connections_per_host=workers)
+    scheduler = HostScheduler(max_per_host=workers, min_interval=0)
+    parser = ParsePool(parse_workers) if parse_workers > 0 else None
+    start = time.perf_counter()
+    try:
+        with quiet() as log, timed_check_fund(latencies):
+            webscraper.check_funds(
+                log, funds, funds_to_check, funds_to_update,
+                workers=workers, scheduler=scheduler, pool=pool, parser=parser
+            )
+    finally:
+        pool.close()
+        if parser:
+            parser.close()
+    elapsed = time.perf_counter() - start
+    return {
+        'elapsed': elapsed,
+        'urls': len(latencies),
+        'latencies': latencies,
+        'funds_to_check': funds_to_check,
+        'funds_to_update': funds_to_update,
+        'connections': pool.stats()
+    }
+
+def bench_get_soup(
+    urls: list[str],
+    workers: int
+) -> dict[str, Any]:
+    """Fetch and parse every url in `urls` with `webscraper.get_soup`, and time it.
+
+    Returns:
+        A dict of results
+    """
+    pool = SessionPool(size=workers, connections_per_host=workers)
+    scheduler = HostScheduler(max_per_host=workers, min_interval=0)
+
+    def timed(url):
+        start = time.perf_counter()
+        soup = webscraper.get_soup(url, scheduler=scheduler, pool=pool)
+        return time.perf_counter() - start, soup is not None
+
+    start = time.perf_counter()
+    try:
+        with quiet(), ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(timed, urls))
+    finally:
+        pool.close()
+    return {
+        'elapsed': time.perf_counter() - start,
+        'urls': len(urls),
+        'latencies': [t for t, _ in results],
+        'failed': sum(1 for _, ok in results if not ok)
+    }
+
+def bench_db_writes(
+    conn: sqlite3.Connection,
+    funds: list[Fund],
+    funds_to_update: list[Fund]
+) -> dict[str, float]:
+    """Time writing check results to the database.
+
+    Returns:
+        The seconds taken by `records_update_dbtable` for `funds_to_update`, and by
+        `webscraper.checkpoint_funds` for all of `funds`
+    """
+    start = time.perf_counter()
+    util.records_update_dbtable(conn, FUNDS_TABLE, ['status', 'access_failures'], funds_to_update)
+    update_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with quiet() as log:
+        webscraper.checkpoint_funds(conn, log, funds, funds_to_update)
+    webscraper.clear_check_journal(conn)
+    checkpoint_time = time.perf_counter() - start
+    return {'records_update_dbtable': update_time, 'checkpoint_funds': checkpoint_time}
+
+def bench_xlsx_export(
+    conn: sqlite3.Connection,
+    out_dir: str,
+    tables: tuple[str, ...] =(FUNDS_TABLE, FUND_URLS_TABLE)
+) -> dict[str, dict[str, float]]:
+    """Time exporting `tables` to .xlsx, via records and pandas and via the streaming export.
+
+    Each path is run twice: once for its time, and once under `tracemalloc` for its peak
+    memory, since tracing slows it down.
+
+    Returns:
+        For each of `records_to_xlsx` (`records_to_xlsx(dbtable_to_records(...))`) and
+        `dbtable_to_xlsx`, the seconds taken and the peak traced memory in MiB
+    """
+    def via_records(path: str) -> None:
+        for table in tables:
+            util.records_to_xlsx(util.dbtable_to_records(conn, table), f"{path}_{table}.xlsx", sheet_name=table)
+
+    def via_cursor(path: str) -> None:
+        for table in tables:
+            util.dbtable_to_xlsx(conn, table, f"{path}_{table}.xlsx", sheet_name=table)
+
+    results = {}
+    for name, export in (('records_to_xlsx', via_records), ('dbtable_to_xlsx', via_cursor)):
+        path = os.path.join(out_dir, name)
+        start = time.perf_counter()
+        export(path)
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        try:
+            export(path)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        results[name] = {'elapsed': elapsed, 'peak_mb': peak / (1024 * 1024)}
+    return results
+
+def report(
+    name: str,
+    result: dict[str, Any]
+) -> None:
+    """Print throughput and latency percentiles of a timed stage."""
+    lat = result['latencies']
+    rate = result['urls'] / result['elapsed'] if result['elapsed'] else 0.0
+    memory = peak_memory_mb()
+    print(
+        f"  {name}: {result['urls']} urls in {result['elapsed']:.2f}s ({rate:.1f} urls/s), "
+        f"p50 {percentile(lat, 50) * 1000:.1f}ms, p99 {percentile(lat, 99) * 1000:.1f}ms"
+        + (f", peak memory {memory:.0f}MiB" if memory is not None else '')
+    )
+
+def run_benchmark(
+    n_funds: int,
+    site: FakeFundSite,
+    workers: int =CHECK_WORKERS,
+    urls_per_fund: int =1,
+    soup_sample: int =200,
+    parse_workers: int =0
+) -> None:
+    """Benchmark checking `n_funds` funds against `site` and print the results.
+
+    Funds are checked twice: once with an empty database, and again after
+    `site.change_pages()`, when unchanged pages are fetched conditionally.
+
+    Args:
+        n_funds: The number of funds
+        site: The running fake fund site
+        workers: The number of concurrent checks
+        urls_per_fund: The number of urls of each fund
+        soup_sample: The number of urls to time `get_soup` on
+        parse_workers: The number of processes to parse pages in; 0 parses in the check threads
+    """
+    print(f"{n_funds} funds, {urls_per_fund} url(s) each, {workers} workers, {parse_workers} parse workers")
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = make_benchmark_db(os.path.join(tmp, DATABASE), site, n_funds, urls_per_fund)
+        try:
+            funds = webscraper.load_funds(conn)
+            first = bench_check_funds(funds, workers, parse_workers)
+            report('check_fund (first run)', first)
+            writes = bench_db_writes(conn, funds, first['funds_to_update'])
+            print(
+                f"  DB writes: records_update_dbtable {len(first['funds_to_update'])} rows in "
+                f"{writes['records_update_dbtable'] * 1000:.1f}ms, "
+                f"checkpoint_funds {len(funds)} funds in {writes['checkpoint_funds'] * 1000:.1f}ms"
+            )
+
+            rows = sum(conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in (FUNDS_TABLE, FUND_URLS_TABLE))
+            export = bench_xlsx_export(conn, tmp)
+            print(
+                f"  xlsx export ({rows} rows): " + ', '.join(
+                    f"{name} {result['elapsed']:.2f}s, peak {result['peak_mb']:.1f}MiB"
+                    for name, result in export.items()
+                )
+            )
+
+            changed = site.change_pages()
+            funds = webscraper.load_funds(conn)
+            repeat = bench_check_funds(funds, workers, parse_workers)
+            report(f"check_fund (repeat run, {changed} pages changed)", repeat)
+            stats = repeat['connections']
+            print(
+                f"  Funds to check: {len(repeat['funds_to_check'])}, funds to update: {len(repeat['funds_to_update'])}, "
+                f"connections: {stats['connections']} for {stats['requests']} requests"
+            )
+
+            urls = [url for fund in funds for url in fund['urls']][:soup_sample]
+            soup = bench_get_soup(urls, workers)
+            report('get_soup', soup)
+        finally:
+            conn.close()
+    print()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the webscraper against a local fake fund site.')
+    parser.add_argument('--funds', type=int, nargs='+', default=[100, 1000], help='fund counts to benchmark')
+    parser.add_argument('--urls-per-fund', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=CHECK_WORKERS)
+    parser.add_argument('--parse-workers', type=int, default=PARSE_WORKERS, help='processes to parse pages in; 0 parses in the check threads')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per response')
+    parser.add_argument('--page-kb', type=int, default=50, help='page size in KiB')
+    parser.add_argument('--timeout-rate', type=float, default=0.0)
+    parser.add_argument('--e412-rate', type=float, default=0.0)
+    parser.add_argument('--e5xx-rate', type=float, default=0.0)
+    parser.add_argument('--non-html-rate', type=float, default=0.0)
+    parser.add_argument('--change-rate', type=float, default=0.1)
+    parser.add_argument('--timeout-delay', type=float, default=16.0, help='seconds before a timed out request is answered')
+    parser.add_argument('--soup-sample', type=int, default=200, help='number of urls to time get_soup on')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    with FakeFundSite(
+        latency=args.latency,
+        page_bytes=args.page_kb * 1024,
+        timeout_rate=args.timeout_rate,
+        e412_rate=args.e412_rate,
+        e5xx_rate=args.e5xx_rate,
+        non_html_rate=args.non_html_rate,
+        change_rate=args.change_rate,
+        timeout_delay=args.timeout_delay,
+        seed=args.seed
+    ) as site:
+        for n_funds in args.funds:
+            run_benchmark(n_funds, site, args.workers, args.urls_per_fund, args.soup_sample, args.parse_workers)
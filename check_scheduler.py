@@ -0,0 +1,99 @@
+from datetime import date, timedelta
+from typing import Any
+from fund import Fund
+from constants import *
+
+def page_volatile(
+    page: dict[str, Any],
+    today: date
+) -> bool:
+    """Return True if the page changed within the last `CHECK_VOLATILE_DAYS` days.
+
+    Args:
+        page: A dict representing a row in `FUND_URLS_TABLE`
+        today: The date of the current run
+    """
+    if not page['last_changed']:
+        return False
+    return date.fromisoformat(page['last_changed']) > today - timedelta(days=CHECK_VOLATILE_DAYS)
+
+def page_due(
+    page: dict[str, Any] | None,
+    today: date
+) -> bool:
+    """Return True if the page should be checked in the run on `today`.
+
+    New pages, pages without a checksum, pages that failed or need a manual check,
+    recently volatile pages, and pages whose next check date has been reached are due.
+
+    Args:
+        page: A dict representing a row in `FUND_URLS_TABLE`, or None for a new url
+        today: The date of the current run
+    """
+    if page is None or not page['checksum'] or not page['next_check']:
+        return True
+    if page['failures'] or page['needs_check'] or page_volatile(page, today):
+        return True
+    return date.fromisoformat(page['next_check']) <= today
+
+def fund_due(
+    fund: Fund,
+    today: date
+) -> bool:
+    """Return True if the fund should be checked in the run on `today`.
+
+    A fund is due if it is in `CHECK` status, has failed to be accessed, or if any of its
+    urls is due (see `page_due`).
+
+    Args:
+        fund: A fund / a row in the database, with its pages attached
+        today: The date of the current run
+    """
+    if fund['status'] == CHECK or fund['access_failures']:
+        return True
+    return any(page_due(fund['pages'].get(url), today) for url in fund['urls'])
+
+def select_due_funds(
+    funds: list[Fund],
+    today: date | None =None
+) -> tuple[list[Fund], list[Fund]]:
+    """Split `funds` into the funds to check in this run and the funds that can wait.
+
+    Args:
+        funds: A list of funds with pages attached, see `attach_fund_pages`
+        today: The date of the current run; defaults to today
+    Returns:
+        A tuple of the funds that are due and the funds that are not, both in the order of `funds`
+    """
+    today = today or date.today()
+    due = []
+    not_due = []
+    for fund in funds:
+        (due if fund_due(fund, today) else not_due).append(fund)
+    return due, not_due
+
+def schedule_page(
+    page: dict[str, Any],
+    changed: bool,
+    today: date | None =None
+) -> None:
+    """Record a successful check of `page` and set the date of its next check.
+
+    A page that changed is checked again after `CHECK_INTERVAL_MIN` days. Each check
+    that finds the page unchanged doubles the interval, up to `CHECK_INTERVAL_MAX` days.
+
+    Args:
+        page: A dict representing a row in `FUND_URLS_TABLE`
+        changed: True if the page changed since its last check
+        today: The date of the check; defaults to today
+    """
+    today = today or date.today()
+    first_check = not page['checks']
+    page['checks'] += 1
+    if changed:
+        page['changes'] += 1
+        page['last_changed'] = today.isoformat()
+        page['check_interval'] = CHECK_INTERVAL_MIN
+    elif not first_check:
+        page['check_interval'] = min(max(page['check_interval'], CHECK_INTERVAL_MIN) * 2, CHECK_INTERVAL_MAX)
+    page['next_check'] = (today + timedelta(days=page['check_interval'])).isoformat()
@@ -5,8 +5,16 @@ import os
 DATABASE = 'webscraper.db'
 DATABASE_BACKUP = 'backup.db'
 FUNDS_TABLE = 'funds'
+FUND_URLS_TABLE = 'fund_urls'
+CHECK_JOURNAL_TABLE = 'check_journal'
+SNAPSHOTS_TABLE = 'snapshots'
+SNAPSHOT_HISTORY_TABLE = 'snapshot_history'
 USERS_TABLE = 'users'
 
+DB_BUSY_TIMEOUT = 30.0
+DB_CACHE_SIZE_KB = 64 * 1024
+DB_MMAP_SIZE = 256 * 1024 * 1024
+
 FILE_EXT = '.xlsx'
 
 INFILE_DIR = 'inputs'
@@ -18,12 +26,23 @@ OUTFILE_USER_PATH = 'outputs/scraper_funds_user.xlsx'
 OUTFILE_NAME = 'scraper_funds.xlsx'
 AUDITLOG_PATH = 'outputs/auditlog.txt'
 AUDITLOG_NAME = 'auditlog.txt'
+RUN_SUMMARY_PATH = 'outputs/run_summary.json'
+
+SHARD_DIR = 'shards'
 
-DB_FUNDS_COLS = ('name', 'url', 'status', 'urls_to_check', 'checksum', 'access_failures')
+DB_FUNDS_COLS = ('id', 'name', 'url', 'status', 'access_failures', 'ignore_blocks', 'selector')
+FUND_URLS_COLS = (
+    'position', 'checksum', 'etag', 'last_modified', 'last_checked', 'failures', 'needs_check',
+    'checks', 'changes', 'last_changed', 'check_interval', 'next_check',
+    'block_hashes', 'content_checksum', 'changed_blocks'
+)
 INPUT_COLS = ('command', 'name', 'url', 'status')
-OUTPUT_COLS = ('name', 'url', 'status', 'urls_to_check')
+INPUT_OPTIONAL_COLS = ('ignore_blocks', 'selector')
+OUTPUT_COLS = ('name', 'url', 'status', 'urls_to_check', 'changed_blocks')
+SNAPSHOT_OUTPUT_COLS = ('name', 'url', 'previous_captured_at', 'previous', 'current_captured_at', 'current')
 
 DELIM = ';;'
+CLEAR_FIELD = '-'
 
 OPEN = 'Open'
 CLOSED = 'Closed'
@@ -31,6 +50,36 @@ CHECK = 'Check Required'
 
 STATUSES = (OPEN, CLOSED, CHECK)
 
+CHECK_WORKERS = 8
+PARSE_WORKERS = 0
+SHARDS = 1
+SHARD_LAUNCH_LOCAL = True
+SHARD_TIMEOUT = 3600
+SHARD_POLL_INTERVAL = 1.0
+DAEMON_POLL_INTERVAL = 60
+DAEMON_CHECK_INTERVAL = 24 * 60 * 60
+HOST_MAX_CONNECTIONS = 2
+HOST_MIN_INTERVAL = 1.0
+SESSION_POOL_HOSTS = 64
+RETRY_AFTER_MAX = 300
+FAST_FINGERPRINT = False
+CHECKPOINT_FUNDS = 25
+CHECK_JOURNAL_MAX_HOURS = 12
+METRICS_TOP_HOSTS = 5
+CHECK_INTERVAL_MIN = 1
+CHECK_INTERVAL_MAX = 14
+CHECK_VOLATILE_DAYS = 30
+MAX_PAGE_BYTES = 10 * 1024 * 1024
+PAGE_CHUNK_SIZE = 64 * 1024
+BLOCK_TAGS = ('p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'table', 'li')
+BLOCK_SNIPPET_CHARS = 200
+BLOCK_SNIPPETS_MAX = 5
+CHANGED_BLOCKS_MAX_CHARS = 4000
+SNAPSHOT_KEEP_VERSIONS = 5
+SNAPSHOT_MAX_AGE_DAYS = 180
+SNAPSHOT_COMPRESSION_LEVEL = 6
+SNAPSHOT_CELL_CHARS = 32000
+
 HTTP_GET_HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)',
     'Accept': 'text/html,application/xhtml+xml',
@@ -43,7 +92,11 @@ EMAIL_ADDRESS = os.environ['EMAIL_USER']
 EMAIL_PASSWORD = os.environ['EMAIL_PASS']
 SMTP_HOST = 'smtp.gmail.com'
 SMTP_PORT = 465
+SMTP_TIMEOUT = 60
+SMTP_RETRIES = 3
+SMTP_RETRY_BACKOFF = 2.0
 IMAP_HOST = 'imap.gmail.com'
 IMAP_PORT = 993
+IMAP_TIMEOUT = 60
 
 EMAIL_SEND_SUBJECT = 'RE Webscraper'
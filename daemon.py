@@ -0,0 +1,223 @@
+import queue
+import signal
+import threading
+import time
+from datetime import datetime
+from io import StringIO
+import email_handler as mail
+import utilities as util
+import webscraper
+from main import input_path, save_inputs, send_outputs
+from database import db_connect
+from setup import migrate_db
+from host_scheduler import HostScheduler
+from parse_pool import ParsePool
+from run_metrics import RunMetrics
+from session_pool import SessionPool
+from constants import *
+
+class Daemon:
+    """Runs the webscraper as a long-running service, instead of once per cron invocation.
+
+    The database connection, HTTP session pool, host scheduler, parse pool and IMAP
+    session stay open for the life of the service. A background thread polls the mailbox
+    every `poll_interval` seconds. Commands received are executed as soon as they arrive,
+    and the admin users are emailed the audit log and any requested tables. Funds are
+    checked every `check_interval` seconds, and the results emailed as a `main.py` run
+    would.
+
+    Commands that arrive during a fund check stop the check after the funds being checked
+    (see `webscraper.run_checks`). The commands are then executed and the check resumes
+    from the check journal, so the database is only ever written by one of them at a time.
+
+    SIGTERM or SIGINT shuts the service down the same way: a check in progress stops
+    early, and the next start resumes it.
+    """
+
+    def __init__(
+        self,
+        poll_interval: float =DAEMON_POLL_INTERVAL,
+        check_interval: float =DAEMON_CHECK_INTERVAL
+    ) -> None:
+        """
+        Args:
+            poll_interval: The number of seconds between polls of the mailbox
+            check_interval: The number of seconds between the starts of two fund checks
+        """
+        self.poll_interval = poll_interval
+        self.check_interval = check_interval
+        self.conn = db_connect(DATABASE)
+        migrate_db(self.conn)
+        # Inputs left by an earlier run that stopped before executing them are not executed
+        util.clean_dir(INFILE_DIR)
+        self.pool = SessionPool()
+        self.scheduler = HostScheduler()
+        self.parser = ParsePool(PARSE_WORKERS) if PARSE_WORKERS > 0 else None
+        self.inputs = queue.Queue()
+        self.stopping = threading.Event()
+        self.interrupt = threading.Event()
+        self._poller = threading.Thread(target=self._poll_mailbox, name='mailbox-poller', daemon=True)
+
+        # State of the current fund check, kept across interruptions
+        self.check_log = None
+        self.check_metrics = None
+
+    def stop(
+        self,
+        signum: int | None =None,
+        frame: object =None
+    ) -> None:
+        """Shut the service down after its current step. Installed as the SIGTERM and SIGINT handler."""
+        self.stopping.set()
+        self.interrupt.set()
+
+    def first_check_time(self) -> float:
+        """Return the time of the first fund check, from the state left by the last run.
+
+        An interrupted check is resumed at once. Otherwise the first check is due
+        `check_interval` seconds after the last time a page was checked.
+        """
+        if webscraper.journal_fund_ids(self.conn):
+            return time.time()
+        row = self.conn.cursor().execute(f"SELECT MAX(last_checked) FROM {FUND_URLS_TABLE}").fetchone()
+        if not row or not row[0]:
+            return time.time()
+        return datetime.fromisoformat(row[0]).timestamp() + self.check_interval
+
+    def _poll_mailbox(self) -> None:
+        """Fetch input attachments every `poll_interval` seconds and queue them for the main thread."""
+        # sqlite3 connections are not shared between threads
+        conn = db_connect(DATABASE, readonly=True)
+        receiver = mail.MailReceiver(IMAP_HOST, IMAP_PORT, EMAIL_ADDRESS, EMAIL_PASSWORD)
+        try:
+            while not self.stopping.is_set():
+                try:
+                    attachments, skipped = receiver.fetch(conn, USERS_TABLE, FILE_EXT)
+                except Exception as e:
+                    print(f"daemon.py: Unable to fetch emails. Exception: {e}")
+                else:
+                    for sender in skipped:
+                        print(f"daemon.py: Ignored message from non-privileged sender {sender}")
+                    if attachments:
+                        self.inputs.put((attachments, skipped))
+                        self.interrupt.set()
+                self.stopping.wait(self.poll_interval)
+        finally:
+            receiver.close()
+            conn.close()
+
+    def execute_inputs(
+        self,
+        attachments: list[mail.Attachment],
+        skipped: list[str]
+    ) -> None:
+        """Execute the commands in `attachments` and email the audit log and requested tables to the admin users.
+
+        Args:
+            attachments: The input attachments downloaded from admin users
+            skipped: The senders whose messages were ignored
+        """
+        # Only the files of this batch are removed, unlike the `clean_dir` of a `main.py` run,
+        # so that e.g. `RUN_SUMMARY_PATH` is kept
+        inputs = [input_path(i) for i in range(len(attachments))]
+        util.remove_files(inputs + [OUTFILE_ADMIN_PATH, OUTFILE_USER_PATH])
+        try:
+            with open(AUDITLOG_PATH, 'w') as auditlog:
+                auditlog.write('BEGIN EMAIL HANDLER\n-----\n\n')
+                save_inputs(auditlog, attachments, skipped)
+                auditlog.write('-----\nEND EMAIL HANDLER\n\n\nBEGIN WEB SCRAPER\n-----\n\n')
+
+                table_reqs = webscraper.execute_inputs(self.conn, auditlog)
+                funds_to_check = []
+                if table_reqs:
+                    funds_to_check = [fund for fund in webscraper.load_funds(self.conn) if fund['status'] == CHECK]
+                webscraper.write_outputs(self.conn, funds_to_check, table_reqs, user_output=False)
+
+                auditlog.write('-----\nEND WEB SCRAPER\n\n\n')
+        finally:
+            util.remove_files(inputs)
+
+        with mail.MailDispatcher(SMTP_HOST, SMTP_PORT, EMAIL_ADDRESS, EMAIL_PASSWORD) as dispatcher:
+            send_outputs(self.conn, dispatcher, users=False)
+
+    def check_funds(self) -> bool:
+        """Check the funds that are due, or continue an interrupted check, and email the results once done.
+
+        Returns:
+            True if the check finished, False if it was interrupted
+        """
+        if self.check_log is None:
+            self.check_log = StringIO()
+            self.check_metrics = RunMetrics()
+            self.check_log.write('BEGIN WEB SCRAPER\n-----\n\n')
+        log = self.check_log
+        metrics = self.check_metrics
+
+        with metrics.phase('check_funds'):
+            funds, funds_to_check, funds_to_update, finished = webscraper.run_checks(
+                self.conn, log, metrics, self.pool, self.scheduler, self.parser, stop=self.interrupt
+            )
+        if not finished:
+            return False
+
+        util.remove_files([OUTFILE_ADMIN_PATH, OUTFILE_USER_PATH])
+        with metrics.phase('write_outputs'):
+            webscraper.write_outputs(self.conn, funds_to_check, set())
+        log.write('-----\nEND WEB SCRAPER\n\n\n')
+        with open(AUDITLOG_PATH, 'w') as auditlog:
+            auditlog.write(log.getvalue())
+
+        with metrics.phase('email_output'), mail.MailDispatcher(SMTP_HOST, SMTP_PORT, EMAIL_ADDRESS, EMAIL_PASSWORD) as dispatcher:
+            send_outputs(self.conn, dispatcher)
+        metrics.write_json(RUN_SUMMARY_PATH)
+
+        self.check_log = None
+        self.check_metrics = None
+        return True
+
+    def run(self) -> None:
+        """Run the service until SIGTERM or SIGINT, then close its connections and pools."""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self._poller.start()
+
+        next_check = self.first_check_time()
+        try:
+            while not self.stopping.is_set():
+                # Cleared first, so inputs that arrive from here on interrupt the next check
+                self.interrupt.clear()
+                if not self.inputs.empty():
+                    attachments, skipped = self.inputs.get()
+                    try:
+                        self.execute_inputs(attachments, skipped)
+                    except Exception as e:
+                        # One failed batch must not end the service
+                        print(f"daemon.py: Unable to execute inputs. Exception: {e}")
+                elif self.check_log is not None or time.time() >= next_check:
+                    if self.check_log is None:
+                        next_check = time.time() + self.check_interval
+                    try:
+                        self.check_funds()
+                    except Exception as e:
+                        # The funds already checked are in the check journal, and the
+                        # next scheduled check resumes with the rest
+                        print(f"daemon.py: Fund check failed. Exception: {e}")
+                        self.check_log = None
+                        self.check_metrics = None
+                else:
+                    self.interrupt.wait(min(self.poll_interval, max(0.0, next_check - time.time())))
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """Stop the mailbox poller and close every connection and pool."""
+        self.stopping.set()
+        if self._poller.is_alive():
+            self._poller.join()
+        self.pool.close()
+        if self.parser:
+            self.parser.close()
+        self.conn.close()
+
+if __name__ == '__main__':
+    Daemon().run()
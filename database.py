@@ -0,0 +1,81 @@
+import os
+import sqlite3
+from constants import *
+
+class DBConnection(sqlite3.Connection):
+    """An sqlite3 connection that caches the database schema, see `utilities.db_schema`."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.schema_cache = {}
+
+def db_connect(
+    path: str =DATABASE,
+    readonly: bool =False
+) -> sqlite3.Connection:
+    """Open a tuned connection to the sqlite3 database at `path`.
+
+    The database is put in WAL journal mode, so any number of readers can work alongside
+    a single writer without blocking each other; with WAL, `synchronous=NORMAL` is still
+    safe against corruption. Each connection also gets a larger page cache and
+    memory-mapped I/O, and waits up to `DB_BUSY_TIMEOUT` seconds for a lock instead of
+    failing. Connections cache the table and column names used to validate queries.
+
+    A connection is not shared between threads. Threads that read the database while
+    funds are being checked should each open their own, using `readonly=True`.
+
+    Args:
+        path: The sqlite3 .db file to open
+        readonly: Open the database read-only. The file must already exist
+    Returns:
+        The open connection
+    """
+    if readonly:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=DB_BUSY_TIMEOUT, factory=DBConnection)
+    else:
+        conn = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT, factory=DBConnection)
+        conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    return conn
+
+def db_backup(
+    conn: sqlite3.Connection,
+    path: str =DATABASE_BACKUP
+) -> None:
+    """Copy the database opened via `conn` to `path` using the online backup API.
+
+    Args:
+        conn: An open connection to an sqlite3 database
+        path: The sqlite3 .db file to write the backup to
+    """
+    conn_backup = db_connect(path)
+    try:
+        conn.backup(conn_backup)
+    finally:
+        conn_backup.close()
+
+def db_restore(
+    conn: sqlite3.Connection,
+    path: str =DATABASE_BACKUP
+) -> None:
+    """Replace the contents of the database opened via `conn` with the backup at `path`.
+
+    Uses the online backup API, so the restore goes through `conn` and its WAL rather
+    than copying over the live database file. Any open transaction on `conn` must be
+    committed first.
+
+    Args:
+        conn: An open connection to an sqlite3 database
+        path: The sqlite3 .db file to restore from
+    Raises:
+        FileNotFoundError: If there is no backup at `path`
+    """
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"No database backup found at \"{path}\"")
+    conn_backup = db_connect(path, readonly=True)
+    try:
+        conn_backup.backup(conn)
+    finally:
+        conn_backup.close()
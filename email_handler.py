@@ -2,14 +2,191 @@ import smtplib
 import imaplib
 import ssl
 import email
+import email.header
+import email.utils
+import os
+import re
+import base64
+import quopri
+import time
+from dataclasses import dataclass
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
-from email.message import EmailMessage
 import sqlite3
-from utilities import db_get_row
+from typing import Any, Iterator
 from constants import *
 
+@dataclass
+class Attachment:
+    """An attachment downloaded from an email, without the rest of the message."""
+    sender: str
+    filename: str
+    data: bytes
+
+class MailDispatcher:
+    """Sends the emails of a run over a single authenticated SMTP session.
+
+    The session is opened on the first send and reused for every message after it, and
+    each attachment file is read and encoded once, however many messages it is attached
+    to. Sends that fail with a transient error (a dropped connection, a timeout, or a 4xx
+    reply) are retried on a new session, up to `SMTP_RETRIES` times.
+
+    Use as a context manager, so the session is closed at the end:
+
+        with MailDispatcher(SMTP_HOST, SMTP_PORT, EMAIL_ADDRESS, EMAIL_PASSWORD) as dispatcher:
+            dispatcher.send(subject, content, recipients, attachments)
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        sender: str,
+        password: str | None,
+        use_ssl: bool =True,
+        retries: int =SMTP_RETRIES,
+        backoff: float =SMTP_RETRY_BACKOFF
+    ) -> None:
+        """
+        Args:
+            host: The name of the host domain
+            port: The port number for the connection
+            sender: The email address to send from
+            password: The password for the account belonging to `sender`, or None to
+                send without logging in
+            use_ssl: Connect over SSL. Set to False for a local test server
+            retries: The number of times a send is retried after a transient error
+            backoff: The number of seconds to wait before the first retry, doubled for each
+                retry after it
+        """
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.password = password
+        self.use_ssl = use_ssl
+        self.retries = retries
+        self.backoff = backoff
+        self.smtp = None
+        self.sessions = 0
+        self._parts = {}
+
+    def __enter__(self) -> 'MailDispatcher':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def connect(self) -> smtplib.SMTP:
+        """Return the open SMTP session, opening and logging in to a new one if needed."""
+        if self.smtp is None:
+            if self.use_ssl:
+                smtp = smtplib.SMTP_SSL(self.host, self.port, timeout=SMTP_TIMEOUT, context=ssl.create_default_context())
+            else:
+                smtp = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+            try:
+                if self.password is not None:
+                    smtp.login(self.sender, self.password)
+            except Exception:
+                smtp.close()
+                raise
+            self.smtp = smtp
+            self.sessions += 1
+        return self.smtp
+
+    def close(self) -> None:
+        """Close the SMTP session, if one is open."""
+        if self.smtp is None:
+            return
+        try:
+            self.smtp.quit()
+        except smtplib.SMTPException:
+            self.smtp.close()
+        except OSError:
+            pass
+        self.smtp = None
+
+    def attachment(
+        self,
+        file_path: str,
+        file_name: str
+    ) -> MIMEApplication | None:
+        """Return the MIME part of an attachment, reading and encoding the file on first use.
+
+        Args:
+            file_path: The path of the file to attach
+            file_name: The name the file is attached under
+        Returns:
+            The MIME part, or None if the file could not be read
+        """
+        key = (file_path, file_name)
+        if key not in self._parts:
+            try:
+                with open(file_path, 'rb') as f:
+                    self._parts[key] = MIMEApplication(f.read(), Name=file_name)
+            except Exception as e:
+                print(f"email_handler.py: Exception: {e}")
+                return None
+        return self._parts[key]
+
+    def send(
+        self,
+        subject: str,
+        content: str,
+        recipients: str | list[str],
+        attachments: list[tuple[str, str]] =[]
+    ) -> None:
+        """Send an email with optional attachments to `recipients`.
+
+        The list `attachments` is a list of tuples. Each tuple contains two strings,
+        in the format: (`file_path`, `file_name`).
+
+        Args:
+            subject: The subject of the email
+            content: The body message of the email
+            recipients: The email address(es) to send to
+            attachments: A list of files to attach
+        Raises:
+            smtplib.SMTPException: If the email could not be sent, or a transient error
+                persisted through every retry
+        """
+        msg = MIMEMultipart()
+        msg['Subject'] = subject
+        msg['From'] = self.sender
+        msg['To'] = recipients if isinstance(recipients, str) else ', '.join(recipients)
+        msg.attach(MIMEText(content))
+        for file_path, file_name in attachments:
+            part = self.attachment(file_path, file_name)
+            if part is not None:
+                msg.attach(part)
+
+        for attempt in range(self.retries + 1):
+            try:
+                self.connect().send_message(msg)
+                return
+            except Exception as e:
+                if attempt == self.retries or not smtp_error_transient(e):
+                    raise
+                print(f"email_handler.py: Retrying send after transient error: {e}")
+                self.close()
+                time.sleep(self.backoff * 2 ** attempt)
+
+def smtp_error_transient(
+    e: Exception
+) -> bool:
+    """Return True if a failed SMTP send may succeed when retried.
+
+    Dropped connections, timeouts and 4xx replies are transient. Permanent errors, such as
+    a refused login or a 5xx reply, are not.
+    """
+    if isinstance(e, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in e.recipients.values())
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 400 <= e.smtp_code < 500
+    return isinstance(e, (ConnectionError, TimeoutError))
+
 def send_email(
     host: str,
     port: int,
@@ -22,6 +199,8 @@ def send_email(
 ) -> None:
     """Send email from sender to recipient with optional attachments.
 
+    Opens a session for this email only; use `MailDispatcher` to send several emails.
+
     The list `attachments` is a list of tuples. Each tuple contains two strings,
     in the format: (`file_path`, `file_name`).
 
@@ -35,82 +214,400 @@ def send_email(
         recipient: The email address(es) to send to
         attachments: A list of files to attach
     """
-    msg = MIMEMultipart()
-    msg['Subject'] = subject
-    msg['From'] = sender
-    msg['To'] = recipients
-    msg.attach(MIMEText(content))
+    with MailDispatcher(host, port, sender, password) as dispatcher:
+        dispatcher.send(subject, content, recipients, attachments)
 
-    for file_path, file_name in attachments:
-        try:
-            f = open(file_path, 'rb')
-            msg.attach(MIMEApplication(f.read(), Name=file_name))
-            f.close()
-        except Exception as e:
-            print(f"email_handler.py: Exception: {e}")
+def save_attachment(att, path):
+    if os.path.isfile(path):
+        raise FileExistsError(f"File already exists at \"{path}\"")
+    
+    with open(path, 'wb') as f:
+        f.write(att.data if isinstance(att, Attachment) else att.get_payload(decode=True))
 
-    with smtplib.SMTP_SSL(host, port) as smtp:
-        smtp.login(sender, password)
-        smtp.send_message(msg)
 
-def receive_emails(
-    host: str,
-    port: str,
-    recipient: str,
-    password: str,
-    mailbox: str ='INBOX',
-    flag: str ='UNSEEN',
-) -> list[EmailMessage]:
-    mail = imaplib.IMAP4_SSL(host, port, ssl_context=ssl.create_default_context())
-    mail.login(recipient, password)
-    mail.select(mailbox)
+_IMAP_TOKEN = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|\x00(\d+)\x00|([^\s()"\[]+(?:\[[^\]]*\][^\s()"]*)?))', re.S)
+
+def imap_parse_response(
+    data: list[bytes | tuple[bytes, bytes]]
+) -> list[Any]:
+    """Parse the untagged responses of an `imaplib` command into nested lists.
+
+    `imaplib` splits a response around each literal (`{n}` followed by n bytes), returning
+    the text before the literal and the literal together as a tuple. Lists are returned as
+    lists, quoted strings and atoms as str, NIL as None, and literals as bytes.
+
+    Args:
+        data: The data returned by an `imaplib` command
+    Returns:
+        The parsed tokens of every response, in order
+    """
+    literals = []
+    text = b''
+    for item in data:
+        if isinstance(item, tuple):
+            head, literal = item
+            text += re.sub(rb'\{\d+\}$', f"\x00{len(literals)}\x00".encode(), head)
+            literals.append(literal)
+        elif item:
+            text += item + b' '
+
+    stack = [[]]
+    pos = 0
+    while True:
+        m = _IMAP_TOKEN.match(text, pos)
+        if not m:
+            break
+        pos = m.end()
+        opened, closed, quoted, literal, atom = m.groups()
+        if opened:
+            stack.append([])
+        elif closed:
+            if len(stack) > 1:
+                token = stack.pop()
+                stack[-1].append(token)
+        elif quoted is not None:
+            stack[-1].append(re.sub(rb'\\(.)', rb'\1', quoted).decode('utf-8', 'replace'))
+        elif literal is not None:
+            stack[-1].append(literals[int(literal)])
+        else:
+            token = atom.decode('utf-8', 'replace')
+            stack[-1].append(None if token.upper() == 'NIL' else token)
+    while len(stack) > 1:
+        token = stack.pop()
+        stack[-1].append(token)
+    return stack[0]
+
+def imap_fetch_items(
+    data: list[bytes | tuple[bytes, bytes]]
+) -> Iterator[dict[str, Any]]:
+    """Yield the data items of each message in the response of an IMAP FETCH command.
+
+    Args:
+        data: The data returned by `imaplib.IMAP4.uid('FETCH', ...)`
+    Yields:
+        A dict mapping each data item name (upper case and unquoted, e.g. `UID`, `BODYSTRUCTURE`,
+        `BODY[2]`) to its value
+    """
+    for token in imap_parse_response(data):
+        if isinstance(token, list):
+            yield {str(token[i]).upper().replace('"', ''): token[i + 1] for i in range(0, len(token) - 1, 2)}
+
+def _decode_filename(
+    name: str | bytes | None
+) -> str | None:
+    """Decode an attachment filename that may be sent as RFC 2047 encoded words."""
+    if name is None:
+        return None
+    if isinstance(name, bytes):
+        name = name.decode('utf-8', 'replace')
+    try:
+        return str(email.header.make_header(email.header.decode_header(name)))
+    except Exception:
+        return name
+
+def _part_filename(
+    part: list[Any]
+) -> str | None:
+    """Return the filename of a non-multipart BODYSTRUCTURE part, if it has one."""
+    params = {}
+    if isinstance(part[2], list):
+        params.update({str(k).lower(): v for k, v in zip(part[2][::2], part[2][1::2])})
+
+    # The disposition follows the type-specific fields of the part
+    media = (str(part[0]).lower(), str(part[1]).lower())
+    dsp_index = 9 if media[0] == 'text' else 11 if media == ('message', 'rfc822') else 8
+    dsp = part[dsp_index] if len(part) > dsp_index else None
+    if isinstance(dsp, list) and len(dsp) > 1 and isinstance(dsp[1], list):
+        params.update({str(k).lower(): v for k, v in zip(dsp[1][::2], dsp[1][1::2])})
+
+    if params.get('filename*'):
+        value = params['filename*']
+        value = value.decode('utf-8', 'replace') if isinstance(value, bytes) else value
+        return email.utils.collapse_rfc2231_value(email.utils.decode_rfc2231(value))
+    return _decode_filename(params.get('filename') or params.get('name'))
 
-    status, data = mail.search(None, flag)
-    messages = []
+def bodystructure_parts(
+    structure: list[Any],
+    prefix: str =''
+) -> Iterator[tuple[str, str | None, str]]:
+    """Yield the section number, filename and transfer encoding of each leaf part of a message.
 
-    if status == 'OK':
-        for num in data[0].split():
-            status, data = mail.fetch(num, '(RFC822)')
-            msg = email.message_from_bytes(data[0][1], _class=EmailMessage)
-            messages.append(msg)
+    Args:
+        structure: The parsed BODYSTRUCTURE of a message, see `imap_fetch_items`
+        prefix: The section number of `structure` within its message
+    Yields:
+        Tuples of (`section`, `filename`, `encoding`), e.g. ('2', 'input.xlsx', 'base64')
+    """
+    if structure and isinstance(structure[0], list):
+        # Multipart: child parts are listed first, followed by the subtype
+        i = 1
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            yield from bodystructure_parts(child, f"{prefix}.{i}" if prefix else str(i))
+            i += 1
+        return
+    encoding = str(structure[5] or '7bit').lower() if len(structure) > 5 else '7bit'
+    yield (prefix or '1', _part_filename(structure), encoding)
 
-            print('From:', msg['From'])
-            print('Subject:', msg['Subject'])
-            print('Date:', msg['Date'])
-            print('Body:', msg.get_payload())
-            print()
+def decode_part(
+    data: bytes,
+    encoding: str
+) -> bytes:
+    """Decode the body of a message part sent with Content-Transfer-Encoding `encoding`."""
+    if encoding == 'base64':
+        return base64.b64decode(data)
+    if encoding == 'quoted-printable':
+        return quopri.decodestring(data)
+    return data
 
-    mail.close()
-    mail.logout()
+def admin_emails(
+    conn: sqlite3.Connection,
+    table: str
+) -> set[str]:
+    """Return the email addresses of the admin users in `table`.
 
-    return messages
+    Args:
+        conn: An open connection to an sqlite3 database
+        table: The name of the users table
+    """
+    res = conn.cursor().execute(f"SELECT email FROM {table} WHERE admin")
+    return {row[0] for row in res.fetchall()}
 
-def parse_emails(
+def fetch_attachments(
+    mail: imaplib.IMAP4,
     conn: sqlite3.Connection,
     table: str,
-    messages: list[EmailMessage],
-    attachment_ext: str | None =None
-) -> list[EmailMessage]:
+    attachment_ext: str | None =None,
+    flag: str ='UNSEEN'
+) -> tuple[list[Attachment], list[str]]:
+    """Download the attachments sent by admin users from the selected mailbox of `mail`.
+
+    Fetches the sender and structure of every message matching `flag` in a single FETCH
+    command. Messages from senders who are not admin users in `table` are skipped, and
+    from the rest only the parts named with extension `attachment_ext` are downloaded,
+    with one FETCH per distinct set of parts. The skipped messages and those whose parts
+    were all downloaded are then marked as seen, so they are not processed again. A
+    message that could not be downloaded is left unseen, for the next fetch to retry.
+
+    Args:
+        mail: An IMAP connection, logged in and with a mailbox selected
+        conn: An open connection to an sqlite3 database
+        table: The name of the users table
+        attachment_ext: The file extension of the attachments to download, or None for all
+        flag: The IMAP search criteria of the messages to process
+    Returns:
+        A tuple of the downloaded attachments, and the senders whose messages were skipped
+    """
+    status, data = mail.uid('SEARCH', None, flag)
+    if status != 'OK' or not data or not data[0]:
+        return [], []
+    uids = b','.join(data[0].split())
+
+    status, data = mail.uid('FETCH', uids, '(UID BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (FROM)])')
+    if status != 'OK':
+        return [], []
+
+    admins = admin_emails(conn, table)
+    skipped = []
+    wanted = {}
+    done = []
+    for item in imap_fetch_items(data):
+        if 'UID' not in item or 'BODYSTRUCTURE' not in item:
+            continue
+        header = item.get('BODY[HEADER.FIELDS (FROM)]') or b''
+        if isinstance(header, str):
+            header = header.encode()
+        sender = email.utils.parseaddr(email.message_from_bytes(header)['From'] or '')[1]
+        if sender not in admins:
+            skipped.append(sender)
+            done.append(item['UID'])
+            continue
+        parts = [
+            (section, filename, encoding)
+            for section, filename, encoding in bodystructure_parts(item['BODYSTRUCTURE'])
+            if filename and (not attachment_ext or os.path.splitext(filename)[1] == attachment_ext)
+        ]
+        if parts:
+            wanted.setdefault(tuple(section for section, _, _ in parts), []).append((item['UID'], sender, parts))
+        else:
+            done.append(item['UID'])
+
     attachments = []
-    for msg in messages:
-        sender_addr = email.utils.parseaddr(msg['From'])[1]
-        user = db_get_row(conn, table, ('email', 'admin'), key='email', val=sender_addr)
-        if not user or user['admin'] == False:
-            print('INPUT ERROR: Non-privileged user.')
+    for sections, messages in wanted.items():
+        # Messages with the same attachment sections are fetched together
+        status, data = mail.uid(
+            'FETCH',
+            ','.join(uid for uid, _, _ in messages),
+            f"(UID {' '.join(f'BODY.PEEK[{section}]' for section in sections)})"
+        )
+        if status != 'OK':
             continue
+        bodies = {item['UID']: item for item in imap_fetch_items(data) if 'UID' in item}
+        for uid, sender, parts in messages:
+            item = bodies.get(uid, {})
+            message_attachments = []
+            for section, filename, encoding in parts:
+                body = item.get(f"BODY[{section}]")
+                if body is None:
+                    break
+                if isinstance(body, str):
+                    body = body.encode()
+                message_attachments.append(Attachment(sender, filename, decode_part(body, encoding)))
+            else:
+                # Only whole messages are kept, so a retried message is not executed twice
+                attachments.extend(message_attachments)
+                done.append(uid)
 
-        for att in msg.iter_attachments():
-            fname = att.get_filename()
-            root, ext = os.path.splitext(fname)
-            if not attachment_ext or ext == attachment_ext:
-                attachments.append(att)
+    if done:
+        mail.uid('STORE', ','.join(done), '+FLAGS', '(\\Seen)')
+    return attachments, skipped
 
-    return attachments
+def receive_attachments(
+    host: str,
+    port: int,
+    recipient: str,
+    password: str,
+    conn: sqlite3.Connection,
+    table: str,
+    attachment_ext: str | None =None,
+    mailbox: str ='INBOX',
+    flag: str ='UNSEEN'
+) -> tuple[list[Attachment], list[str]]:
+    """Connect to the IMAP server at `host` and download the attachments sent by admin users.
 
-def save_attachment(att, path):
-    if os.path.isfile(path):
-        raise FileExistsError(f"File already exists at \"{path}\"")
-    
-    with open(path, 'wb') as f:
-        f.write(att.get_payload(decode=True))
+    See `fetch_attachments`.
+
+    Args:
+        host: The name of the host domain
+        port: The port number for the connection
+        recipient: The email address to receive at
+        password: The password for the account belonging to `recipient`
+        conn: An open connection to an sqlite3 database
+        table: The name of the users table
+        attachment_ext: The file extension of the attachments to download, or None for all
+        mailbox: The mailbox to read
+        flag: The IMAP search criteria of the messages to process
+    Returns:
+        A tuple of the downloaded attachments, and the senders whose messages were skipped
+    """
+    with MailReceiver(host, port, recipient, password, mailbox) as receiver:
+        return receiver.fetch(conn, table, attachment_ext, flag)
+
+class MailReceiver:
+    """Keeps one IMAP session open for repeated downloads of input attachments.
+
+    The session is opened on the first fetch and reused for every fetch after it, so a
+    long-running process can poll the mailbox often without logging in each time. A fetch
+    on a session the server has dropped reconnects and is retried once.
+
+    Use as a context manager, so the session is closed at the end:
+
+        with MailReceiver(IMAP_HOST, IMAP_PORT, EMAIL_ADDRESS, EMAIL_PASSWORD) as receiver:
+            attachments, skipped = receiver.fetch(conn, USERS_TABLE, FILE_EXT)
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        recipient: str,
+        password: str,
+        mailbox: str ='INBOX',
+        use_ssl: bool =True
+    ) -> None:
+        """
+        Args:
+            host: The name of the host domain
+            port: The port number for the connection
+            recipient: The email address to receive at
+            password: The password for the account belonging to `recipient`
+            mailbox: The mailbox to read
+            use_ssl: Connect over SSL. Set to False for a local test server
+        """
+        self.host = host
+        self.port = port
+        self.recipient = recipient
+        self.password = password
+        self.mailbox = mailbox
+        self.use_ssl = use_ssl
+        self.imap = None
+        self.sessions = 0
+
+    def __enter__(self) -> 'MailReceiver':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def connect(self) -> imaplib.IMAP4:
+        """Return the open IMAP session, opening, logging in to and selecting the mailbox of a new one if needed."""
+        if self.imap is None:
+            if self.use_ssl:
+                imap = imaplib.IMAP4_SSL(self.host, self.port, ssl_context=ssl.create_default_context(), timeout=IMAP_TIMEOUT)
+            else:
+                imap = imaplib.IMAP4(self.host, self.port, timeout=IMAP_TIMEOUT)
+            try:
+                imap.login(self.recipient, self.password)
+                imap.select(self.mailbox)
+            except Exception:
+                try:
+                    imap.shutdown()
+                except OSError:
+                    pass
+                raise
+            self.imap = imap
+            self.sessions += 1
+        return self.imap
+
+    def close(self) -> None:
+        """Close the IMAP session, if one is open."""
+        if self.imap is None:
+            return
+        try:
+            self.imap.close()
+            self.imap.logout()
+        except (imaplib.IMAP4.error, OSError):
+            self.drop()
+        self.imap = None
+
+    def drop(self) -> None:
+        """Discard the IMAP session without logging out, e.g. after the server dropped it."""
+        if self.imap is None:
+            return
+        try:
+            self.imap.shutdown()
+        except OSError:
+            pass
+        self.imap = None
+
+    def fetch(
+        self,
+        conn: sqlite3.Connection,
+        table: str,
+        attachment_ext: str | None =None,
+        flag: str ='UNSEEN'
+    ) -> tuple[list[Attachment], list[str]]:
+        """Download the attachments sent by admin users since the last fetch, see `fetch_attachments`.
+
+        Args:
+            conn: An open connection to an sqlite3 database
+            table: The name of the users table
+            attachment_ext: The file extension of the attachments to download, or None for all
+            flag: The IMAP search criteria of the messages to process
+        Returns:
+            A tuple of the downloaded attachments, and the senders whose messages were skipped
+        """
+        for attempt in range(2):
+            reused = self.imap is not None
+            try:
+                imap = self.connect()
+                if reused:
+                    # Picks up new messages, and fails early if the server dropped the session
+                    imap.noop()
+                return fetch_attachments(imap, conn, table, attachment_ext, flag)
+            except (imaplib.IMAP4.abort, OSError):
+                self.drop()
+                if attempt or not reused:
+                    raise
 
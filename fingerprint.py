@@ -0,0 +1,396 @@
+import hashlib
+import re
+import time
+from collections import Counter
+from types import SimpleNamespace
+from typing import Any, Iterable
+from bs4 import BeautifulSoup
+from bs4.builder import HTMLParserTreeBuilder
+from bs4.builder._htmlparser import BeautifulSoupHTMLParser
+from bs4.element import CData, NavigableString, Tag
+from constants import *
+
+ROOT_TAG_NAME = '[document]'
+BLOCK_HASH_CHARS = 16
+MAIN_CONTENT_STRING_TYPES = (NavigableString, CData)
+
+_EMPTY_ELEMENT = SimpleNamespace(is_empty_element=True)
+_CONTAINER_ELEMENT = SimpleNamespace(is_empty_element=False)
+
+class SelectorNoMatchError(Exception):
+    """Exception to be raised when a fund's CSS selector matches no element of its page."""
+    pass
+
+def normalized_text_checksum(
+    text: str
+) -> str:
+    """Remove all whitespace from `text` and return the SHA-256 checksum of the remainder.
+
+    Args:
+        text: The page text to checksum
+    Returns:
+        The hex digest of the checksum
+    """
+    return hashlib.sha256(''.join(text.split()).encode('utf-8')).hexdigest()
+
+def validate_selector(
+    selector: str
+) -> None:
+    """Raise an exception if `selector` is not a valid CSS selector.
+
+    Args:
+        selector: The CSS selector to validate
+    """
+    BeautifulSoup('', 'html.parser').select(selector)
+
+def selected_roots(
+    soup: BeautifulSoup,
+    selector: str | None
+) -> list[Tag]:
+    """Return the elements of the page body that are fingerprinted.
+
+    Without a `selector`, this is the body itself. Otherwise it is every element matching
+    `selector`, in page order, leaving out elements inside another matching element.
+
+    Args:
+        soup: The parsed page
+        selector: A CSS selector, or None
+    Returns:
+        The elements to fingerprint, or an empty list if the page has no body
+    Raises:
+        SelectorNoMatchError: If `selector` matches no element
+    """
+    if soup.body is None:
+        return []
+    if not selector:
+        return [soup.body]
+    matches = soup.body.select(selector)
+    if not matches:
+        raise SelectorNoMatchError(f"Selector \"{selector}\" matches no element")
+    matched = set(map(id, matches))
+    return [el for el in matches if not any(id(parent) in matched for parent in el.parents)]
+
+def soup_checksum(
+    html: str,
+    timings: dict[str, float] | None =None,
+    selector: str | None =None
+) -> str | None:
+    """Checksum the body text of `html` using a full BeautifulSoup parse.
+
+    Args:
+        html: The html of a page
+        timings: If given, the seconds spent parsing and hashing are added to its
+            `parse` and `hash` keys
+        selector: If given, only the text of the elements matching this CSS selector is
+            checksummed
+    Returns:
+        The hex digest of the checksum, or None if the page has no body
+    Raises:
+        SelectorNoMatchError: If `selector` matches no element of the page
+    """
+    start = time.perf_counter()
+    soup = BeautifulSoup(html, 'html.parser')
+    roots = selected_roots(soup, selector)
+    text = ''.join(root.text for root in roots) if roots else None
+    parsed = time.perf_counter()
+    checksum = normalized_text_checksum(text) if text is not None else None
+    if timings is not None:
+        timings['parse'] = timings.get('parse', 0.0) + parsed - start
+        timings['hash'] = timings.get('hash', 0.0) + time.perf_counter() - parsed
+    return checksum
+
+def block_text(
+    element: Tag
+) -> str:
+    """Return the visible text of a block element, with runs of whitespace collapsed."""
+    return ' '.join(element.get_text(' ').split())
+
+def outer_blocks(
+    root: Tag
+) -> list[Tag]:
+    """Return the outermost block elements (`BLOCK_TAGS`) in `root`, in page order."""
+    blocks = []
+    stack = [root]
+    while stack:
+        element = stack.pop()
+        if element.name in BLOCK_TAGS:
+            blocks.append(element)
+            continue
+        stack.extend(reversed([child for child in element.children if isinstance(child, Tag)]))
+    return blocks
+
+def page_blocks(
+    html: str,
+    ignore: Iterable[str] =(),
+    selector: str | None =None
+) -> dict[str, Any] | None:
+    """Fingerprint each paragraph, heading, table and list item of `html`.
+
+    Only outermost blocks (`BLOCK_TAGS`) are fingerprinted, e.g. a paragraph inside a
+    table is part of the table's block. Blocks whose text matches any of the regular
+    expressions in `ignore` (case-insensitive) are left out.
+
+    Args:
+        html: The html of a page
+        ignore: Regular expressions matching the text of blocks to ignore
+        selector: If given, only blocks inside the elements matching this CSS selector
+            are fingerprinted
+    Returns:
+        None if the page has no body. Otherwise a dict with the `hashes` and `texts` of
+        the blocks in page order, the `content_checksum` of the fingerprinted text
+        with the ignored blocks removed (None if `ignore` is empty), and the readable
+        `text` of the fingerprinted part of the page, one line per text node
+    Raises:
+        SelectorNoMatchError: If `selector` matches no element of the page
+    """
+    soup = BeautifulSoup(html, 'html.parser')
+    roots = selected_roots(soup, selector)
+    if not roots:
+        return None
+    patterns = [re.compile(p, re.IGNORECASE) for p in ignore]
+    text = '\n'.join(root.get_text('\n', strip=True) for root in roots)
+    hashes = []
+    texts = []
+    ignored = []
+    for element in [block for root in roots for block in outer_blocks(root)]:
+        block = block_text(element)
+        if any(p.search(block) for p in patterns):
+            ignored.append(element)
+            continue
+        hashes.append(hashlib.sha256(''.join(block.split()).encode('utf-8')).hexdigest()[:BLOCK_HASH_CHARS])
+        texts.append(block)
+
+    content_checksum = None
+    if patterns:
+        for element in ignored:
+            element.decompose()
+        ignored_ids = set(map(id, ignored))
+        content_checksum = normalized_text_checksum(''.join(root.text for root in roots if id(root) not in ignored_ids))
+    return {'hashes': hashes, 'texts': texts, 'content_checksum': content_checksum, 'text': text}
+
+def diff_blocks(
+    old_hashes: list[str],
+    new_hashes: list[str],
+    new_texts: list[str]
+) -> tuple[list[str], int]:
+    """Compare the block fingerprints of two versions of a page.
+
+    Args:
+        old_hashes: The block hashes of the old version
+        new_hashes: The block hashes of the new version
+        new_texts: The block texts of the new version
+    Returns:
+        A tuple of the texts of the new blocks that are not in the old version, and the
+        number of old blocks that are not in the new version
+    """
+    remaining = Counter(old_hashes)
+    added = []
+    for h, text in zip(new_hashes, new_texts):
+        if remaining[h] > 0:
+            remaining[h] -= 1
+        else:
+            added.append(text)
+    return added, sum(remaining.values())
+
+class _BodyTextSink:
+    """Stand-in for a BeautifulSoup object that hashes body text instead of building a tree.
+
+    Receives the same tree-building calls from `BeautifulSoupHTMLParser` that a
+    BeautifulSoup object would, and follows the same tag stack and string container rules,
+    so that exactly the strings BeautifulSoup would return from `soup.body.text` are fed
+    to the checksum.
+    """
+
+    def __init__(self) -> None:
+        self.builder = HTMLParserTreeBuilder()
+        self.contains_replacement_characters = False
+        self.original_encoding = None
+        self.digest = hashlib.sha256()
+        self._stack = [ROOT_TAG_NAME]
+        self._open_tag_counter = Counter()
+        self._string_container_stack = []
+        self._current_data = []
+        self._body_index = None
+        self._body_closed = False
+
+    @property
+    def found_body(self) -> bool:
+        return self._body_index is not None
+
+    def _in_body(self) -> bool:
+        return self._body_index is not None and not self._body_closed
+
+    def _push_tag(
+        self,
+        name: str
+    ) -> None:
+        self._stack.append(name)
+        self._open_tag_counter[name] += 1
+        if name in self.builder.string_containers:
+            self._string_container_stack.append(len(self._stack) - 1)
+        if name == 'body' and self._body_index is None:
+            self._body_index = len(self._stack) - 1
+
+    def _pop_tag(self) -> None:
+        name = self._stack.pop()
+        self._open_tag_counter[name] -= 1
+        if self._string_container_stack and self._string_container_stack[-1] == len(self._stack):
+            self._string_container_stack.pop()
+        if self._body_index is not None and len(self._stack) <= self._body_index:
+            self._body_closed = True
+
+    def _pop_to_tag(
+        self,
+        name: str
+    ) -> None:
+        if name == ROOT_TAG_NAME:
+            return
+        for i in range(len(self._stack) - 1, 0, -1):
+            if not self._open_tag_counter.get(name):
+                break
+            if self._stack[i] == name:
+                self._pop_tag()
+                break
+            self._pop_tag()
+
+    def handle_starttag(
+        self,
+        name: str,
+        namespace: str | None,
+        nsprefix: str | None,
+        attrs: dict[str, str],
+        sourceline: int | None =None,
+        sourcepos: int | None =None,
+        namespaces: dict[str, str] | None =None
+    ) -> SimpleNamespace:
+        self.endData()
+        self._push_tag(name)
+        if self.builder.can_be_empty_element(name):
+            return _EMPTY_ELEMENT
+        return _CONTAINER_ELEMENT
+
+    def handle_endtag(
+        self,
+        name: str,
+        nsprefix: str | None =None
+    ) -> None:
+        self.endData()
+        self._pop_to_tag(name)
+
+    def handle_data(
+        self,
+        data: str
+    ) -> None:
+        self._current_data.append(data)
+
+    def endData(
+        self,
+        containerClass: type[NavigableString] | None =None
+    ) -> None:
+        if not self._current_data:
+            return
+        data = ''.join(self._current_data)
+        self._current_data = []
+        if not self._in_body():
+            return
+
+        container = containerClass or NavigableString
+        if self._string_container_stack and container is NavigableString:
+            container_tag = self._stack[self._string_container_stack[-1]]
+            container = self.builder.string_containers.get(container_tag, container)
+        if container in MAIN_CONTENT_STRING_TYPES:
+            self.digest.update(''.join(data.split()).encode('utf-8'))
+
+class StreamingFingerprint:
+    """Incremental version of `fast_checksum`, fed the page html a chunk at a time."""
+
+    def __init__(self) -> None:
+        self._sink = _BodyTextSink()
+        self._parser = BeautifulSoupHTMLParser(self._sink, convert_charrefs=False)
+
+    def feed(
+        self,
+        html: str
+    ) -> None:
+        """Parse and hash the next chunk of the page.
+
+        Args:
+            html: The next chunk of the page html
+        """
+        self._parser.feed(html)
+
+    def checksum(self) -> str | None:
+        """Finish parsing the page and return its checksum.
+
+        Returns:
+            The hex digest of the checksum, or None if the page has no body
+        """
+        self._parser.close()
+        self._sink.endData()
+        if not self._sink.found_body:
+            return None
+        return self._sink.digest.hexdigest()
+
+def fast_checksum(
+    html: str
+) -> str | None:
+    """Checksum the body text of `html` in a single streaming pass, without building a tree.
+
+    Produces the same checksum as `soup_checksum`, using the same tokenizer and
+    tree-building rules as BeautifulSoup's 'html.parser' builder.
+
+    Args:
+        html: The html of a page
+    Returns:
+        The hex digest of the checksum, or None if the page has no body
+    """
+    fingerprint = StreamingFingerprint()
+    fingerprint.feed(html)
+    return fingerprint.checksum()
+
+def page_checksum(
+    html: str | Iterable[str],
+    fast: bool =FAST_FINGERPRINT,
+    timings: dict[str, float] | None =None,
+    selector: str | None =None
+) -> str | None:
+    """Checksum the whitespace-stripped body text of `html`.
+
+    `html` may be given as an iterable of text chunks, e.g. a page being streamed from
+    the network. The streaming fingerprinter hashes each chunk as it arrives, while the
+    BeautifulSoup path joins the chunks before parsing.
+
+    Args:
+        html: The html of a page, as a string or an iterable of chunks
+        fast: Use the streaming fingerprinter instead of a full BeautifulSoup parse
+        timings: If given, the seconds spent parsing and hashing are added to its `parse`
+            and `hash` keys. Time spent waiting for chunks is not included. The streaming
+            fingerprinter hashes while it parses, so all of its time counts as `parse`
+        selector: If given, only the text of the elements matching this CSS selector is
+            checksummed. Needs a full BeautifulSoup parse, so `fast` is ignored
+    Returns:
+        The hex digest of the checksum, or None if the page has no body or cannot be read
+    Raises:
+        SelectorNoMatchError: If `selector` matches no element of the page
+    """
+    chunks = [html] if isinstance(html, str) else html
+    try:
+        if fast and not selector:
+            fingerprint = StreamingFingerprint()
+            elapsed = 0.0
+            for chunk in chunks:
+                start = time.perf_counter()
+                fingerprint.feed(chunk)
+                elapsed += time.perf_counter() - start
+            start = time.perf_counter()
+            checksum = fingerprint.checksum()
+            elapsed += time.perf_counter() - start
+            if timings is not None:
+                timings['parse'] = timings.get('parse', 0.0) + elapsed
+            return checksum
+        return soup_checksum(''.join(chunks), timings, selector)
+    except SelectorNoMatchError:
+        raise
+    except Exception as e:
+        print(f"fingerprint.py: page_checksum(): Unable to read page. Exception: {e}")
+        return None
@@ -0,0 +1,67 @@
+from dataclasses import dataclass, field, fields
+from typing import Any
+from constants import *
+
+@dataclass(slots=True, eq=False)
+class Fund:
+    """A fund / a row of `FUNDS_TABLE`, together with the state of its pages during a check.
+
+    Uses `__slots__` instead of a per-instance dict, and splits `url` into `urls` once
+    when the fund is loaded. Fields can also be read and written by name like a dict
+    (`fund['status']`, `fund.get('selector')`), and `to_dict` converts the fund to a
+    plain record for the functions in `utilities.py`.
+
+    Build funds from a query with `utilities.db_record_factory(Fund)`.
+    """
+    id: int
+    name: str
+    url: str
+    status: str
+    access_failures: int =0
+    ignore_blocks: str | None =None
+    selector: str | None =None
+    urls: list[str] =field(init=False)
+    pages: dict[str, dict[str, Any]] =field(default_factory=dict)
+    urls_to_check: str | None =None
+    changed_blocks: str | None =None
+
+    def __post_init__(self) -> None:
+        self.urls = self.url.split(DELIM)
+
+    def __getitem__(
+        self,
+        key: str
+    ) -> Any:
+        if key not in FUND_FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(
+        self,
+        key: str,
+        value: Any
+    ) -> None:
+        if key not in FUND_FIELDS or key == 'urls':
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(
+        self,
+        key: str
+    ) -> bool:
+        return key in FUND_FIELDS
+
+    def get(
+        self,
+        key: str,
+        default: Any =None
+    ) -> Any:
+        """Return field `key`, or `default` if the fund has no such field."""
+        return getattr(self, key) if key in FUND_FIELDS else default
+
+    def to_dict(self) -> dict[str, Any]:
+        """Return the fund's columns and check results as a dict, without its parsed urls and pages."""
+        return {key: getattr(self, key) for key in FUND_RECORD_FIELDS}
+
+FUND_FIELDS = frozenset(f.name for f in fields(Fund))
+FUND_RECORD_FIELDS = tuple(f.name for f in fields(Fund) if f.name not in ('urls', 'pages'))
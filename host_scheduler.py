@@ -0,0 +1,153 @@
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from itertools import zip_longest
+from urllib.parse import urlsplit
+import requests
+from typing import Iterator
+from fund import Fund
+from constants import *
+
+def url_host(
+    url: str
+) -> str:
+    """Return the lowercase host name of `url`.
+
+    Urls without a scheme (e.g. "google.com/page") are grouped by their first path segment.
+
+    Args:
+        url: The url to get the host of
+    Returns:
+        The host name of `url`
+    """
+    host = urlsplit(url).hostname
+    if not host:
+        host = url.strip().split('/')[0].split(':')[0]
+    return host.lower()
+
+def parse_retry_after(
+    response: requests.Response | None
+) -> float | None:
+    """Parse the `Retry-After` header of `response` into a number of seconds to wait.
+
+    Args:
+        response: The response to read the header from
+    Returns:
+        The number of seconds to wait, or None if the header is missing or invalid
+    """
+    if response is None:
+        return None
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+def interleave_by_host(
+    funds: list[Fund]
+) -> list[int]:
+    """Order fund indices so that consecutive funds are on different hosts where possible.
+
+    Funds are grouped by the host of their first url and the groups are taken from
+    round-robin, so that concurrent workers spread their requests across hosts instead
+    of queueing on the same one.
+
+    Args:
+        funds: A list of funds / rows in the database
+    Returns:
+        The indices of `funds`, in the order they should be checked
+    """
+    groups = {}
+    for i, fund in enumerate(funds):
+        host = url_host(fund['urls'][0])
+        groups.setdefault(host, []).append(i)
+    return [i for batch in zip_longest(*groups.values()) for i in batch if i is not None]
+
+class HostScheduler:
+    """Thread-safe per-host request scheduler.
+
+    Limits the number of in-flight requests to each host to `max_per_host` and spaces
+    the start of consecutive requests to the same host by at least `min_interval`
+    seconds. Requests to different hosts do not wait on each other.
+    """
+
+    def __init__(
+        self,
+        max_per_host: int =HOST_MAX_CONNECTIONS,
+        min_interval: float =HOST_MIN_INTERVAL
+    ) -> None:
+        """
+        Args:
+            max_per_host: The maximum number of concurrent requests to a single host
+            min_interval: The minimum number of seconds between requests to a single host
+        """
+        self.max_per_host = max_per_host
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._next_start = {}
+
+    def _semaphore(
+        self,
+        host: str
+    ) -> threading.Semaphore:
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = threading.Semaphore(self.max_per_host)
+            return self._slots[host]
+
+    def _wait_turn(
+        self,
+        host: str
+    ) -> None:
+        # Reserve the next start time for `host` before sleeping, so that waiting
+        # threads are released one `min_interval` apart.
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start.get(host, now))
+            self._next_start[host] = start + self.min_interval
+        if start > now:
+            time.sleep(start - now)
+
+    @contextmanager
+    def slot(
+        self,
+        url: str
+    ) -> Iterator[None]:
+        """Block until a request to the host of `url` may start, and hold a host slot.
+
+        Args:
+            url: The url about to be requested
+        """
+        host = url_host(url)
+        with self._semaphore(host):
+            self._wait_turn(host)
+            yield
+
+    def defer(
+        self,
+        url: str,
+        seconds: float
+    ) -> None:
+        """Delay all further requests to the host of `url` by at least `seconds`.
+
+        Used to honour `Retry-After` headers across every fund on the same host.
+
+        Args:
+            url: A url on the host to delay
+            seconds: The number of seconds to wait before the next request to the host
+        """
+        host = url_host(url)
+        with self._lock:
+            resume = time.monotonic() + seconds
+            self._next_start[host] = max(self._next_start.get(host, 0.0), resume)
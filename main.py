@@ -1,31 +1,40 @@
 from webscraper import main as webscraper_main
 import email_handler as mail
 import utilities as util
+from setup import migrate_db
+from run_metrics import RunMetrics
+from database import db_connect
 import sqlite3
 import os
+from io import TextIOWrapper
 from constants import *
 
-def main() -> None:
-    """Handle incoming emails, pass inputs to `webscraper` main function, and send outputs via email.
-
-    Use functions from `webscraper.py`, `email_handler.py`, and `utilities.py`. Initialize `conn`
-    (type sqlite3.Connection) and `auditlog` (type TextIOWrapper) for use in submodule functions.
+def input_path(
+    index: int
+) -> str:
+    """Return the path in `INFILE_DIR` that the input attachment at `index` is saved to."""
+    return f"{INFILE_DIR}/{INFILE_TEMPLATE.replace('X', str(index+1))}"
+
+def save_inputs(
+    auditlog: TextIOWrapper,
+    attachments: list[mail.Attachment],
+    skipped: list[str]
+) -> None:
+    """Save input attachments to `INFILE_DIR`, for `webscraper.queue_inputs` to read.
+
+    Args:
+        auditlog: The open audit log file to write to
+        attachments: The attachments downloaded from admin users
+        skipped: The senders whose messages were ignored
     """
-    util.clean_dir(INFILE_DIR)
-    util.clean_dir(OUTFILE_DIR)
-
-    conn = sqlite3.connect(DATABASE)
+    for sender in skipped:
+        auditlog.write(f"EMAIL HANDLER: Ignored message from non-privileged sender {sender}\n\n")
 
-    auditlog = open(AUDITLOG_PATH, 'w')
-    auditlog.write('BEGIN EMAIL HANDLER\n-----\n\n')
-    messages = mail.receive_emails(IMAP_HOST, IMAP_PORT, EMAIL_ADDRESS, EMAIL_PASSWORD)
-    attachments = mail.parse_emails(conn, USERS_TABLE, messages, attachment_ext=FILE_EXT)
-    
     if len(attachments) == 0:
         auditlog.write('EMAIL HANDLER: No inputs received\n\n')
 
     for i in range(len(attachments)):
-        path = f"{INFILE_DIR}/{INFILE_TEMPLATE.replace('X', str(i+1))}"
+        path = input_path(i)
         try:
             mail.save_attachment(attachments[i], path)
         except Exception as e:
@@ -33,15 +42,20 @@ def main() -> None:
         else:
             auditlog.write(f"EMAIL HANDLER: Successfully saved input file at {path}\n\n")
 
-    auditlog.write('-----\nEND EMAIL HANDLER\n\n\nBEGIN WEB SCRAPER\n-----\n\n')
-
-    webscraper_main(conn, auditlog)
-
-    auditlog.write('-----\nEND WEB SCRAPER\n\n\n')
-    auditlog.close()
-
+def send_outputs(
+    conn: sqlite3.Connection,
+    dispatcher: mail.MailDispatcher,
+    users: bool =True
+) -> None:
+    """Email the audit log and output files of a run to the admin users, and the funds to check to the other users.
+
+    Args:
+        conn: An open connection to an sqlite3 database
+        dispatcher: The mail dispatcher to send through
+        users: Email the regular users too. If False, only the admin users are emailed, to
+            report on the commands they sent
+    """
     recipients = util.dbtable_to_records(conn, USERS_TABLE)
-    conn.close()
 
     recipients_admin = set(admin['email'] for admin in recipients if admin['admin'] == True)
     recipients_users = set(user['email'] for user in recipients if user['admin'] == False)
@@ -49,13 +63,20 @@ def main() -> None:
     outfile_admin_exists = os.path.isfile(OUTFILE_ADMIN_PATH)
     outfile_user_exists = os.path.isfile(OUTFILE_USER_PATH)
 
+    # Both emails are sent over one SMTP session, and a file attached to both is encoded once
+
     # Prepare and send email to admin users
 
     attachments = [(AUDITLOG_PATH, AUDITLOG_NAME)]
     body_msg = 'No funds to check today.'
 
     if recipients_admin:
-        if outfile_admin_exists and outfile_user_exists:
+        if not users:
+            body_msg = 'Commands executed. See the attached audit log.'
+            if outfile_admin_exists:
+                attachments.insert(0, (OUTFILE_ADMIN_PATH, OUTFILE_NAME))
+                body_msg = 'Commands executed. Table request(s) attached.'
+        elif outfile_admin_exists and outfile_user_exists:
             attachments.insert(0, (OUTFILE_ADMIN_PATH, OUTFILE_NAME))
             body_msg = 'Funds to check and table request(s) attached.'
         elif outfile_admin_exists:
@@ -64,14 +85,9 @@ def main() -> None:
         elif outfile_user_exists:
             attachments.insert(0, (OUTFILE_USER_PATH, OUTFILE_NAME))
             body_msg = 'Funds to check attached.'
-        
+    
         try:
-            mail.send_email(
-                SMTP_HOST, SMTP_PORT,
-                EMAIL_SEND_SUBJECT, body_msg,
-                EMAIL_ADDRESS, EMAIL_PASSWORD,
-                ', '.join(recipients_admin), attachments
-            )
+            dispatcher.send(EMAIL_SEND_SUBJECT, body_msg, ', '.join(recipients_admin), attachments)
         except Exception as e:
             print(f"Failed to send email to admin users. Exception: {e}")
 
@@ -80,20 +96,51 @@ def main() -> None:
     attachments = []
     body_msg = 'No funds to check today.'
 
-    if recipients_users:
+    if recipients_users and users:
         if outfile_user_exists:
             attachments.append((OUTFILE_USER_PATH, OUTFILE_NAME))
             body_msg = 'Funds to check attached.'
-        
+    
         try:
-            mail.send_email(
-                SMTP_HOST, SMTP_PORT,
-                EMAIL_SEND_SUBJECT, body_msg,
-                EMAIL_ADDRESS, EMAIL_PASSWORD,
-                ', '.join(recipients_users), attachments
-            )
+            dispatcher.send(EMAIL_SEND_SUBJECT, body_msg, ', '.join(recipients_users), attachments)
         except Exception as e:
             print(f"Failed to send email to regular users. Exception: {e}")
 
+def main() -> None:
+    """Handle incoming emails, pass inputs to `webscraper` main function, and send outputs via email.
+
+    Use functions from `webscraper.py`, `email_handler.py`, and `utilities.py`. Initialize `conn`
+    (type sqlite3.Connection) and `auditlog` (type TextIOWrapper) for use in submodule functions.
+    Write a JSON summary of the run's timings to `RUN_SUMMARY_PATH`.
+    """
+    util.clean_dir(INFILE_DIR)
+    util.clean_dir(OUTFILE_DIR)
+
+    conn = db_connect(DATABASE)
+    migrate_db(conn)
+
+    metrics = RunMetrics()
+    auditlog = open(AUDITLOG_PATH, 'w')
+    auditlog.write('BEGIN EMAIL HANDLER\n-----\n\n')
+    with metrics.phase('email_input'):
+        attachments, skipped = mail.receive_attachments(
+            IMAP_HOST, IMAP_PORT, EMAIL_ADDRESS, EMAIL_PASSWORD,
+            conn, USERS_TABLE, attachment_ext=FILE_EXT
+        )
+        save_inputs(auditlog, attachments, skipped)
+
+    auditlog.write('-----\nEND EMAIL HANDLER\n\n\nBEGIN WEB SCRAPER\n-----\n\n')
+
+    webscraper_main(conn, auditlog, metrics)
+
+    auditlog.write('-----\nEND WEB SCRAPER\n\n\n')
+    auditlog.close()
+
+    with metrics.phase('email_output'), mail.MailDispatcher(SMTP_HOST, SMTP_PORT, EMAIL_ADDRESS, EMAIL_PASSWORD) as dispatcher:
+        send_outputs(conn, dispatcher)
+    conn.close()
+
+    metrics.write_json(RUN_SUMMARY_PATH)
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,139 @@
+import codecs
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Iterable, Iterator
+from fingerprint import SelectorNoMatchError, page_blocks, page_checksum
+from constants import *
+
+def page_decoder(
+    encoding: str | None
+) -> codecs.IncrementalDecoder:
+    """Return an incremental decoder for a page body, decoding the way `response.text` would.
+
+    Undecodable bytes are replaced. Unknown encodings fall back to utf-8.
+
+    Args:
+        encoding: The encoding declared by the response, if any
+    """
+    try:
+        return codecs.getincrementaldecoder(encoding or 'utf-8')(errors='replace')
+    except LookupError:
+        return codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+def decode_chunks(
+    chunks: Iterable[bytes],
+    encoding: str | None
+) -> Iterator[str]:
+    """Decode the raw chunks of a page body, one chunk at a time.
+
+    Args:
+        chunks: The chunks of the page body, in the order they were received
+        encoding: The encoding declared by the response, if any
+    Yields:
+        Chunks of the decoded page text
+    """
+    decoder = page_decoder(encoding)
+    for chunk in chunks:
+        yield decoder.decode(chunk)
+    yield decoder.decode(b'', final=True)
+
+def fingerprint_page(
+    chunks: list[bytes],
+    encoding: str | None,
+    old_checksum: str | None =None,
+    ignore: Iterable[str] =(),
+    selector: str | None =None,
+    fast: bool =FAST_FINGERPRINT
+) -> dict[str, Any]:
+    """Checksum a page from its raw body, and fingerprint its blocks if it changed.
+
+    Does the CPU work of `webscraper.check_fund` for one url: decodes the body, computes
+    the page checksum (see `fingerprint.page_checksum`), and if the checksum differs from
+    `old_checksum` fingerprints the page's blocks (see `fingerprint.page_blocks`). The
+    body is decoded chunk by chunk exactly as `webscraper.iter_page_text` decodes it, so
+    the results are identical to those computed in-process.
+
+    Args:
+        chunks: The raw chunks of the page body, as read from the response
+        encoding: The encoding declared by the response, if any
+        old_checksum: The stored checksum of the page, if any
+        ignore: Regular expressions matching the text of blocks to ignore
+        selector: If given, only the elements matching this CSS selector are fingerprinted
+        fast: Use the streaming fingerprinter for the page checksum
+    Returns:
+        A dict with the page `checksum` (None if the page cannot be read),
+        `selector_missing` (True if `selector` matched nothing), the page `blocks` (None if
+        not fingerprinted) and the seconds spent on `parse` and `hash`
+    """
+    result = {'checksum': None, 'selector_missing': False, 'blocks': None, 'parse': 0.0, 'hash': 0.0}
+    html = list(decode_chunks(chunks, encoding))
+    try:
+        result['checksum'] = page_checksum(html, fast, timings=result, selector=selector)
+    except SelectorNoMatchError:
+        result['selector_missing'] = True
+        return result
+
+    if result['checksum'] and result['checksum'] != old_checksum:
+        start = time.perf_counter()
+        try:
+            result['blocks'] = page_blocks(''.join(html), ignore, selector)
+        except Exception as e:
+            print(f"parse_pool.py: fingerprint_page(): Unable to fingerprint blocks. Exception: {e}")
+        result['parse'] += time.perf_counter() - start
+    return result
+
+class ParsePool:
+    """Pool of worker processes that parse and fingerprint pages outside the GIL.
+
+    Fund checks fetch pages in threads and hand the raw bodies to this pool, so that
+    network I/O and html parsing are fed through separate queues: the check threads
+    (`CHECK_WORKERS`) wait on the network, while up to `workers` processes parse pages on
+    other cores. Worker processes are started on first use and reused for the whole run.
+    """
+
+    def __init__(
+        self,
+        workers: int =PARSE_WORKERS
+    ) -> None:
+        """
+        Args:
+            workers: The number of worker processes
+        """
+        # Spawned rather than forked, since the pool is used from the fund check threads
+        self._executor = ProcessPoolExecutor(
+            max_workers=max(1, workers),
+            mp_context=multiprocessing.get_context('spawn')
+        )
+        self.workers = max(1, workers)
+
+    def fingerprint(
+        self,
+        chunks: list[bytes],
+        encoding: str | None,
+        old_checksum: str | None =None,
+        ignore: Iterable[str] =(),
+        selector: str | None =None,
+        fast: bool =FAST_FINGERPRINT
+    ) -> dict[str, Any]:
+        """Run `fingerprint_page` in a worker process and wait for its result.
+
+        If the pool has broken (e.g. a worker was killed), the page is fingerprinted
+        in-process instead.
+
+        Args:
+            See `fingerprint_page`
+        Returns:
+            See `fingerprint_page`
+        """
+        args = (chunks, encoding, old_checksum, list(ignore), selector, fast)
+        try:
+            return self._executor.submit(fingerprint_page, *args).result()
+        except BrokenProcessPool as e:
+            print(f"parse_pool.py: ParsePool.fingerprint(): Parse pool unavailable, parsing in-process. Exception: {e}")
+            return fingerprint_page(*args)
+
+    def close(self) -> None:
+        """Shut down the worker processes, waiting for pending pages to finish."""
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,146 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from io import TextIOWrapper
+from typing import Any, Iterator
+from host_scheduler import url_host
+from constants import *
+
+URL_TIMINGS = ('fetch', 'read', 'parse', 'hash')
+
+def new_url_stats() -> dict[str, Any]:
+    """Return an empty stats dict for one url, to be filled in while the url is checked.
+
+    `fetch` is the time until the response headers arrive (including retries and waits),
+    `read` the time spent downloading and decoding the body, and `parse` and `hash` the
+    time spent checksumming the page text.
+    """
+    return {
+        'fetch': 0.0,
+        'read': 0.0,
+        'parse': 0.0,
+        'hash': 0.0,
+        'retries': 0,
+        'bytes': 0,
+        'status': None,
+        'result': None
+    }
+
+class RunMetrics:
+    """Thread-safe collector of timings and counters for one run of the webscraper.
+
+    Records the wall time of each phase of the run and the stats of every url checked,
+    and summarizes them as a JSON run summary and a slowest-hosts section of the audit log.
+    """
+
+    def __init__(self) -> None:
+        self.started_at = datetime.now()
+        self.phases = {}
+        self.urls = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(
+        self,
+        name: str
+    ) -> Iterator[None]:
+        """Time the enclosed block as phase `name` of the run.
+
+        Args:
+            name: The name of the phase. Repeated phases add up
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def record_url(
+        self,
+        url: str,
+        stats: dict[str, Any]
+    ) -> None:
+        """Record the stats of one checked url.
+
+        Args:
+            url: The url checked
+            stats: The stats of the check, see `new_url_stats`
+        """
+        record = {'url': url, 'host': url_host(url), **stats}
+        record['total'] = sum(stats[t] for t in URL_TIMINGS)
+        with self._lock:
+            self.urls.append(record)
+
+    def host_stats(self) -> list[dict[str, Any]]:
+        """Return per-host totals, slowest host (by mean time per url) first."""
+        hosts = {}
+        with self._lock:
+            urls = list(self.urls)
+        for record in urls:
+            host = hosts.setdefault(record['host'], {'host': record['host'], 'urls': 0, 'total': 0.0, 'max': 0.0, 'retries': 0, 'bytes': 0})
+            host['urls'] += 1
+            host['total'] += record['total']
+            host['max'] = max(host['max'], record['total'])
+            host['retries'] += record['retries']
+            host['bytes'] += record['bytes']
+        for host in hosts.values():
+            host['mean'] = host['total'] / host['urls']
+        return sorted(hosts.values(), key=lambda host: host['mean'], reverse=True)
+
+    def summary(self) -> dict[str, Any]:
+        """Return the run summary as a JSON-serializable dict."""
+        with self._lock:
+            urls = list(self.urls)
+            phases = dict(self.phases)
+        totals = {t: sum(record[t] for record in urls) for t in URL_TIMINGS}
+        totals.update({
+            'urls': len(urls),
+            'retries': sum(record['retries'] for record in urls),
+            'bytes': sum(record['bytes'] for record in urls)
+        })
+        return {
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'finished_at': datetime.now().isoformat(timespec='seconds'),
+            'phases': phases,
+            'totals': totals,
+            'slowest_hosts': self.host_stats()[:METRICS_TOP_HOSTS],
+            'urls': urls
+        }
+
+    def write_json(
+        self,
+        path: str =RUN_SUMMARY_PATH
+    ) -> None:
+        """Write the run summary to `path` as JSON.
+
+        Args:
+            path: The file to write the summary to
+        """
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_slowest_hosts(
+        self,
+        log: TextIOWrapper,
+        n: int =METRICS_TOP_HOSTS
+    ) -> None:
+        """Write the `n` slowest hosts of the run to the audit log.
+
+        Args:
+            log: The open audit log file to write to
+            n: The number of hosts to list
+        """
+        hosts = self.host_stats()[:n]
+        if not hosts:
+            return
+        log.write("INFO: Slowest hosts (mean seconds per url):\n")
+        for host in hosts:
+            log.write(
+                f"    {host['host']}: {host['mean']:.2f}s over {host['urls']} url(s), "
+                f"max {host['max']:.2f}s, {host['retries']} retries, {host['bytes']} bytes\n"
+            )
+        log.write('\n')
@@ -0,0 +1,101 @@
+import queue
+import threading
+from contextlib import contextmanager
+import requests
+from requests.adapters import HTTPAdapter
+from typing import Iterator
+from constants import *
+
+class _CountingAdapter(HTTPAdapter):
+    """HTTPAdapter that keeps request and connection counts of evicted host pools."""
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.stats_lock = threading.Lock()
+        self.evicted_requests = 0
+        self.evicted_connections = 0
+        dispose = self.poolmanager.pools.dispose_func
+
+        def record_and_dispose(pool):
+            with self.stats_lock:
+                self.evicted_requests += pool.num_requests
+                self.evicted_connections += pool.num_connections
+            if dispose:
+                dispose(pool)
+            else:
+                pool.close()
+
+        self.poolmanager.pools.dispose_func = record_and_dispose
+
+class SessionPool:
+    """Thread-safe pool of keep-alive `requests.Session` objects.
+
+    Every session in the pool shares a single connection adapter, so open connections
+    are reused across sessions and the number of connections to each host is capped at
+    `connections_per_host`. Sessions themselves are never used by two threads at once.
+    """
+
+    def __init__(
+        self,
+        size: int =CHECK_WORKERS,
+        connections_per_host: int =HOST_MAX_CONNECTIONS,
+        max_hosts: int =SESSION_POOL_HOSTS
+    ) -> None:
+        """
+        Args:
+            size: The number of sessions in the pool
+            connections_per_host: The maximum number of open connections to a single host
+            max_hosts: The number of hosts to keep connections open for at once
+        """
+        self._adapter = _CountingAdapter(
+            pool_connections=max_hosts,
+            pool_maxsize=connections_per_host,
+            pool_block=True
+        )
+        self._sessions = queue.LifoQueue()
+        self._all = []
+        for _ in range(max(1, size)):
+            session = requests.Session()
+            session.headers.update(HTTP_GET_HEADERS)
+            session.mount('http://', self._adapter)
+            session.mount('https://', self._adapter)
+            self._sessions.put(session)
+            self._all.append(session)
+
+    @contextmanager
+    def session(self) -> Iterator[requests.Session]:
+        """Borrow a session from the pool, blocking until one is free."""
+        session = self._sessions.get()
+        try:
+            yield session
+        finally:
+            self._sessions.put(session)
+
+    def stats(self) -> dict[str, int]:
+        """Return request and connection counts for the lifetime of the pool.
+
+        Returns:
+            A dict with the number of `requests` sent, `connections` opened, and
+            `reused` requests that were sent over an already open connection
+        """
+        adapter = self._adapter
+        with adapter.stats_lock:
+            n_requests = adapter.evicted_requests
+            n_connections = adapter.evicted_connections
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                n_requests += pool.num_requests
+                n_connections += pool.num_connections
+        return {
+            'requests': n_requests,
+            'connections': n_connections,
+            'reused': max(0, n_requests - n_connections)
+        }
+
+    def close(self) -> None:
+        """Close every session and connection in the pool."""
+        for session in self._all:
+            session.close()
+        self._adapter.close()
@@ -1,9 +1,100 @@
 import sqlite3
 import os
+import sys
 from utilities import csv_to_records
-from constants import DATABASE, EMAIL_ADDRESS, INFILE_DIR, OUTFILE_DIR
+from database import db_connect
+from constants import DATABASE, DELIM, EMAIL_ADDRESS, INFILE_DIR, OUTFILE_DIR
 from typing import Any
 
+# `funds.name` and `users.email` are already indexed by their UNIQUE constraints
+FUNDS_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS funds_status ON funds (status)",
+)
+
+FUND_URLS_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS fund_urls (
+        id INTEGER NOT NULL PRIMARY KEY,
+        fund_id INTEGER NOT NULL REFERENCES funds (id) ON DELETE CASCADE,
+        position INTEGER NOT NULL DEFAULT 0,
+        url TEXT NOT NULL,
+        checksum TEXT,
+        etag TEXT,
+        last_modified TEXT,
+        last_checked TEXT,
+        failures INTEGER DEFAULT 0,
+        needs_check BOOL DEFAULT 0,
+        checks INTEGER DEFAULT 0,
+        changes INTEGER DEFAULT 0,
+        last_changed TEXT,
+        check_interval INTEGER DEFAULT 1,
+        next_check TEXT,
+        block_hashes TEXT,
+        content_checksum TEXT,
+        changed_blocks TEXT,
+        UNIQUE (fund_id, url))
+    """,
+    "CREATE INDEX IF NOT EXISTS fund_urls_fund_id ON fund_urls (fund_id)",
+    # Foreign keys are not enforced by default in sqlite3, so delete a fund's urls explicitly
+    """CREATE TRIGGER IF NOT EXISTS funds_delete_urls AFTER DELETE ON funds
+    BEGIN
+        DELETE FROM fund_urls WHERE fund_id = OLD.id;
+    END
+    """
+)
+
+CHECK_JOURNAL_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS check_journal (
+        fund_id INTEGER NOT NULL PRIMARY KEY REFERENCES funds (id) ON DELETE CASCADE,
+        checked_at TEXT)
+    """,
+    # Fund ids can be reused after a delete, so forget deleted funds
+    """CREATE TRIGGER IF NOT EXISTS funds_delete_journal AFTER DELETE ON funds
+    BEGIN
+        DELETE FROM check_journal WHERE fund_id = OLD.id;
+    END
+    """
+)
+
+SNAPSHOTS_SCHEMA = (
+    # One compressed copy of each distinct page version, keyed by its page checksum
+    """CREATE TABLE IF NOT EXISTS snapshots (
+        checksum TEXT NOT NULL PRIMARY KEY,
+        data BLOB NOT NULL,
+        size INTEGER NOT NULL,
+        created_at TEXT)
+    """,
+    """CREATE TABLE IF NOT EXISTS snapshot_history (
+        id INTEGER NOT NULL PRIMARY KEY,
+        fund_id INTEGER NOT NULL REFERENCES funds (id) ON DELETE CASCADE,
+        url TEXT NOT NULL,
+        checksum TEXT NOT NULL REFERENCES snapshots (checksum),
+        captured_at TEXT)
+    """,
+    "CREATE INDEX IF NOT EXISTS snapshot_history_fund_url ON snapshot_history (fund_id, url)",
+    "CREATE INDEX IF NOT EXISTS snapshot_history_checksum ON snapshot_history (checksum)",
+    """CREATE TRIGGER IF NOT EXISTS funds_delete_snapshots AFTER DELETE ON funds
+    BEGIN
+        DELETE FROM snapshot_history WHERE fund_id = OLD.id;
+    END
+    """
+)
+
+# Columns added to `funds` and `fund_urls` after they were first created, for migrating older databases
+FUNDS_ADDED_COLS = {
+    'ignore_blocks': 'TEXT',
+    'selector': 'TEXT'
+}
+FUND_URLS_ADDED_COLS = {
+    'checks': 'INTEGER DEFAULT 0',
+    'changes': 'INTEGER DEFAULT 0',
+    'last_changed': 'TEXT',
+    'check_interval': 'INTEGER DEFAULT 1',
+    'next_check': 'TEXT',
+    'block_hashes': 'TEXT',
+    'content_checksum': 'TEXT',
+    'changed_blocks': 'TEXT'
+}
+
 def init_table_funds(
     conn: sqlite3.Connection
 ) -> None:
@@ -20,11 +111,117 @@ def init_table_funds(
         name TEXT UNIQUE NOT NULL,
         url TEXT NOT NULL,
         status TEXT NOT NULL,
-        checksum TEXT,
-        urls_to_check TEXT,
-        access_failures TINYINT DEFAULT 0)
+        access_failures TINYINT DEFAULT 0,
+        ignore_blocks TEXT,
+        selector TEXT)
     """
     )
+    for stmt in FUNDS_INDEXES:
+        cur.execute(stmt)
+    conn.commit()
+
+def init_table_fund_urls(
+    conn: sqlite3.Connection
+) -> None:
+    """Initialize `fund_urls` table in database, which stores the page state of each fund url
+
+    Args:
+        conn: An open connection to an sqlite3 database
+    """
+    cur = conn.cursor()
+    cur.execute("DROP TABLE IF EXISTS fund_urls")
+    for stmt in FUND_URLS_SCHEMA:
+        cur.execute(stmt)
+    conn.commit()
+
+def init_table_check_journal(
+    conn: sqlite3.Connection
+) -> None:
+    """Initialize `check_journal` table in database, which records the funds checked so far in an unfinished run
+
+    Args:
+        conn: An open connection to an sqlite3 database
+    """
+    cur = conn.cursor()
+    cur.execute("DROP TABLE IF EXISTS check_journal")
+    for stmt in CHECK_JOURNAL_SCHEMA:
+        cur.execute(stmt)
+    conn.commit()
+
+def init_table_snapshots(
+    conn: sqlite3.Connection
+) -> None:
+    """Initialize `snapshots` and `snapshot_history` tables in database, which archive the versions of each fund url
+
+    Args:
+        conn: An open connection to an sqlite3 database
+    """
+    cur = conn.cursor()
+    cur.execute("DROP TABLE IF EXISTS snapshot_history")
+    cur.execute("DROP TABLE IF EXISTS snapshots")
+    for stmt in SNAPSHOTS_SCHEMA:
+        cur.execute(stmt)
+    conn.commit()
+
+def migrate_db(
+    conn: sqlite3.Connection
+) -> None:
+    """Bring an existing database up to the current schema, keeping its data.
+
+    Databases from before the `fund_urls` table have their `DELIM`-joined `checksum`,
+    `etag`, `last_modified` and `urls_to_check` columns in `funds` split into one
+    `fund_urls` row per url, after which those columns are dropped. Tables added since
+    the database was created are created empty, and columns added to `funds` and
+    `fund_urls` are added with their default values.
+
+    Safe to run on a database that is already up to date.
+
+    Args:
+        conn: An open connection to an sqlite3 database
+    """
+    cur = conn.cursor()
+    cols = [colinfo[1] for colinfo in cur.execute("PRAGMA table_info(funds)").fetchall()]
+    if not cols:
+        return
+    for stmt in FUND_URLS_SCHEMA + CHECK_JOURNAL_SCHEMA + SNAPSHOTS_SCHEMA:
+        cur.execute(stmt)
+    for c, coltype in FUNDS_ADDED_COLS.items():
+        if c not in cols:
+            cur.execute(f"ALTER TABLE funds ADD COLUMN {c} {coltype}")
+    for stmt in FUNDS_INDEXES:
+        cur.execute(stmt)
+    url_cols = [colinfo[1] for colinfo in cur.execute("PRAGMA table_info(fund_urls)").fetchall()]
+    for c, coltype in FUND_URLS_ADDED_COLS.items():
+        if c not in url_cols:
+            cur.execute(f"ALTER TABLE fund_urls ADD COLUMN {c} {coltype}")
+
+    legacy_cols = [c for c in ('checksum', 'etag', 'last_modified', 'urls_to_check') if c in cols]
+    if legacy_cols:
+        rows = []
+        res = cur.execute(f"SELECT id, url, {', '.join(legacy_cols)} FROM funds")
+        for fund_id, url, *legacy in res.fetchall():
+            urls = url.split(DELIM)
+            fields = dict(zip(legacy_cols, legacy))
+            per_url = {}
+            for c in ('checksum', 'etag', 'last_modified'):
+                values = fields[c].split(DELIM) if fields.get(c) else []
+                per_url[c] = values + [''] * (len(urls) - len(values))
+            to_check = set(fields['urls_to_check'].split(DELIM)) if fields.get('urls_to_check') else set()
+            for i, u in enumerate(urls):
+                rows.append((
+                    fund_id, i, u,
+                    per_url['checksum'][i] or None,
+                    per_url['etag'][i] or None,
+                    per_url['last_modified'][i] or None,
+                    u in to_check
+                ))
+        cur.executemany(
+            """INSERT OR IGNORE INTO fund_urls (fund_id, position, url, checksum, etag, last_modified, needs_check)
+            VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            rows
+        )
+        for c in legacy_cols:
+            cur.execute(f"ALTER TABLE funds DROP COLUMN {c}")
     conn.commit()
 
 def init_table_users(
@@ -68,12 +265,27 @@ def add_funds(
 ) -> None:
     """Add funds from `records` object to `funds` table in database.
 
+    The `checksum` of each record may hold `DELIM`-joined checksums, one per url, which
+    are stored in the `fund_urls` table.
+
     Args:
         conn: An open connection to an sqlite3 database
         records: A list of dicts, with each dict representing a row in database
     """
     cur = conn.cursor()
-    cur.executemany("INSERT INTO funds (name, url, status, checksum) VALUES (:name, :url, :status, :checksum)", records)
+    for rec in records:
+        cur.execute(
+            "INSERT INTO funds (name, url, status, ignore_blocks, selector) VALUES (:name, :url, :status, :ignore_blocks, :selector)",
+            {'ignore_blocks': None, 'selector': None, **rec}
+        )
+        fund_id = cur.lastrowid
+        urls = rec['url'].split(DELIM)
+        checksums = rec['checksum'].split(DELIM) if rec.get('checksum') else []
+        checksums += [None] * (len(urls) - len(checksums))
+        cur.executemany(
+            "INSERT INTO fund_urls (fund_id, position, url, checksum) VALUES (?, ?, ?, ?)",
+            [(fund_id, i, u, checksums[i] or None) for i, u in enumerate(urls)]
+        )
     conn.commit()
 
 def init_dir(path):
@@ -85,10 +297,17 @@ def init_dir(path):
         print(f"setup.py: init_dir(): {e}")
 
 if __name__ == '__main__':
-    conn = sqlite3.connect(DATABASE)
+    conn = db_connect(DATABASE)
+    if sys.argv[1:] == ['migrate']:
+        migrate_db(conn)
+        conn.close()
+        sys.exit()
     init_dir(INFILE_DIR)
     init_dir(OUTFILE_DIR)
     init_table_funds(conn)
+    init_table_fund_urls(conn)
+    init_table_check_journal(conn)
+    init_table_snapshots(conn)
     init_table_users(conn)
     add_user(conn, EMAIL_ADDRESS, True)
     conn.close()
\ No newline at end of file
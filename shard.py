@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import subprocess
+import sys
+from typing import Any
+from fund import Fund
+
+def shard_of(
+    fund_id: int,
+    shards: int
+) -> int:
+    """Return the shard that the fund with id `fund_id` is checked in.
+
+    Uses a hash of the id rather than Python's `hash`, which differs between processes,
+    so every coordinator and worker assigns a fund to the same shard.
+
+    Args:
+        fund_id: The id of the fund
+        shards: The number of shards
+    """
+    digest = hashlib.sha256(str(fund_id).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shards
+
+def split_shards(
+    funds: list[Fund],
+    shards: int
+) -> list[list[Fund]]:
+    """Split `funds` into `shards` lists by `shard_of`, keeping the order of `funds` in each."""
+    groups = [[] for _ in range(shards)]
+    for fund in funds:
+        groups[shard_of(fund['id'], shards)].append(fund)
+    return groups
+
+def fund_to_record(
+    fund: Fund
+) -> dict[str, Any]:
+    """Return `fund` and its pages as a JSON-serializable dict, see `fund_from_record`."""
+    return {**fund.to_dict(), 'pages': list(fund.pages.values())}
+
+def fund_from_record(
+    record: dict[str, Any]
+) -> Fund:
+    """Rebuild a fund and its pages from a dict made by `fund_to_record`."""
+    record = dict(record)
+    pages = {page['url']: page for page in record.pop('pages')}
+    return Fund(**record, pages=pages)
+
+def shard_path(
+    shard_dir: str,
+    shard: int,
+    kind: str
+) -> str:
+    """Return the path of the `input` or `result` file of shard `shard` in `shard_dir`."""
+    return os.path.join(shard_dir, f"shard_{shard}.{kind}.json")
+
+def write_json_atomic(
+    path: str,
+    data: Any
+) -> None:
+    """Write `data` to `path` as JSON, so that readers never see a partly written file.
+
+    The file is written under a temporary name in the same directory and then renamed.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def read_json(
+    path: str
+) -> Any | None:
+    """Return the JSON data in `path`, or None if the file does not exist."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def remove_file(
+    path: str
+) -> None:
+    """Remove the file at `path`, if it exists."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def remove_shard_input(
+    shard_dir: str,
+    shard: int,
+    run_id: str
+) -> None:
+    """Remove the input of shard `shard` if it belongs to run `run_id`.
+
+    A worker removes the input it has checked this way, so that an input written by a
+    newer run in the meantime is kept.
+    """
+    path = shard_path(shard_dir, shard, 'input')
+    data = read_json(path)
+    if data is not None and data['run_id'] == run_id:
+        remove_file(path)
+
+def clear_shard_dir(
+    shard_dir: str
+) -> None:
+    """Remove the shard inputs and results left in `shard_dir` by earlier runs."""
+    for name in os.listdir(shard_dir):
+        if name.startswith('shard_') and name.endswith(('.input.json', '.result.json')):
+            remove_file(os.path.join(shard_dir, name))
+
+def write_shard_input(
+    shard_dir: str,
+    run_id: str,
+    shard: int,
+    funds: list[Fund]
+) -> None:
+    """Write the funds of shard `shard` for a worker to check.
+
+    Args:
+        shard_dir: The directory shared by the coordinator and its workers
+        run_id: The id of the coordinator's run, echoed back in the shard's result
+        shard: The shard number
+        funds: The funds of the shard, with their pages attached
+    """
+    write_json_atomic(shard_path(shard_dir, shard, 'input'), {
+        'run_id': run_id,
+        'shard': shard,
+        'funds': [fund_to_record(fund) for fund in funds]
+    })
+
+def read_shard_result(
+    shard_dir: str,
+    shard: int,
+    run_id: str
+) -> dict[str, Any] | None:
+    """Return the result of shard `shard` for run `run_id`, or None if it is not ready.
+
+    Results left over from other runs are ignored.
+
+    Returns:
+        The result written by `shard_worker.run_shard`, with the checked funds as dicts
+    """
+    result = read_json(shard_path(shard_dir, shard, 'result'))
+    if result is None or result['run_id'] != run_id:
+        return None
+    return result
+
+def launch_shard_worker(
+    shard_dir: str,
+    shard: int
+) -> subprocess.Popen:
+    """Start a local worker process that checks shard `shard` once, see `shard_worker.py`."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shard_worker.py')
+    return subprocess.Popen([sys.executable, script, 'work', shard_dir, str(shard)])
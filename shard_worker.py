@@ -0,0 +1,100 @@
+import argparse
+import time
+import webscraper
+from host_scheduler import HostScheduler
+from parse_pool import ParsePool
+from run_metrics import RunMetrics
+from session_pool import SessionPool
+from shard import fund_from_record, fund_to_record, read_json, remove_shard_input, shard_path, write_json_atomic
+from constants import *
+
+def run_shard(
+    shard_dir: str,
+    shard: int,
+    workers: int =CHECK_WORKERS,
+    parse_workers: int =PARSE_WORKERS
+) -> bool:
+    """Check the funds of shard `shard`, if the coordinator has written them, and write back the results.
+
+    Reads the shard's input file from `shard_dir`, checks each fund with
+    `webscraper.iter_check_results`, and writes the checked funds, their audit log text,
+    url stats and HTTP connection counts to the shard's result file. The input file is
+    then removed, unless a newer run has replaced it. Does not touch the database; the
+    coordinator saves the results.
+
+    Args:
+        shard_dir: The directory shared with the coordinator
+        shard: The shard number
+        workers: The maximum number of funds checked at once
+        parse_workers: The number of processes to parse pages in; 0 parses in the check threads
+    Returns:
+        True if the shard was checked, False if it had no input
+    """
+    input_path = shard_path(shard_dir, shard, 'input')
+    data = read_json(input_path)
+    if data is None:
+        return False
+
+    funds = [fund_from_record(record) for record in data['funds']]
+    metrics = RunMetrics()
+    pool = SessionPool()
+    parser = ParsePool(parse_workers) if parse_workers > 0 and funds else None
+    results = []
+    try:
+        for fund, text, to_check, to_update in webscraper.iter_check_results(funds, workers, HostScheduler(), pool, metrics, parser):
+            results.append({
+                'fund': fund_to_record(fund),
+                'log': text,
+                'to_check': bool(to_check),
+                'to_update': bool(to_update)
+            })
+    finally:
+        pool.close()
+        if parser:
+            parser.close()
+
+    write_json_atomic(shard_path(shard_dir, shard, 'result'), {
+        'run_id': data['run_id'],
+        'shard': shard,
+        'results': results,
+        'urls': metrics.urls,
+        'connections': pool.stats()
+    })
+    remove_shard_input(shard_dir, shard, data['run_id'])
+    return True
+
+def serve_shard(
+    shard_dir: str,
+    shard: int,
+    workers: int =CHECK_WORKERS,
+    parse_workers: int =PARSE_WORKERS,
+    poll_interval: float =SHARD_POLL_INTERVAL
+) -> None:
+    """Check shard `shard` every time the coordinator writes its input, until interrupted.
+
+    For workers on other hosts, which share `shard_dir` with the coordinator.
+
+    Args:
+        shard_dir: The directory shared with the coordinator
+        shard: The shard number
+        workers: The maximum number of funds checked at once
+        parse_workers: The number of processes to parse pages in
+        poll_interval: The number of seconds between looks for new input
+    """
+    while True:
+        if not run_shard(shard_dir, shard, workers, parse_workers):
+            time.sleep(poll_interval)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check one shard of the funds for a coordinating webscraper run.')
+    parser.add_argument('mode', choices=('work', 'serve'), help='check the current input once, or keep checking new inputs')
+    parser.add_argument('shard_dir', help='the directory shared with the coordinator')
+    parser.add_argument('shard', type=int)
+    parser.add_argument('--workers', type=int, default=CHECK_WORKERS)
+    parser.add_argument('--parse-workers', type=int, default=PARSE_WORKERS)
+    args = parser.parse_args()
+
+    if args.mode == 'work':
+        run_shard(args.shard_dir, args.shard, args.workers, args.parse_workers)
+    else:
+        serve_shard(args.shard_dir, args.shard, args.workers, args.parse_workers)
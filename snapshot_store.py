@@ -0,0 +1,180 @@
+import sqlite3
+import zlib
+from datetime import datetime, timedelta
+from typing import Any
+from constants import *
+
+def compress_snapshot(
+    text: str
+) -> bytes:
+    """Compress the text of a page version for storage in `SNAPSHOTS_TABLE`."""
+    return zlib.compress(text.encode('utf-8'), SNAPSHOT_COMPRESSION_LEVEL)
+
+def decompress_snapshot(
+    data: bytes
+) -> str:
+    """Return the text of a page version stored in `SNAPSHOTS_TABLE`."""
+    return zlib.decompress(data).decode('utf-8')
+
+def save_snapshots(
+    conn: sqlite3.Connection,
+    funds: list[dict[str, Any]],
+    captured_at: str | None =None
+) -> None:
+    """Archive the new page versions found while checking `funds`.
+
+    Each page with a new version carries its text in a `snapshot` field, set by
+    `webscraper.check_fund`. The text is stored once per distinct page checksum in
+    `SNAPSHOTS_TABLE`, however many funds, urls or runs it appears in, and a row is added
+    to `SNAPSHOT_HISTORY_TABLE` linking the url to that version. The `snapshot` fields
+    are removed from the pages. Does not commit.
+
+    Args:
+        conn: An open connection to an sqlite3 database
+        funds: A list of funds with pages attached, see `webscraper.attach_fund_pages`
+        captured_at: The time the versions were fetched, defaults to now
+    """
+    captured_at = captured_at or datetime.now().isoformat(timespec='seconds')
+    cur = conn.cursor()
+    for fund in funds:
+        for url, page in fund['pages'].items():
+            text = page.pop('snapshot', None)
+            if text is None or not page['checksum']:
+                continue
+            latest = cur.execute(
+                f"SELECT checksum FROM {SNAPSHOT_HISTORY_TABLE} WHERE fund_id = ? AND url = ? ORDER BY id DESC LIMIT 1",
+                (fund['id'], url)
+            ).fetchone()
+            if latest and latest[0] == page['checksum']:
+                continue
+            data = compress_snapshot(text)
+            cur.execute(
+                f"INSERT OR IGNORE INTO {SNAPSHOTS_TABLE} (checksum, data, size, created_at) VALUES (?, ?, ?, ?)",
+                (page['checksum'], data, len(text), captured_at)
+            )
+            cur.execute(
+                f"INSERT INTO {SNAPSHOT_HISTORY_TABLE} (fund_id, url, checksum, captured_at) VALUES (?, ?, ?, ?)",
+                (fund['id'], url, page['checksum'], captured_at)
+            )
+
+def get_snapshot(
+    conn: sqlite3.Connection,
+    checksum: str
+) -> str | None:
+    """Return the text of the page version with checksum `checksum`, or None if it is not archived.
+
+    Args:
+        conn: An open connection to an sqlite3 database
+        checksum: The page checksum of the version
+    """
+    row = conn.cursor().execute(f"SELECT data FROM {SNAPSHOTS_TABLE} WHERE checksum = ?", (checksum,)).fetchone()
+    return decompress_snapshot(row[0]) if row else None
+
+def url_snapshots(
+    conn: sqlite3.Connection,
+    fund_id: int,
+    url: str,
+    n: int =2
+) -> list[dict[str, Any]]:
+    """Return the `n` latest archived versions of a fund's url, newest first.
+
+    Args:
+        conn: An open connection to an sqlite3 database
+        fund_id: The id of the fund
+        url: The url of the page
+        n: The number of versions to return
+    Returns:
+        A list of dicts with the `checksum`, `captured_at` and `text` of each version
+    """
+    res = conn.cursor().execute(
+        f"""SELECT h.checksum, h.captured_at, s.data FROM {SNAPSHOT_HISTORY_TABLE} h
+        JOIN {SNAPSHOTS_TABLE} s ON s.checksum = h.checksum
+        WHERE h.fund_id = ? AND h.url = ? ORDER BY h.id DESC LIMIT ?""",
+        (fund_id, url, n)
+    )
+    return [
+        {'checksum': checksum, 'captured_at': captured_at, 'text': decompress_snapshot(data)}
+        for checksum, captured_at, data in res.fetchall()
+    ]
+
+def snapshot_records(
+    conn: sqlite3.Connection,
+    funds: list[dict[str, Any]]
+) -> list[dict[str, Any]]:
+    """Build the admin output rows comparing the previous and current version of each url to check.
+
+    Texts are cut to `SNAPSHOT_CELL_CHARS` characters to fit in a spreadsheet cell.
+
+    Args:
+        conn: An open connection to an sqlite3 database
+        funds: A list of funds with `urls_to_check`, e.g. the funds to check of a run
+    Returns:
+        A list of dicts with the columns `SNAPSHOT_OUTPUT_COLS`, one per url
+    """
+    def cell(text: str | None) -> str | None:
+        if text is None or len(text) <= SNAPSHOT_CELL_CHARS:
+            return text
+        return text[:SNAPSHOT_CELL_CHARS] + '...'
+
+    records = []
+    for fund in funds:
+        if not fund.get('urls_to_check'):
+            continue
+        for url in fund['urls_to_check'].split(DELIM):
+            versions = url_snapshots(conn, fund['id'], url) + [None, None]
+            current, previous = versions[0], versions[1]
+            records.append({
+                'name': fund['name'],
+                'url': url,
+                'previous_captured_at': previous['captured_at'] if previous else None,
+                'previous': cell(previous['text']) if previous else None,
+                'current_captured_at': current['captured_at'] if current else None,
+                'current': cell(current['text']) if current else None
+            })
+    return records
+
+def prune_snapshots(
+    conn: sqlite3.Connection,
+    keep: int =SNAPSHOT_KEEP_VERSIONS,
+    max_age_days: int =SNAPSHOT_MAX_AGE_DAYS,
+    commit: bool =True
+) -> int:
+    """Apply the snapshot retention policy.
+
+    Keeps the `keep` latest versions of each fund url. Versions of urls that are no
+    longer in `FUND_URLS_TABLE` are kept for `max_age_days` days. Archived texts no
+    longer referenced by any url are then deleted.
+
+    Args:
+        conn: An open connection to an sqlite3 database
+        keep: The number of versions to keep per url
+        max_age_days: The number of days to keep the versions of removed urls
+        commit: Commit the changes; set to False when called inside a transaction
+    Returns:
+        The number of archived texts deleted
+    """
+    cutoff = (datetime.now() - timedelta(days=max_age_days)).isoformat(timespec='seconds')
+    cur = conn.cursor()
+    cur.execute(
+        f"""DELETE FROM {SNAPSHOT_HISTORY_TABLE} WHERE id IN (
+            SELECT id FROM (
+                SELECT id, ROW_NUMBER() OVER (PARTITION BY fund_id, url ORDER BY id DESC) AS rn
+                FROM {SNAPSHOT_HISTORY_TABLE}
+            ) WHERE rn > ?
+        )""",
+        (keep,)
+    )
+    cur.execute(
+        f"""DELETE FROM {SNAPSHOT_HISTORY_TABLE} WHERE captured_at < ? AND NOT EXISTS (
+            SELECT 1 FROM {FUND_URLS_TABLE} f
+            WHERE f.fund_id = {SNAPSHOT_HISTORY_TABLE}.fund_id AND f.url = {SNAPSHOT_HISTORY_TABLE}.url
+        )""",
+        (cutoff,)
+    )
+    cur.execute(
+        f"DELETE FROM {SNAPSHOTS_TABLE} WHERE checksum NOT IN (SELECT checksum FROM {SNAPSHOT_HISTORY_TABLE})"
+    )
+    deleted = cur.rowcount
+    if commit:
+        conn.commit()
+    return deleted
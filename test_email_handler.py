@@ -0,0 +1,89 @@
+import os
+os.environ.setdefault('EMAIL_USER', 'test@example.com')
+os.environ.setdefault('EMAIL_PASS', 'test')
+
+import smtplib
+import socketserver
+import threading
+import pytest
+from email_handler import MailDispatcher, smtp_error_transient
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """A minimal SMTP server that replies 421 to the next `fail_next` messages."""
+
+    def reply(self, line: str) -> None:
+        self.wfile.write(f"{line}\r\n".encode('ascii'))
+
+    def handle(self) -> None:
+        state = self.server.state
+        state['sessions'] += 1
+        self.reply('220 test')
+        while True:
+            line = self.rfile.readline().decode('ascii').strip()
+            if not line:
+                return
+            cmd = line.split(' ')[0].upper()
+            if cmd in ('EHLO', 'HELO', 'RCPT', 'RSET', 'NOOP'):
+                self.reply('250 ok')
+            elif cmd == 'MAIL':
+                if state['fail_next']:
+                    state['fail_next'] -= 1
+                    self.reply('421 try again later')
+                    return
+                self.reply('250 ok')
+            elif cmd == 'DATA':
+                self.reply('354 go ahead')
+                while self.rfile.readline() != b'.\r\n':
+                    pass
+                state['messages'] += 1
+                self.reply('250 queued')
+            elif cmd == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('502 not implemented')
+
+@pytest.fixture
+def server():
+    srv = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPHandler)
+    srv.daemon_threads = True
+    srv.state = {'sessions': 0, 'messages': 0, 'fail_next': 0}
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+def dispatcher(srv, retries: int =2) -> MailDispatcher:
+    return MailDispatcher('127.0.0.1', srv.server_address[1], 'sender@example.com', None, use_ssl=False, retries=retries, backoff=0.01)
+
+def test_reuses_session(server):
+    with dispatcher(server) as d:
+        d.send('subject', 'first', 'a@example.com')
+        d.send('subject', 'second', ['b@example.com', 'c@example.com'])
+        assert d.sessions == 1
+    assert server.state['messages'] == 2
+
+def test_retries_transient_error(server, capsys):
+    server.state['fail_next'] = 2
+    with dispatcher(server) as d:
+        d.send('subject', 'body', 'a@example.com')
+        assert d.sessions == 3
+    assert server.state['messages'] == 1
+    assert capsys.readouterr().out.count('Retrying send after transient error') == 2
+
+def test_gives_up_after_retries(server):
+    server.state['fail_next'] = 10
+    with pytest.raises(smtplib.SMTPException):
+        with dispatcher(server, retries=2) as d:
+            d.send('subject', 'body', 'a@example.com')
+    assert server.state['sessions'] == 3
+    assert server.state['messages'] == 0
+
+def test_smtp_error_transient():
+    assert smtp_error_transient(smtplib.SMTPServerDisconnected('dropped'))
+    assert smtp_error_transient(smtplib.SMTPSenderRefused(421, b'try again later', 'a@example.com'))
+    assert smtp_error_transient(TimeoutError())
+    assert not smtp_error_transient(smtplib.SMTPAuthenticationError(535, b'bad login'))
+    assert not smtp_error_transient(smtplib.SMTPSenderRefused(550, b'rejected', 'a@example.com'))
+    assert smtp_error_transient(smtplib.SMTPRecipientsRefused({'a@example.com': (450, b'busy')}))
+    assert not smtp_error_transient(smtplib.SMTPRecipientsRefused({'a@example.com': (450, b'busy'), 'b@example.com': (550, b'unknown')}))
@@ -0,0 +1,115 @@
+import os
+os.environ.setdefault('EMAIL_USER', 'test@example.com')
+os.environ.setdefault('EMAIL_PASS', 'test')
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+import pytest
+import setup
+import webscraper
+from database import db_connect
+from fund import Fund
+from shard import clear_shard_dir, read_shard_result, remove_shard_input, shard_of, shard_path, split_shards, write_json_atomic, write_shard_input
+
+class PageHandler(BaseHTTPRequestHandler):
+    """Serve a small page naming the fund in the request path."""
+
+    def do_GET(self) -> None:
+        body = f"<html><body><h1>{self.path.strip('/')}</h1><p>Deadline 1 May</p></body></html>".encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+@pytest.fixture
+def server():
+    srv = ThreadingHTTPServer(('127.0.0.1', 0), PageHandler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{srv.server_address[1]}"
+    srv.shutdown()
+    srv.server_close()
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = db_connect(str(tmp_path / 'webscraper.db'))
+    setup.init_table_funds(conn)
+    setup.init_table_fund_urls(conn)
+    setup.init_table_check_journal(conn)
+    setup.init_table_snapshots(conn)
+    yield conn
+    conn.close()
+
+def make_funds(ids: list[int]) -> list[Fund]:
+    return [Fund(id=i, name=f"F{i}", url=f"http://example.com/{i}", status='Open') for i in ids]
+
+def test_shard_of_is_stable_and_in_range():
+    for shards in (1, 2, 3, 7):
+        for fund_id in range(200):
+            shard = shard_of(fund_id, shards)
+            assert 0 <= shard < shards
+            assert shard == shard_of(fund_id, shards)
+    # A sha256 of the id, not Python's per-process `hash`, so these never change
+    assert [shard_of(fund_id, 3) for fund_id in range(1, 11)] == [1, 1, 1, 1, 2, 0, 2, 0, 0, 0]
+    assert all(shard_of(fund_id, 1) == 0 for fund_id in range(50))
+
+def test_split_shards_keeps_every_fund_in_order():
+    funds = make_funds(list(range(1, 101)))
+    groups = split_shards(funds, 4)
+    assert len(groups) == 4
+    assert sorted(f['id'] for group in groups for f in group) == list(range(1, 101))
+    for i, group in enumerate(groups):
+        assert all(shard_of(f['id'], 4) == i for f in group)
+        assert [f['id'] for f in group] == sorted(f['id'] for f in group)
+    assert sum(1 for group in groups if group) > 1
+
+def test_clear_shard_dir_removes_only_shard_files(tmp_path):
+    for name in ('shard_0.input.json', 'shard_1.result.json', 'shard_2.input.json'):
+        write_json_atomic(str(tmp_path / name), {'run_id': 'old'})
+    (tmp_path / 'notes.txt').write_text('keep')
+    clear_shard_dir(str(tmp_path))
+    assert os.listdir(tmp_path) == ['notes.txt']
+
+def test_remove_shard_input_keeps_newer_run(tmp_path):
+    shard_dir = str(tmp_path)
+    write_shard_input(shard_dir, 'new', 0, make_funds([1]))
+    remove_shard_input(shard_dir, 0, 'old')
+    assert os.path.exists(shard_path(shard_dir, 0, 'input'))
+    remove_shard_input(shard_dir, 0, 'new')
+    assert not os.path.exists(shard_path(shard_dir, 0, 'input'))
+
+def test_read_shard_result_ignores_other_runs(tmp_path):
+    shard_dir = str(tmp_path)
+    assert read_shard_result(shard_dir, 0, 'run') is None
+    write_json_atomic(shard_path(shard_dir, 0, 'result'), {'run_id': 'old', 'results': []})
+    assert read_shard_result(shard_dir, 0, 'run') is None
+    assert read_shard_result(shard_dir, 0, 'old')['run_id'] == 'old'
+
+def test_timeout_falls_back_to_local_check(tmp_path, conn, server, monkeypatch):
+    monkeypatch.setattr(webscraper, 'SHARD_POLL_INTERVAL', 0.05)
+    setup.add_funds(conn, [{'name': f"F{i}", 'url': f"{server}/F{i}", 'status': 'Open'} for i in range(8)])
+    funds = webscraper.load_funds(conn)
+    shard_dir = str(tmp_path / 'shards')
+    os.makedirs(shard_dir)
+    # Left by an earlier run, and must not be merged into this one
+    write_json_atomic(shard_path(shard_dir, 0, 'result'), {'run_id': 'old', 'results': []})
+
+    log = StringIO()
+    funds_to_check = []
+    funds_to_update = []
+    webscraper.check_funds_sharded(conn, log, funds, funds_to_check, funds_to_update, shards=3, shard_dir=shard_dir, launch=False, timeout=0.2)
+
+    text = log.getvalue()
+    nonempty = [i for i, group in enumerate(split_shards(funds, 3)) if group]
+    for i in nonempty:
+        assert f"WARNING: Shard {i} did not report back within 0.2 seconds" in text
+    # New pages are saved, so every fund is updated, in the order of `funds`
+    assert [f['id'] for f in funds_to_update] == [f['id'] for f in funds]
+    assert funds_to_check == []
+    assert os.listdir(shard_dir) == []
+    checksums = conn.execute('SELECT checksum FROM fund_urls').fetchall()
+    assert len(checksums) == 8 and all(row[0] for row in checksums)
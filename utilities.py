@@ -1,14 +1,45 @@
 import csv
 import pandas as pd
-import numpy as np
 import sqlite3
 import os
+import dataclasses
+import openpyxl
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from contextlib import contextmanager
+from functools import lru_cache
 from typing import *
 
 class InvalidInputError(ValueError):
     """Exception to be raised when database functions are passed invalid input."""
     pass
 
+def db_schema(
+    conn: sqlite3.Connection
+) -> dict[str, Any] | None:
+    """Return the cached schema metadata of the database opened via `conn`.
+
+    Connections opened with `database.db_connect` keep a cache of the database's table
+    names, and of the columns of each table as they are looked up. The cache is checked
+    against sqlite3's `schema_version`, which changes on every schema change (including
+    a `RESTORE`), so it is reloaded after any DDL.
+
+    Args:
+        conn: An open connection to an sqlite3 database
+    Returns:
+        A dict with the set of `tables` and a `cols` dict of column lists by table, or
+        None if `conn` does not keep a cache
+    """
+    cache = getattr(conn, 'schema_cache', None)
+    if cache is None:
+        return None
+    version = conn.execute('PRAGMA schema_version').fetchone()[0]
+    if cache.get('version') != version:
+        cache.clear()
+        cache['version'] = version
+        cache['tables'] = {row[0] for row in conn.execute('SELECT name FROM sqlite_master')}
+        cache['cols'] = {}
+    return cache
+
 def db_validate_table(
     conn: sqlite3.Connection,
     table: str
@@ -21,6 +52,11 @@ def db_validate_table(
     Raises:
         InvalidInputError: `table` is not in database opened via `conn` 
     """
+    schema = db_schema(conn)
+    if schema is not None:
+        if table not in schema['tables']:
+            raise InvalidInputError('Table not found')
+        return
     cur = conn.cursor()
     res = cur.execute('SELECT name FROM sqlite_master')
     if (table,) not in res.fetchall():
@@ -40,34 +76,190 @@ def db_validate_cols(
     Raises:
         InvalidInputError: Any column in `cols` is not present in `table`
     """
-    cur = conn.cursor()
-    res = cur.execute(f"PRAGMA table_info({table})")
-    db_cols = [colinfo[1] for colinfo in res.fetchall()]
+    schema = db_schema(conn)
+    db_cols = schema['cols'].get(table) if schema is not None else None
+    if db_cols is None:
+        res = conn.cursor().execute(f"PRAGMA table_info({table})")
+        db_cols = [colinfo[1] for colinfo in res.fetchall()]
+        if schema is not None:
+            schema['cols'][table] = db_cols
     for c in cols:
         if c not in db_cols:
             raise InvalidInputError(f"Invalid field name: {c}")
 
+# SQL templates, built once per table and column set. sqlite3 keeps a prepared statement
+# for each distinct SQL string it has recently run, so reusing the same string for the
+# same operation also reuses its prepared statement.
+
+@lru_cache(maxsize=256)
+def sql_select(
+    table: str,
+    cols: tuple[str, ...],
+    key: str
+) -> str:
+    """Return the SELECT of `cols` from the rows of `table` matching `key` = ?."""
+    return f"SELECT {', '.join(cols)} FROM {table} WHERE {key} = ?"
+
+@lru_cache(maxsize=256)
+def sql_insert(
+    table: str,
+    cols: tuple[str, ...]
+) -> str:
+    """Return the INSERT of a row of named parameters `cols` into `table`."""
+    return f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({', '.join(f':{c}' for c in cols)})"
+
+@lru_cache(maxsize=256)
+def sql_update(
+    table: str,
+    cols: tuple[str, ...],
+    key: str
+) -> str:
+    """Return the UPDATE of named parameters `cols` of the rows of `table` matching `:key`."""
+    return f"UPDATE {table} SET {', '.join(f'{c} = :{c}' for c in cols)} WHERE {key} = :{key}"
+
+@lru_cache(maxsize=256)
+def sql_delete(
+    table: str,
+    key: str
+) -> str:
+    """Return the DELETE of the rows of `table` matching `key` = ?."""
+    return f"DELETE FROM {table} WHERE {key} = ?"
+
+@lru_cache(maxsize=256)
+def sql_upsert(
+    table: str,
+    cols: tuple[str, ...],
+    key: tuple[str, ...]
+) -> str:
+    """Return the INSERT of named parameters `key` and `cols` into `table`, updating `cols` on a `key` conflict."""
+    return (
+        f"INSERT INTO {table} ({', '.join([*key, *cols])}) VALUES ({', '.join(f':{c}' for c in [*key, *cols])}) "
+        f"ON CONFLICT ({', '.join(key)}) DO UPDATE SET {', '.join(f'{c} = excluded.{c}' for c in cols)}"
+    )
+
+@contextmanager
+def db_transaction(
+    conn: sqlite3.Connection
+) -> Iterator[None]:
+    """Run the enclosed database operations in a single transaction.
+
+    Commits once when the block exits, or rolls back every operation in the block if
+    an exception is raised. Functions called inside the block must not commit, i.e.
+    should be passed `commit=False`.
+
+    Args:
+        conn: An open connection to an sqlite3 database
+    Raises:
+        sqlite3.ProgrammingError: A transaction is already open on `conn`; it is neither
+            committed nor rolled back
+    """
+    if conn.in_transaction:
+        raise sqlite3.ProgrammingError('A transaction is already open; commit or roll it back first')
+    conn.cursor().execute('BEGIN')
+    try:
+        yield
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+@contextmanager
+def db_savepoint(
+    conn: sqlite3.Connection,
+    name: str ='sp'
+) -> Iterator[None]:
+    """Run the enclosed database operations in a savepoint.
+
+    If an exception is raised, only the operations in the block are rolled back, and the
+    exception is re-raised. Otherwise the savepoint is released into the enclosing
+    transaction. If no transaction is open, one is begun and left open, so that many
+    savepoints can be committed together with a single `conn.commit()`.
+
+    Args:
+        conn: An open connection to an sqlite3 database
+        name: The name of the savepoint
+    """
+    cur = conn.cursor()
+    if not conn.in_transaction:
+        cur.execute('BEGIN')
+    cur.execute(f"SAVEPOINT {name}")
+    try:
+        yield
+    except BaseException:
+        cur.execute(f"ROLLBACK TO {name}")
+        cur.execute(f"RELEASE {name}")
+        raise
+    else:
+        cur.execute(f"RELEASE {name}")
+
 # from https://docs.python.org/3/library/sqlite3.html#sqlite3-howto-row-factory
-def db_dict_factory(cursor, row):
-    fields = [column[0] for column in cursor.description]
-    return {key: value for key, value in zip(fields, row)}
+def db_dict_factory() -> Callable[[sqlite3.Cursor, tuple], dict[str, Any]]:
+    """Return a row factory that builds a dict from each row.
+
+    The field names are read once per query, from the first row's `cursor.description`.
+    Each factory keeps its own field names, so give each cursor its own factory.
+
+    Returns:
+        A function to set as the `row_factory` of a cursor
+    """
+    cache = {}
+
+    def factory(cursor, row):
+        if cache.get('description') is not cursor.description:
+            cache['description'] = cursor.description
+            cache['fields'] = [column[0] for column in cursor.description]
+        return dict(zip(cache['fields'], row))
+    return factory
+
+def db_record_factory(
+    cls: type
+) -> Callable[[sqlite3.Cursor, tuple], Any]:
+    """Return a row factory that builds an instance of dataclass `cls` from each row.
+
+    Columns are matched to the fields of `cls` by name once per query, from the first
+    row's `cursor.description`; columns that `cls` has no field for are left out.
+
+    Args:
+        cls: A dataclass whose fields include the queried columns, e.g. `fund.Fund`
+    Returns:
+        A function to set as the `row_factory` of a cursor
+    """
+    names = {f.name for f in dataclasses.fields(cls) if f.init}
+    cache = {}
+
+    def factory(cursor, row):
+        if cache.get('description') is not cursor.description:
+            cache['description'] = cursor.description
+            cache['fields'] = [(i, column[0]) for i, column in enumerate(cursor.description) if column[0] in names]
+        return cls(**{name: row[i] for i, name in cache['fields']})
+    return factory
+
+def record_dict(
+    record: Any
+) -> dict[str, Any]:
+    """Return `record` as a dict: dicts as they are, and other records (e.g. `fund.Fund`) via their `to_dict`."""
+    return record if isinstance(record, dict) else record.to_dict()
 
 def dbtable_to_records(
     conn: sqlite3.Connection,
-    table: str
-) -> list[dict[str, Any]]:
+    table: str,
+    row_factory: Callable[[sqlite3.Cursor, tuple], Any] | None =None
+) -> list[Any]:
     """Convert a database table to a records (list of dicts) object.
 
     Args:
         conn: An open connection to an sqlite3 database
         table: The name of a table in the database
+        row_factory: The function that builds each record from a row, e.g.
+            `db_record_factory(Fund)` to build `fund.Fund` records; dicts by default
     Returns:
-        records: A list of dicts, each dict representing a row in `table`
+        records: A list of records (dicts by default), each representing a row in `table`
     """
     cur = conn.cursor()
     db_validate_table(conn, table)
     
-    cur.row_factory = db_dict_factory
+    cur.row_factory = row_factory or db_dict_factory()
     cur.execute(f"SELECT * FROM {table}")
 
     records = []
@@ -79,7 +271,8 @@ def records_update_dbtable(
     conn: sqlite3.Connection,
     table: str,
     cols: list | tuple | set,
-    records: list[dict[str, Any]]
+    records: list[dict[str, Any]],
+    commit: bool =True
 ) -> None:
     """Update `table` in the database using `records`.
 
@@ -90,19 +283,47 @@ def records_update_dbtable(
         conn: An open connection to an sqlite3 database
         table: The name of a table in the database
         cols: The list of columns to be updated
-        records: The incoming data, where each dict represents a row to be updated
+        records: The incoming data, where each dict (or record with a `to_dict`, e.g.
+            `fund.Fund`) represents a row to be updated
+        commit: Commit the update; set to False when called inside a transaction
     """
     cur = conn.cursor()
     db_validate_table(conn, table)
     db_validate_cols(conn, table, cols)
 
-    updates = ''
-    for c in cols:
-        updates += f"{c} = :{c}, "
-    updates = updates.rstrip(', ')
-    for row in records:
-        cur.execute(f"UPDATE {table} SET {updates} WHERE id = :id", row)
-    conn.commit()
+    cur.executemany(sql_update(table, tuple(cols), 'id'), map(record_dict, records))
+    if commit:
+        conn.commit()
+
+def records_upsert_dbtable(
+    conn: sqlite3.Connection,
+    table: str,
+    cols: list | tuple | set,
+    records: list[dict[str, Any]],
+    key: list | tuple,
+    commit: bool =True
+) -> None:
+    """Insert or update rows of `table` using `records`.
+
+    Each row in `records` is inserted into `table`. If a row with the same values in
+    the `key` columns already exists, only the columns of that row listed in `cols` are
+    updated instead. `key` must be covered by a UNIQUE constraint on `table`.
+
+    Args:
+        conn: An open connection to an sqlite3 database
+        table: The name of a table in the database
+        cols: The list of columns to be inserted or updated
+        records: The incoming data, where each dict represents a row
+        key: The columns identifying a row
+        commit: Commit the changes; set to False when called inside a transaction
+    """
+    cur = conn.cursor()
+    db_validate_table(conn, table)
+    db_validate_cols(conn, table, [*key, *cols])
+
+    cur.executemany(sql_upsert(table, tuple(cols), tuple(key)), records)
+    if commit:
+        conn.commit()
 
 def db_get_row(
     conn: sqlite3.Connection,
@@ -123,15 +344,38 @@ def db_get_row(
         A dict representing the fetched row from `table`.
     """
     cur = conn.cursor()
-    cur.row_factory = db_dict_factory
-    fieldstr = ', '.join(cols)
-    res = cur.execute(f"SELECT {fieldstr} FROM {table} WHERE {key} = ?", (val,))
+    cur.row_factory = db_dict_factory()
+    res = cur.execute(sql_select(table, tuple(cols), key), (val,))
     return res.fetchone()
 
+def db_get_rows(
+    conn: sqlite3.Connection,
+    table: str,
+    cols: list | tuple | set,
+    key: str,
+    val: Any,
+) -> list[dict[str, Any]]:
+    """Fetch certain columns of every row from `table` matching an identifier key-value pair.
+
+    Args:
+        conn: An open connection to an sqlite3 database
+        table: The name of a table in the database
+        cols: The list of columns to be fetched from each fetched row
+        key: The column that `val` belongs to
+        val: The value matched to rows in `table`
+    Returns:
+        A list of dicts, each dict representing a fetched row from `table`.
+    """
+    cur = conn.cursor()
+    cur.row_factory = db_dict_factory()
+    res = cur.execute(sql_select(table, tuple(cols), key), (val,))
+    return res.fetchall()
+
 def db_insert(
     conn: sqlite3.Connection,
     table: str,
-    row: dict[str, Any]
+    row: dict[str, Any],
+    commit: bool =True
 ) -> None:
     """Insert `row` into `table`.
 
@@ -142,24 +386,19 @@ def db_insert(
         conn: An open connection to an sqlite3 database
         table: The name of a table in the database
         row: A dict representing a row to be added to `table`
+        commit: Commit the insert; set to False when called inside a transaction
     """
     cur = conn.cursor()
-    keystr = ''
-    valstr = ''
-    for key in row.keys():
-        keystr += f"{key}, "
-        valstr += f":{key}, "
-    keystr = keystr.rstrip(', ')
-    valstr = valstr.rstrip(', ')
-
-    cur.execute(f"INSERT INTO {table} ({keystr}) VALUES ({valstr})", row)
-    conn.commit()
+    cur.execute(sql_insert(table, tuple(row.keys())), row)
+    if commit:
+        conn.commit()
 
 def db_delete(
     conn: sqlite3.Connection,
     table: str,
     key: str,
-    val: Any
+    val: Any,
+    commit: bool =True
 ) -> None:
     """Delete the row from `table` matched by the identifier key-value pair.
 
@@ -168,16 +407,19 @@ def db_delete(
         table: The name of a table in the database
         key: The column that `val` belongs to
         val: The value matched to a row in `table`
+        commit: Commit the delete; set to False when called inside a transaction
     """
     cur = conn.cursor()
-    cur.execute(f"DELETE FROM {table} WHERE {key} = ?", (val, ))
-    conn.commit()
+    cur.execute(sql_delete(table, key), (val, ))
+    if commit:
+        conn.commit()
 
 def db_update(
     conn: sqlite3.Connection,
     table: str,
     row: dict[str, Any],
-    key: str
+    key: str,
+    commit: bool =True
 ) -> None:
     """Update a specific row in `table`.
 
@@ -191,52 +433,191 @@ def db_update(
         table: The name of a table in the database
         row: A dict representing the new columns of a row in `table`
         key: The column used to match `row` to a row in `table`
+        commit: Commit the update; set to False when called inside a transaction
     """
     cur = conn.cursor()
-    updatestr = ''
-    for k in row.keys():
-        updatestr += f"{k} = :{k}, "
-    updatestr = updatestr.rstrip(', ')
-    cur.execute(f"UPDATE {table} SET {updatestr} WHERE {key} = :{key}", row)
-    conn.commit()
+    cur.execute(sql_update(table, tuple(row.keys()), key), row)
+    if commit:
+        conn.commit()
 
 def xlsx_to_records(
     infile: str,
     usecols: list | tuple | set | None =None,
-    sheet: int | str  =0
+    sheet: int | str  =0,
+    optcols: list | tuple | set =()
 ) -> list[dict[str, Any]]:
     """Convert the contents of a .xlsx file to records (list of dicts).
 
     To include all columns, set `usecols` to `None` or do not specify `usecols`.
     Not specifiying `sheet` will default to parse first sheet.
 
+    Columns in `optcols` are included if `infile` has them, and are set to None in every
+    record otherwise.
+
     Args:
         infile: The name of the .xlsx file to be parsed
         usecols: The list of columns to be included in the output `records`
         sheet: The name or index of the sheet to parse
+        optcols: The list of optional columns to be included in the output `records`
     Returns:
         records: A list of dicts, each dict representing a row of `infile`
+    Raises:
+        ValueError: If `infile` is missing any column in `usecols`
     """
-    df = pd.read_excel(infile, usecols=usecols, sheet_name=sheet)
-    df.replace(np.nan, None, inplace=True)
+    if optcols and usecols is not None:
+        df = pd.read_excel(infile, usecols=lambda col: col in usecols or col in optcols, sheet_name=sheet)
+        missing = [col for col in usecols if col not in df.columns]
+        if missing:
+            raise ValueError(f"Missing columns: {missing}")
+        df = df.reindex(columns=[*usecols, *optcols])
+    else:
+        df = pd.read_excel(infile, usecols=usecols, sheet_name=sheet)
+    df = df.astype(object).where(df.notna(), None)
     return df.to_dict(orient='records')
 
+def xlsx_iter_records(
+    infile: str,
+    usecols: list | tuple | set | None =None,
+    sheet: int | str =0,
+    optcols: list | tuple | set =()
+) -> Iterator[dict[str, Any]]:
+    """Stream the rows of a .xlsx file as records (dicts), one row at a time.
+
+    A lighter alternative to `xlsx_to_records` for large files: the workbook is opened in
+    openpyxl's read-only mode and rows are read as they are consumed, so the whole sheet
+    is never held in memory. The header row is read and validated when this function is
+    called; the other rows are read lazily. Empty cells are None, and empty rows are
+    skipped. Close the returned iterator if it is not read to the end.
+
+    To include all columns, set `usecols` to `None` or do not specify `usecols`. Columns
+    in `optcols` are included if `infile` has them, and are set to None otherwise.
+
+    Args:
+        infile: The name of the .xlsx file to be parsed
+        usecols: The list of columns to be included in the output records
+        sheet: The name or index of the sheet to parse
+        optcols: The list of optional columns to be included in the output records
+    Returns:
+        An iterator of dicts, each dict representing a row of `infile`
+    Raises:
+        ValueError: If `infile` is missing any column in `usecols`
+    """
+    wb = openpyxl.load_workbook(infile, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[sheet] if isinstance(sheet, int) else wb[sheet]
+        ws.reset_dimensions()
+        rows = ws.iter_rows(values_only=True)
+        header = next(rows, ())
+        index = {}
+        for i, col in enumerate(header):
+            if col is not None and col not in index:
+                index[col] = i
+        if usecols is None:
+            cols = list(index)
+        else:
+            missing = [col for col in usecols if col not in index]
+            if missing:
+                raise ValueError(f"Missing columns: {missing}")
+            cols = [*usecols, *optcols]
+    except Exception:
+        wb.close()
+        raise
+
+    def records() -> Iterator[dict[str, Any]]:
+        try:
+            yield None
+            for row in rows:
+                if all(value is None for value in row):
+                    continue
+                yield {col: row[index[col]] if col in index and index[col] < len(row) else None for col in cols}
+        finally:
+            wb.close()
+
+    # Start the generator, so that closing it closes the workbook even if no row was read
+    it = records()
+    next(it)
+    return it
+
+def xlsx_safe(
+    value: Any
+) -> Any:
+    """Return `value` with the control characters that .xlsx files cannot hold removed.
+
+    Scraped page text may contain such characters, on which openpyxl raises
+    `IllegalCharacterError`. Values other than strings are returned unchanged.
+    """
+    if isinstance(value, str):
+        return ILLEGAL_CHARACTERS_RE.sub('', value)
+    return value
+
 def records_to_xlsx(
     records: list[dict[str, Any]],
     out: Any,
     usecols: list | tuple | set | None =None,
     sheet_name: str ='Sheet 1'
 ) -> None:
-    """Write records (list of dicts) to an .xlsx file.
+    """Write records (list of dicts) to an .xlsx file, removing characters .xlsx cannot hold (see `xlsx_safe`).
 
     Args:
-        records: A list of dicts, each dict representing a row in a table
+        records: A list of dicts (or records with a `to_dict`, e.g. `fund.Fund`), each
+            representing a row in a table
         out: File path (.xlsx) or existing ExcelWriter to write to
         usecols: The list of columns to be included in `outfile`
         sheet_name: The name of the sheet to write to
     """
-    df = pd.DataFrame.from_records(records)
-    df.to_excel(out, columns=usecols, sheet_name=sheet_name, index=False)
+    records = [{key: xlsx_safe(value) for key, value in record_dict(rec).items()} for rec in records]
+    df = pd.DataFrame.from_records(records, columns=usecols)
+    df.to_excel(out, sheet_name=sheet_name, index=False)
+
+def rows_to_xlsx(
+    rows: Iterable[Sequence[Any]],
+    header: Sequence[str],
+    out: str | openpyxl.Workbook,
+    sheet_name: str ='Sheet 1'
+) -> None:
+    """Stream rows (sequences of values) into a sheet of an .xlsx file.
+
+    Rows are written to an openpyxl write-only workbook as they are read from `rows`, so
+    memory use does not grow with the number of rows. Characters .xlsx cannot hold are
+    removed from string values, see `xlsx_safe`.
+
+    Args:
+        rows: The rows to write, in order, e.g. an sqlite3 cursor
+        header: The column names, written as the first row
+        out: File path (.xlsx), or a write-only `openpyxl.Workbook` to add the sheet to;
+            the caller saves the workbook
+        sheet_name: The name of the sheet to write to
+    """
+    wb = openpyxl.Workbook(write_only=True) if isinstance(out, str) else out
+    ws = wb.create_sheet(sheet_name)
+    ws.append(list(header))
+    for row in rows:
+        ws.append([xlsx_safe(value) for value in row])
+    if isinstance(out, str):
+        wb.save(out)
+
+def dbtable_to_xlsx(
+    conn: sqlite3.Connection,
+    table: str,
+    out: str | openpyxl.Workbook,
+    sheet_name: str ='Sheet 1'
+) -> None:
+    """Write a database table to a sheet of an .xlsx file, streaming rows from the cursor.
+
+    A faster, constant-memory alternative to `records_to_xlsx(dbtable_to_records(...))`
+    for large tables: no records or DataFrame are built.
+
+    Args:
+        conn: An open connection to an sqlite3 database
+        table: The name of a table in the database
+        out: File path (.xlsx), or a write-only `openpyxl.Workbook` to add the sheet to
+        sheet_name: The name of the sheet to write to
+    """
+    db_validate_table(conn, table)
+    cur = conn.cursor()
+    cur.row_factory = None
+    cur.execute(f"SELECT * FROM {table}")
+    rows_to_xlsx(cur, [col[0] for col in cur.description], out, sheet_name)
 
 def prune_records(
     records: list[dict[str, Any]],
@@ -285,6 +666,18 @@ def csv_clear_field(infile, outfile, usecols, field):
         item[field] = None
     records_to_csv(records, outfile, usecols=usecols)
 
+def remove_files(
+    paths: Iterable[str]
+) -> None:
+    """Remove each file in `paths` that exists.
+
+    Args:
+        paths: The paths of the files to remove
+    """
+    for path in paths:
+        if os.path.isfile(path):
+            os.remove(path)
+
 def clean_dir(
     path: str
 ) -> None:
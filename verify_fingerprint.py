@@ -0,0 +1,80 @@
+import os
+import sqlite3
+import sys
+import time
+from fingerprint import fast_checksum, soup_checksum
+from webscraper import fetch_page, iter_page_text
+from database import db_connect
+from constants import *
+
+def save_pages(
+    conn: sqlite3.Connection,
+    path: str
+) -> None:
+    """Download the current page of every url in `FUNDS_TABLE` into `path`.
+
+    Args:
+        conn: An open connection to an sqlite3 database
+        path: The directory to save pages to
+    """
+    os.makedirs(path, exist_ok=True)
+    cur = conn.cursor()
+    n = 0
+    for fund_id, urls in cur.execute(f"SELECT id, url FROM {FUNDS_TABLE}").fetchall():
+        for i, url in enumerate(urls.split(DELIM)):
+            with fetch_page(url) as response:
+                if response is None or response.status_code == 304:
+                    continue
+                try:
+                    html = ''.join(iter_page_text(response))
+                except Exception as e:
+                    print(f"Unable to read {url}: {e}")
+                    continue
+            with open(f"{path}/fund{fund_id}_url{i+1}.html", 'w', encoding='utf-8') as f:
+                f.write(html)
+            n += 1
+    print(f"Saved {n} pages to {path}")
+
+def verify_pages(
+    path: str
+) -> bool:
+    """Compare the fast and BeautifulSoup checksums of every saved page in `path`.
+
+    Args:
+        path: The directory containing saved pages (.html)
+    Returns:
+        True if every page produced the same checksum with both fingerprinters
+    """
+    files = sorted(f for f in os.listdir(path) if f.endswith('.html'))
+    mismatches = []
+    soup_time = 0.0
+    fast_time = 0.0
+    for fname in files:
+        with open(f"{path}/{fname}", encoding='utf-8', errors='replace') as f:
+            html = f.read()
+
+        start = time.perf_counter()
+        expected = soup_checksum(html)
+        soup_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        actual = fast_checksum(html)
+        fast_time += time.perf_counter() - start
+
+        if actual != expected:
+            mismatches.append(fname)
+            print(f"MISMATCH: {fname}: BeautifulSoup {expected}, fast {actual}")
+
+    print(f"Pages: {len(files)}, mismatches: {len(mismatches)}")
+    print(f"BeautifulSoup: {soup_time:.3f}s, fast: {fast_time:.3f}s")
+    return not mismatches
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python verify_fingerprint.py PAGES_DIR [--save]')
+        sys.exit(2)
+    if '--save' in sys.argv[2:]:
+        conn = db_connect(DATABASE)
+        save_pages(conn, sys.argv[1])
+        conn.close()
+    sys.exit(0 if verify_pages(sys.argv[1]) else 1)
@@ -1,14 +1,31 @@
 from bs4 import BeautifulSoup
 import requests
 import sqlite3
-import pandas as pd
-import hashlib
+import openpyxl
 import os
-import shutil
+import re
+import threading
 import time
+import uuid
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager, nullcontext
+from functools import partial
+from io import StringIO
 from requests.exceptions import HTTPError, Timeout
 import utilities as util
-from typing import Any
+from host_scheduler import HostScheduler, interleave_by_host, parse_retry_after
+from session_pool import SessionPool
+from parse_pool import ParsePool, decode_chunks
+from shard import clear_shard_dir, fund_from_record, launch_shard_worker, read_shard_result, remove_file, shard_path, split_shards, write_shard_input
+from setup import migrate_db
+from database import db_backup, db_connect, db_restore
+from fingerprint import SelectorNoMatchError, diff_blocks, page_blocks, page_checksum, validate_selector
+from check_scheduler import schedule_page, select_due_funds
+from run_metrics import RunMetrics, new_url_stats
+from fund import Fund
+from snapshot_store import prune_snapshots, save_snapshots, snapshot_records
+from typing import Any, Iterator
 from io import TextIOWrapper
 from constants import *
 
@@ -22,24 +39,33 @@ from constants import *
 # - regex ADDU user emails, fund URLs
 # - NOTE: scraper does not detect page changes if only text generated by js was changed.
 
+class PageTooLargeError(Exception):
+    """Exception to be raised when a page body is larger than the configured maximum size."""
+    pass
+
 def queue_inputs(
     log: TextIOWrapper
-) -> list[dict[str, Any]]:
-    """Convert input files (xlsx) located in `INFILE_DIR` to records (list of dicts)
+) -> Iterator[dict[str, Any]]:
+    """Stream the commands of the input files (xlsx) located in `INFILE_DIR` as records (dicts)
 
     Each row of an input file contains the columns: 'command', 'name', 'url', 'status' at minimum.
+    Optional columns (`INPUT_OPTIONAL_COLS`) are set to None when a file does not have them.
     Errors are printed to the audit log, `log`.
 
+    The header of every file is validated up front, but rows are only read as the returned
+    iterator is consumed (see `utilities.xlsx_iter_records`), so a large input file is
+    never held in memory at once.
+
     Args:
         log: The open audit log file to write to
     Returns:
-        A list of dicts, with each dict representing an input command
+        An iterator of dicts, with each dict representing an input command
     """
     if not os.path.isdir(INFILE_DIR):
         log.write('INPUT FILE ERROR: Unable to locate input directory\n\n')
         print(f"Input directory not found. Unable to locate inputs.")
 
-    inputs = []
+    files = []
     i = 1
     while True:
         infile = f"{INFILE_DIR}/{INFILE_TEMPLATE.replace('X', str(i))}"
@@ -48,7 +74,7 @@ def queue_inputs(
             print(f"Input files: {i - 1}")
             break
         try:
-            inputs.extend(util.xlsx_to_records(infile, usecols=INPUT_COLS))
+            files.append(util.xlsx_iter_records(infile, usecols=INPUT_COLS, optcols=INPUT_OPTIONAL_COLS))
         except ValueError as e:
             log.write('INPUT FILE ERROR: Incomplete set of column headers, requires: (command, name, url, status)\n\n')
             print(f"webscraper.py: queue_inputs(): Invalid column headers")
@@ -57,7 +83,27 @@ def queue_inputs(
             print(f"webscraper.py: queue_inputs(): Exception: {e}")
             break
         i += 1
-    return inputs
+    return _stream_inputs(log, files)
+
+def _stream_inputs(
+    log: TextIOWrapper,
+    files: list[Iterator[dict[str, Any]]]
+) -> Iterator[dict[str, Any]]:
+    """Yield the rows of each input file in turn, stopping at a file that cannot be read.
+
+    Args:
+        log: The open audit log file to write to
+        files: The row iterators of the input files, in order
+    """
+    for rows in files:
+        try:
+            yield from rows
+        except Exception as e:
+            log.write('INPUT FILE ERROR: Unable to parse file\n\n')
+            print(f"webscraper.py: queue_inputs(): Exception: {e}")
+            break
+    for rows in files:
+        rows.close()
 
 def exec_cmd(
     conn: sqlite3.Connection,
@@ -71,6 +117,11 @@ def exec_cmd(
     If command is a table request ('REQ'), append requested table name to `table_reqs`, if
     valid.
 
+    Database changes are made in a savepoint and left uncommitted, so that the caller can
+    commit a whole queue of commands at once. A command that fails is rolled back alone.
+    `MOD` fetches the fund's pages before its savepoint, after committing the commands
+    queued before it, so that no write lock is held during the requests.
+
     Args:
         conn: An open connection to an sqlite3 database
         log: The open audit log file to write to
@@ -94,135 +145,622 @@ def exec_cmd(
     ):
         log.write(f"INPUT ERROR: {cmd} {item['name']}: Invalid status: \"{item['status']}\"\n\n")
         return
+    if cmd in ('ADD', 'MOD') and item.get('ignore_blocks') not in (None, CLEAR_FIELD):
+        item['ignore_blocks'] = str(item['ignore_blocks'])
+        try:
+            for pattern in ignore_patterns(item['ignore_blocks']):
+                re.compile(pattern)
+        except re.error as e:
+            log.write(f"INPUT ERROR: {cmd} {item['name']}: Invalid ignore_blocks pattern: {e}\n\n")
+            return
+    if cmd in ('ADD', 'MOD') and item.get('selector') not in (None, CLEAR_FIELD):
+        item['selector'] = str(item['selector'])
+        try:
+            validate_selector(item['selector'])
+        except Exception as e:
+            log.write(f"INPUT ERROR: {cmd} {item['name']}: Invalid selector: {str(e).splitlines()[0]}\n\n")
+            return
     
-    try:
-        if cmd == 'ADD':
-            util.db_insert(conn, FUNDS_TABLE, item)
-            log.write(f"ADD: {item['name']}\n\n")
+    # BACKUP and RESTORE act on the database file, so commit the commands queued before them
+    if cmd in ('BACKUP', 'RESTORE') and conn.in_transaction:
+        conn.commit()
 
-        elif cmd == 'MOD':
+    try:
+        if cmd == 'MOD':
             # Precheck to catch page changes since last check
             item_old = util.db_get_row(conn, FUNDS_TABLE, DB_FUNDS_COLS, key='name', val=item['name'])
             if not item_old:
                 log.write(f"INPUT ERROR: {item['name']} does not exist for command MOD\n\n")
                 return
+            # The precheck fetches the fund's pages, so commit the commands queued before it
+            # rather than hold the database's write lock during the requests
+            if conn.in_transaction:
+                conn.commit()
+            item_old = Fund(**item_old)
+            attach_fund_pages([item_old], util.db_get_rows(conn, FUND_URLS_TABLE, ('*',), key='fund_id', val=item_old['id']))
             funds_to_check = []
             check_fund(None, item_old, funds_to_check, [])
             if funds_to_check:
                 log.write(f"WARNING: Potential change to fund \"{item['name']}\" before MOD command\n")
 
-            # Execute MOD
-            # Remove url field if not set
-            if not item['url']:
-                item.pop('url')
-
-            # Reset checksum, urls_to_check, and access_failures fields
-            item['checksum'] = None
-            item['urls_to_check'] = None
-            item['access_failures'] = 0
-            util.db_update(conn, FUNDS_TABLE, item, key='name')
-            log.write(f"MOD: {item['name']}, {item['url']}, {item['status']}\n\n")
-
-        elif cmd == 'DEL':
-            util.db_delete(conn, FUNDS_TABLE, key='name', val=item['name'])
-            log.write(f"DEL: {item['name']}\n\n")
+        # Run each command in its own savepoint, so a failed command is rolled back alone
+        with util.db_savepoint(conn, 'exec_cmd') if cmd not in ('BACKUP', 'RESTORE') else nullcontext():
+            if cmd == 'ADD':
+                for col in INPUT_OPTIONAL_COLS:
+                    if item.get(col) == CLEAR_FIELD:
+                        item[col] = None
+                util.db_insert(conn, FUNDS_TABLE, item, commit=False)
+                log.write(f"ADD: {item['name']}\n\n")
+
+            elif cmd == 'MOD':
+                # Remove url field if not set
+                if not item['url']:
+                    item.pop('url')
+
+                # Keep optional fields that are not set, and clear those set to `CLEAR_FIELD`
+                for col in INPUT_OPTIONAL_COLS:
+                    if item.get(col) is None:
+                        item.pop(col, None)
+                    elif item[col] == CLEAR_FIELD:
+                        item[col] = None
+
+                # Reset access_failures field and page history (checksums, validators, urls to check)
+                item['access_failures'] = 0
+                util.db_update(conn, FUNDS_TABLE, item, key='name', commit=False)
+                util.db_delete(conn, FUND_URLS_TABLE, key='fund_id', val=item_old['id'], commit=False)
+                util.db_delete(conn, CHECK_JOURNAL_TABLE, key='fund_id', val=item_old['id'], commit=False)
+                log.write(f"MOD: {item['name']}, {item.get('url')}, {item['status']}\n\n")
+
+            elif cmd == 'DEL':
+                util.db_delete(conn, FUNDS_TABLE, key='name', val=item['name'], commit=False)
+                log.write(f"DEL: {item['name']}\n\n")
         
-        elif cmd == 'REQ':
-            table_name = item['name'].lower()
-            util.db_validate_table(conn, table_name)
-            table_reqs.add(table_name)
-            log.write(f"REQ: Table \"{table_name}\"\n\n")
+            elif cmd == 'REQ':
+                table_name = item['name'].lower()
+                util.db_validate_table(conn, table_name)
+                table_reqs.add(table_name)
+                log.write(f"REQ: Table \"{table_name}\"\n\n")
         
-        elif cmd == 'REQB':
-            conn_backup = sqlite3.connect(DATABASE_BACKUP)
+            elif cmd == 'REQB':
+                if not os.path.isfile(DATABASE_BACKUP):
+                    raise util.InvalidInputError('No database backup exists')
+                conn_backup = db_connect(DATABASE_BACKUP, readonly=True)
 
-            table_name = item['name'].lower()
-            util.db_validate_table(conn_backup, table_name)
-            table_reqs.add(f"backup{DELIM}{table_name}")
-            log.write(f"REQB: Table \"{table_name}\"\n\n")
+                table_name = item['name'].lower()
+                util.db_validate_table(conn_backup, table_name)
+                table_reqs.add(f"backup{DELIM}{table_name}")
+                log.write(f"REQB: Table \"{table_name}\"\n\n")
 
-            conn_backup.close()
+                conn_backup.close()
         
-        elif cmd == 'ADDU':
-            util.db_insert(conn, USERS_TABLE, {'email': item['name'], 'admin': item['status']})
-            log.write(f"ADDU: {item['name']}, admin: {item['status']}\n\n")
-
-        elif cmd == 'DELU':
-            util.db_delete(conn, USERS_TABLE, key='email', val=item['name'])
-            log.write(f"DELU: {item['name']}\n\n")
-
-        elif cmd == 'BACKUP':
-            conn_backup = sqlite3.connect(DATABASE_BACKUP)
-            conn.backup(conn_backup)
-            log.write(f"BACKUP: Saved backup of database\n\n")
-            conn_backup.close()
+            elif cmd == 'ADDU':
+                util.db_insert(conn, USERS_TABLE, {'email': item['name'], 'admin': item['status']}, commit=False)
+                log.write(f"ADDU: {item['name']}, admin: {item['status']}\n\n")
+
+            elif cmd == 'DELU':
+                util.db_delete(conn, USERS_TABLE, key='email', val=item['name'], commit=False)
+                log.write(f"DELU: {item['name']}\n\n")
+
+            elif cmd == 'BACKUP':
+                db_backup(conn, DATABASE_BACKUP)
+                log.write(f"BACKUP: Saved backup of database\n\n")
             
-        else:   # cmd == 'RESTORE'
-            shutil.copyfile(src=DATABASE_BACKUP, dst=DATABASE)
-            table_reqs.add(FUNDS_TABLE)
-            table_reqs.add(USERS_TABLE)
-            log.write(f"RESTORE: Restored database from backup. Added database tables to output\n\n")
+            else:   # cmd == 'RESTORE'
+                db_restore(conn, DATABASE_BACKUP)
+                migrate_db(conn)
+                clear_check_journal(conn)
+                table_reqs.add(FUNDS_TABLE)
+                table_reqs.add(USERS_TABLE)
+                log.write(f"RESTORE: Restored database from backup. Added database tables to output\n\n")
 
     except sqlite3.Error as e:
-        conn.rollback()
         log.write(f"DATABASE ERROR: {cmd} {item['name']}: {e}\n\n")
     except util.InvalidInputError as e:
         log.write(f"INPUT ERROR: {cmd} {item['name']}: {e}\n\n")
     except Exception as e:
         log.write(f"ERROR: {cmd}: {e}")
 
+@contextmanager
+def fetch_page(
+    url: str,
+    retries= 3,
+    backoff= 2,
+    scheduler: HostScheduler | None =None,
+    pool: SessionPool | None =None,
+    headers: dict[str, str] | None =None,
+    max_bytes: int =MAX_PAGE_BYTES,
+    stats: dict[str, Any] | None =None
+) -> Iterator[requests.Response | None]:
+    """Request the html page at `url` and provide the response, if possible.
+
+    Used as a context manager. The response is streamed: only the headers have been read
+    when it is provided, and the body should be read with `iter_page_text` inside the
+    `with` block. The response is closed when the block exits. Responses that are not
+    html, or that declare a `Content-Length` over `max_bytes`, are rejected without
+    retrying.
+
+    If the server responds with a `Retry-After` header, wait the requested time instead
+    of the backoff time before retrying. With a `scheduler`, requests are subject to its
+    per-host limits and the wait applies to every request to the same host. The host slot
+    is held until the response is closed, so the limit covers reading the body too. With
+    a `pool`, the request is sent over a pooled keep-alive session.
+
+    A 304 (Not Modified) response to a conditional request is provided as is.
+
+    Args:
+        url: The url to scrape
+        retries: The number of retry attempts, if html request fails
+        backoff: The backoff factor, used to calculate wait time between retries
+        scheduler: The per-host scheduler to request through, or None to request directly
+        pool: The session pool to draw a session from, or None to use a one-off connection
+        headers: Extra request headers, e.g. `If-None-Match` / `If-Modified-Since`
+        max_bytes: The largest page size, in bytes, to accept
+        stats: If given, the number of `retries` and the last HTTP `status` are recorded in it
+    Yields:
+        The unread response from `url`, or None on failure
+    """
+    headers = headers or {}
+    stats = {} if stats is None else stats
+    with ExitStack() as stack:
+        response = None
+        for attempt in range(retries):
+            stats['retries'] = attempt
+            # Holds the host slot and then the response, and releases both in reverse order
+            held = stack.enter_context(ExitStack())
+            try:
+                if scheduler:
+                    held.enter_context(scheduler.slot(url))
+                if pool:
+                    with pool.session() as session:
+                        response = session.get(url, headers=headers, timeout=(3.1, 15.1), stream=True)
+                else:
+                    response = requests.get(url, headers={**HTTP_GET_HEADERS, **headers}, timeout=(3.1, 15.1), stream=True)
+                held.callback(response.close)
+                stats['status'] = response.status_code
+                if response.status_code == 304:
+                    held.close()
+                    break
+                response.raise_for_status()
+
+                # Reject pages from the response headers alone, before any of the body is read
+                content_type = response.headers.get('content-type', '')
+                if 'text/html' not in content_type:
+                    held.close()
+                    response = None
+                    print(f"Not an html page (content-type: \"{content_type}\"). Skipping \"{url}\"...")
+                    break
+                content_length = response.headers.get('content-length', '')
+                if content_length.isdigit() and int(content_length) > max_bytes:
+                    held.close()
+                    response = None
+                    print(f"Page too large ({content_length} bytes). Skipping \"{url}\"...")
+                    break
+
+                break
+
+            except Timeout as e:
+                held.close()
+                response = None
+                wait_time = backoff ** attempt
+                print(f'TimeoutError: {e}. Retrying in {wait_time} seconds...')
+                time.sleep(wait_time)
+
+            except HTTPError as e:
+                held.close()
+                response = None
+                if e.response.status_code == 412:
+                    print(f"Error 412. Skipping \"{url}\"...")
+                    break
+                wait_time = parse_retry_after(e.response)
+                if wait_time is None:
+                    wait_time = backoff ** attempt
+                elif wait_time > RETRY_AFTER_MAX:
+                    print(f"HTTP error: {e}. Retry-After of {wait_time} seconds too long. Skipping \"{url}\"...")
+                    break
+                print(f"HTTP error: {e}. Retrying in {wait_time} seconds...")
+                if scheduler:
+                    scheduler.defer(url, wait_time)
+                else:
+                    time.sleep(wait_time)
+
+            except Exception as e:
+                held.close()
+                response = None
+                print(f"Failed to reach URL: {url}. Error: {e}. Skipping...")
+                break
+        yield response
+
+def iter_page_bytes(
+    response: requests.Response,
+    max_bytes: int =MAX_PAGE_BYTES,
+    stats: dict[str, Any] | None =None
+) -> Iterator[bytes]:
+    """Read the body of a streamed `response` as raw bytes, one chunk at a time.
+
+    Args:
+        response: A streamed response, as returned by `fetch_page`
+        max_bytes: The largest page size, in bytes, to read
+        stats: If given, the `bytes` read and the seconds spent reading them (`read`) are
+            added to it
+    Yields:
+        Chunks of the page body
+    Raises:
+        PageTooLargeError: The page body is larger than `max_bytes`
+    """
+    stats = {} if stats is None else stats
+    size = 0
+    chunks = response.iter_content(PAGE_CHUNK_SIZE)
+    while True:
+        start = time.perf_counter()
+        chunk = next(chunks, None)
+        stats['read'] = stats.get('read', 0.0) + time.perf_counter() - start
+        if chunk is None:
+            break
+        size += len(chunk)
+        stats['bytes'] = size
+        if size > max_bytes:
+            response.close()
+            raise PageTooLargeError(f"Page larger than {max_bytes} bytes")
+        yield chunk
+
+def iter_page_text(
+    response: requests.Response,
+    max_bytes: int =MAX_PAGE_BYTES,
+    stats: dict[str, Any] | None =None
+) -> Iterator[str]:
+    """Read the body of a streamed `response` as decoded text, one chunk at a time.
+
+    Decodes the same way `response.text` would when the response declares an encoding,
+    see `parse_pool.decode_chunks`.
+
+    Args:
+        response: A streamed response, as returned by `fetch_page`
+        max_bytes: The largest page size, in bytes, to read
+        stats: If given, the `bytes` read and the seconds spent reading them (`read`) are
+            added to it
+    Yields:
+        Chunks of the decoded page text
+    Raises:
+        PageTooLargeError: The page body is larger than `max_bytes`
+    """
+    return decode_chunks(iter_page_bytes(response, max_bytes, stats), response.encoding)
+
 def get_soup(
     url: str,
     retries= 3,
-    backoff= 2
+    backoff= 2,
+    scheduler: HostScheduler | None =None,
+    pool: SessionPool | None =None,
+    metrics: RunMetrics | None =None
 ) -> BeautifulSoup | None:
     """Scrape html from `url` and return BeautifulSoup object, if possible.
 
+    See `fetch_page` for retry behaviour.
+
     Args:
         url: The url to scrape
         retries: The number of retry attempts, if html request fails
         backoff: The backoff factor, used to calculate wait time between retries
+        scheduler: The per-host scheduler to request through, or None to request directly
+        pool: The session pool to draw a session from, or None to use a one-off connection
+        metrics: The run metrics to record the url's fetch, read and parse times in
     Returns:
         A BeautifulSoup object of the html from `url`, or None on failure
     """
-    for attempt in range(retries):
+    stats = new_url_stats()
+    start = time.perf_counter()
+    html = None
+    with fetch_page(url, retries, backoff, scheduler, pool, stats=stats) as response:
+        stats['fetch'] = time.perf_counter() - start
+        if response is not None:
+            try:
+                html = ''.join(iter_page_text(response, stats=stats))
+            except Exception as e:
+                print(f"Failed to read URL: {url}. Error: {e}. Skipping...")
+    soup = None
+    if html is not None:
+        start = time.perf_counter()
         try:
-            response = requests.get(url, headers=HTTP_GET_HEADERS, timeout=(3.1, 15.1))
-            if 'text/html' not in response.headers['content-type']:
-                raise TypeError
-            response.raise_for_status()
-            soup = BeautifulSoup(response.text, 'html.parser')
-
-            return soup
-        
-        except Timeout as e:
-            wait_time = backoff ** attempt
-            print(f'TimeoutError: {e}. Retrying in {wait_time} seconds...')
-            time.sleep(wait_time)
-
-        except TypeError as e:
-            wait_time = backoff ** attempt
-            print(f'TypeError: {e}. Retrying in {wait_time} seconds...')
-            time.sleep(wait_time)
-
-        except HTTPError as e:
-            if e.response.status_code == 412:
-                print(f"Error 412. Skipping \"{url}\"...")
-                return None
-            wait_time = backoff ** attempt
-            print(f"HTTP error: {e}. Retrying in {wait_time} seconds...")
-            time.sleep(wait_time)
-            
+            soup = BeautifulSoup(html, 'html.parser')
         except Exception as e:
-            print(f"Failed to reach URL: {url}. Error: {e}. Skipping...")
-            return None
-    return None
+            print(f"Failed to parse URL: {url}. Error: {e}. Skipping...")
+        stats['parse'] = time.perf_counter() - start
+    stats['result'] = 'ok' if soup is not None else 'failed'
+    if metrics:
+        metrics.record_url(url, stats)
+    return soup
+
+def conditional_headers(
+    etag: str | None,
+    last_modified: str | None
+) -> dict[str, str]:
+    """Build conditional GET request headers from a page's stored validators.
+
+    Args:
+        etag: The `ETag` the page was last fetched with, or None
+        last_modified: The `Last-Modified` date the page was last fetched with, or None
+    Returns:
+        A dict of `If-None-Match` / `If-Modified-Since` headers
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+def response_validators(
+    response: requests.Response
+) -> tuple[str, str]:
+    """Return the `ETag` and `Last-Modified` validators of `response`.
+
+    Args:
+        response: The response to read the validators from
+    Returns:
+        A tuple of (etag, last_modified), with None for a missing validator
+    """
+    return response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+def new_fund_page(
+    fund_id: int,
+    url: str
+) -> dict[str, Any]:
+    """Return a `FUND_URLS_TABLE` row for a url that has not been checked yet.
+
+    Args:
+        fund_id: The id of the fund the url belongs to
+        url: The url of the page
+    Returns:
+        A dict representing a new row in `FUND_URLS_TABLE`
+    """
+    return {
+        'id': None,
+        'fund_id': fund_id,
+        'position': 0,
+        'url': url,
+        'checksum': None,
+        'etag': None,
+        'last_modified': None,
+        'last_checked': None,
+        'failures': 0,
+        'needs_check': False,
+        'checks': 0,
+        'changes': 0,
+        'last_changed': None,
+        'check_interval': CHECK_INTERVAL_MIN,
+        'next_check': None,
+        'block_hashes': None,
+        'content_checksum': None,
+        'changed_blocks': None
+    }
+
+def attach_fund_pages(
+    funds: list[Fund],
+    pages: list[dict[str, Any]]
+) -> None:
+    """Attach rows of `FUND_URLS_TABLE` to the funds they belong to.
+
+    Each fund gets a `pages` dict mapping each of its urls to its row, an
+    `urls_to_check` field listing its urls that need a manual check, and a
+    `changed_blocks` field describing the changes found on those urls.
+
+    Args:
+        funds: A list of funds, each representing a row in `FUNDS_TABLE`
+        pages: A list of dicts, each dict representing a row in `FUND_URLS_TABLE`
+    """
+    pages_by_fund = {}
+    for page in pages:
+        pages_by_fund.setdefault(page['fund_id'], {})[page['url']] = page
+    for fund in funds:
+        fund['pages'] = pages_by_fund.get(fund['id'], {})
+        urls_to_check = [url for url, page in fund['pages'].items() if page['needs_check']]
+        fund['urls_to_check'] = DELIM.join(urls_to_check) if urls_to_check else None
+        fund['changed_blocks'] = fund_changed_blocks(fund)
+
+def save_fund_pages(
+    conn: sqlite3.Connection,
+    funds: list[Fund],
+    commit: bool =True
+) -> None:
+    """Write the page state of each fund in `funds` to `FUND_URLS_TABLE`.
+
+    Rows for urls that are no longer in a fund's `url` field are deleted.
+
+    Args:
+        conn: An open connection to an sqlite3 database
+        funds: A list of funds with pages attached, see `attach_fund_pages`
+        commit: Commit the changes; set to False when called inside a transaction
+    """
+    rows = []
+    stale = []
+    for fund in funds:
+        urls = set(fund.urls)
+        for url, page in fund['pages'].items():
+            if url in urls:
+                rows.append(page)
+            elif page['id'] is not None:
+                stale.append((page['id'],))
+    if stale:
+        conn.cursor().executemany(f"DELETE FROM {FUND_URLS_TABLE} WHERE id = ?", stale)
+    util.records_upsert_dbtable(conn, FUND_URLS_TABLE, FUND_URLS_COLS, rows, key=('fund_id', 'url'), commit=commit)
+
+def checkpoint_funds(
+    conn: sqlite3.Connection,
+    log: TextIOWrapper,
+    funds: list[Fund],
+    funds_to_update: list[Fund]
+) -> None:
+    """Save the results of checking `funds` and record them as done in `CHECK_JOURNAL_TABLE`.
+
+    The page state of every fund, the new page versions found (see
+    `snapshot_store.save_snapshots`), the updated fields of `funds_to_update`, and the
+    journal entries are written in a single transaction, so a fund is only recorded as
+    done once its results are saved.
+
+    Args:
+        conn: An open connection to an sqlite3 database
+        log: The open audit log file to write to
+        funds: The funds that have been checked
+        funds_to_update: The funds in `funds` that need to be updated
+    """
+    checked_at = datetime.now().isoformat(timespec='seconds')
+    try:
+        with util.db_transaction(conn):
+            save_fund_pages(conn, funds, commit=False)
+            save_snapshots(conn, funds, checked_at)
+            if funds_to_update:
+                util.records_update_dbtable(conn, FUNDS_TABLE, ['status', 'access_failures'], funds_to_update, commit=False)
+            conn.cursor().executemany(
+                f"INSERT OR REPLACE INTO {CHECK_JOURNAL_TABLE} (fund_id, checked_at) VALUES (?, ?)",
+                [(fund['id'], checked_at) for fund in funds]
+            )
+    except sqlite3.Error as e:
+        log.write(f"DATABASE ERROR: Unable to save results for {len(funds)} funds: {e}\n\n")
+
+def journal_cutoff(
+    max_hours: float =CHECK_JOURNAL_MAX_HOURS
+) -> str:
+    """Return the earliest `checked_at` time of a journal entry that an interrupted run can resume from."""
+    return (datetime.now() - timedelta(hours=max_hours)).isoformat(timespec='seconds')
+
+def journal_fund_ids(
+    conn: sqlite3.Connection,
+    since: str | None =None
+) -> set[int]:
+    """Return the ids of the funds already checked by an unfinished run.
+
+    Entries older than `since` belong to a run that was interrupted too long ago to
+    resume, and are left out, so those funds are checked again.
+
+    Args:
+        conn: An open connection to an sqlite3 database
+        since: The earliest `checked_at` time to include; defaults to `journal_cutoff()`
+    Returns:
+        The set of fund ids in `CHECK_JOURNAL_TABLE` checked at or after `since`
+    """
+    res = conn.cursor().execute(
+        f"SELECT fund_id FROM {CHECK_JOURNAL_TABLE} WHERE checked_at >= ?",
+        (since or journal_cutoff(),)
+    )
+    return {row[0] for row in res.fetchall()}
+
+def clear_check_journal(
+    conn: sqlite3.Connection,
+    before: str | None =None
+) -> int:
+    """Empty `CHECK_JOURNAL_TABLE`, so that the next run checks every fund.
+
+    Args:
+        conn: An open connection to an sqlite3 database
+        before: If given, only the entries checked before this time are removed
+    Returns:
+        The number of entries removed
+    """
+    if before is None:
+        cur = conn.cursor().execute(f"DELETE FROM {CHECK_JOURNAL_TABLE}")
+    else:
+        cur = conn.cursor().execute(f"DELETE FROM {CHECK_JOURNAL_TABLE} WHERE checked_at < ?", (before,))
+    conn.commit()
+    return cur.rowcount
+
+def keep_chunks(
+    chunks: Iterator[str],
+    kept: list[str]
+) -> Iterator[str]:
+    """Pass through `chunks`, appending each one to `kept`."""
+    for chunk in chunks:
+        kept.append(chunk)
+        yield chunk
+
+def ignore_patterns(
+    ignore_blocks: str | None
+) -> list[str]:
+    """Split a fund's `ignore_blocks` field into its regular expressions."""
+    if not ignore_blocks:
+        return []
+    return [p for p in str(ignore_blocks).split(DELIM) if p.strip()]
+
+def changed_blocks_summary(
+    old_blocks: str | None,
+    blocks: dict[str, Any] | None
+) -> str:
+    """Describe the blocks that changed between two versions of a page.
+
+    Args:
+        old_blocks: The stored block hashes of the old version
+        blocks: The blocks of the new version, see `fingerprint.page_blocks`
+    Returns:
+        Up to `BLOCK_SNIPPETS_MAX` snippets of added or changed blocks and the number of
+        removed blocks, one per line
+    """
+    if old_blocks is None or blocks is None:
+        return 'Page changed (no earlier block fingerprints to compare)'
+    added, removed = diff_blocks(old_blocks.split(), blocks['hashes'], blocks['texts'])
+    lines = []
+    for text in added[:BLOCK_SNIPPETS_MAX]:
+        snippet = text if len(text) <= BLOCK_SNIPPET_CHARS else text[:BLOCK_SNIPPET_CHARS] + '...'
+        lines.append(f"+ {snippet}")
+    if len(added) > BLOCK_SNIPPETS_MAX:
+        lines.append(f"+ ({len(added) - BLOCK_SNIPPETS_MAX} more changed blocks)")
+    if removed:
+        lines.append(f"- ({removed} blocks removed)")
+    if not lines:
+        lines.append('Text changed outside paragraphs, headings, tables and lists')
+    return '\n'.join(lines)
+
+def merge_changed_blocks(
+    old_summary: str,
+    summary: str
+) -> str:
+    """Add the changes of a new version of a page to those not yet reviewed.
+
+    Lines repeated from `old_summary` are kept once, in their latest position. The oldest
+    lines are dropped to keep the result within `CHANGED_BLOCKS_MAX_CHARS` characters.
+
+    Args:
+        old_summary: The changed blocks stored for the page since it was last reviewed
+        summary: The changed blocks of the new version, see `changed_blocks_summary`
+    Returns:
+        The changed blocks of both, one per line, oldest first
+    """
+    omitted = '(earlier changes omitted)'
+    lines = [line for line in old_summary.split('\n') if line != omitted] + summary.split('\n')
+    lines = list(reversed(dict.fromkeys(reversed(lines))))
+    size = sum(len(line) + 1 for line in lines) - 1
+    if size <= CHANGED_BLOCKS_MAX_CHARS:
+        return '\n'.join(lines)
+    start = 0
+    while start < len(lines) - 1 and size + len(omitted) + 1 > CHANGED_BLOCKS_MAX_CHARS:
+        size -= len(lines[start]) + 1
+        start += 1
+    return '\n'.join([omitted] + lines[start:])
+
+def fund_changed_blocks(
+    fund: Fund
+) -> str | None:
+    """Collect the changed blocks of each url of `fund` that needs a manual check.
+
+    Args:
+        fund: The fund, with its pages attached
+    Returns:
+        The changed blocks of each url, headed by the url, or None if there are none
+    """
+    sections = []
+    for url in fund.urls:
+        page = fund.pages.get(url)
+        if page and page['needs_check'] and page['changed_blocks']:
+            sections.append(f"{url}:\n{page['changed_blocks']}")
+    return '\n\n'.join(sections) if sections else None
 
 def check_fund(
     log: TextIOWrapper | None,
-    fund: dict[str, Any],
-    funds_to_check: list[dict[str, Any]],
-    funds_to_update: list[dict[str, Any]]
+    fund: Fund,
+    funds_to_check: list[Fund],
+    funds_to_update: list[Fund],
+    scheduler: HostScheduler | None =None,
+    pool: SessionPool | None =None,
+    metrics: RunMetrics | None =None,
+    parser: ParsePool | None =None
 ) -> None:
     """Check a fund for page changes by comparing page checksum data for each url.
 
@@ -230,83 +768,487 @@ def check_fund(
     `funds_to_update` if any column in `fund` does not match the same column for the
     version of `fund` in the database. Does not update the database.
 
+    The stored state of each url is read from, and written back to, the `fund['pages']`
+    dict (see `attach_fund_pages`). Pages are matched to urls by url, not by position.
+
+    Urls with a stored checksum are requested conditionally using their stored `ETag` /
+    `Last-Modified` validators. A 304 (Not Modified) response is treated as matching
+    checksums, without downloading or parsing the page.
+
+    Each url successfully checked is rescheduled, see `check_scheduler.schedule_page`.
+
+    New and changed pages are also fingerprinted block by block (see
+    `fingerprint.page_blocks`), and the blocks added since the last version are stored
+    in the page's `changed_blocks` for the user output. The text of the new version is
+    kept in the page's `snapshot` field, to be archived when the fund is saved. If the
+    fund has an ignore list (`ignore_blocks`) and nothing changed outside the ignored
+    blocks, the change is logged as `AUTO-CLEAR` and the url is not marked for a manual
+    check.
+
+    If the fund has a CSS `selector`, only the matching elements of its pages are
+    fingerprinted. A page on which the selector no longer matches anything is marked
+    for a manual check, keeping its stored checksum so the next match is compared
+    against the last good version.
+
+    With a `parser`, pages are read as raw bytes and parsed and fingerprinted in its
+    worker processes instead of in the calling thread, with identical results.
+
     Args:
         log: The open audit log file to write to, or None to suppress logging
-        fund: A dict representing a fund's info / a row in the database
+        fund: The fund to check, with its pages attached
         funds_to_check: A list of funds that need to be checked
         funds_to_update: A list of funds that need to be updated
+        scheduler: The per-host scheduler to request through, or None to request directly
+        pool: The session pool to request through, or None to use one-off connections
+        metrics: The run metrics to record the stats of each url in
+        parser: The process pool to parse pages in, or None to parse in-process
     """
-    urls = fund['url'].split(DELIM)
-    urls_to_check = set(fund['urls_to_check'].split(DELIM)) if fund['urls_to_check'] else set()
-    old_checksums = fund['checksum'].split(DELIM) if fund['checksum'] else ['' for u in urls]
-    checksums = []
+    urls = fund.urls
+    pages = fund.pages
+    prev_access_failures = fund['access_failures']
+    ignore = ignore_patterns(fund.get('ignore_blocks'))
+    selector = fund.get('selector') or None
 
     need_update = False
     failed_connect = False
     for i in range(len(urls)):
+        page = pages.get(urls[i])
+        if page is None:
+            page = new_fund_page(fund['id'], urls[i])
+            pages[urls[i]] = page
+        page['position'] = i
+        page['last_checked'] = datetime.now().isoformat(timespec='seconds')
+
+        headers = conditional_headers(page['etag'], page['last_modified']) if page['checksum'] else {}
+        stats = new_url_stats()
+        start = time.perf_counter()
+        # Remove page whitespace and checksum remaining text
+        checksum = None
+        selector_missing = False
+        html = []
+        chunks = None
+        parsed = None
+        with fetch_page(urls[i], scheduler=scheduler, pool=pool, headers=headers, stats=stats) as response:
+            stats['fetch'] = time.perf_counter() - start
+            not_modified = response is not None and response.status_code == 304
+            if response is not None and not not_modified:
+                # The body is read while the host slot is held; the parse pool parses it after
+                try:
+                    if parser:
+                        chunks = list(iter_page_bytes(response, stats=stats))
+                        encoding = response.encoding
+                    else:
+                        checksum = page_checksum(keep_chunks(iter_page_text(response, stats=stats), html), timings=stats, selector=selector)
+                except SelectorNoMatchError:
+                    selector_missing = True
+                except Exception as e:
+                    # Raised while reading the body for the parse pool; `page_checksum` catches its own
+                    print(f"Failed to read URL: {urls[i]}. Error: {e}. Skipping...")
+
+        if not_modified:
+            # Page unchanged since last fetch
+            page['failures'] = 0
+            schedule_page(page, changed=False)
+            stats['result'] = 'not_modified'
+            if metrics:
+                metrics.record_url(urls[i], stats)
+            print(f"{fund['name']}, {fund['status'].upper()} FUND: URL {i+1}: Not modified. Checksums match.")
+            continue
+
+        if chunks is not None:
+            try:
+                parsed = parser.fingerprint(chunks, encoding, page['checksum'], ignore, selector)
+                checksum = parsed['checksum']
+                selector_missing = parsed['selector_missing']
+                stats['parse'] += parsed['parse']
+                stats['hash'] += parsed['hash']
+            except Exception as e:
+                print(f"Failed to parse URL: {urls[i]}. Error: {e}. Skipping...")
+
+        if selector_missing:
+            # Page layout changed, so the fingerprinted part of the page can no longer be found
+            need_update = True
+            page['failures'] = 0
+            page['needs_check'] = True
+            page['changed_blocks'] = f"Selector \"{selector}\" no longer matches any element"
 
-        soup = get_soup(urls[i])
+            if log:
+                log.write(f"CHECK: {fund['name']}, {urls[i]}: Selector \"{selector}\" no longer matches any element\n\n")
 
-        if not soup:
+            stats['result'] = 'selector_missing'
+            print(f"{fund['name']}, {fund['status'].upper()} FUND: URL {i+1}: Selector not found. Check required.")
+        elif checksum is None:
             # Unable to scrape url
             need_update = True
             failed_connect = True
             fund['access_failures'] += 1
+            page['failures'] += 1
     
             if fund['access_failures'] >= 3:
-                urls_to_check.add(urls[i])
-            
-            checksums.append(old_checksums[i])
+                page['needs_check'] = True
 
             if log:
                 log.write(f"SCRAPE FAIL: {fund['name']}, URL: {urls[i]}\n\n")
 
+            stats['result'] = 'failed'
             print(f"{fund['name']}, {fund['status'].upper()} FUND: URL {i+1}: Failed to connect.")
         else:
             # Successful url scrape
-            # Remove page whitespace, checksum remaining text and add to list
-            checksums.append(hashlib.sha256(''.join(soup.body.text.split()).encode('utf-8')).hexdigest())
+            old_checksum = page['checksum']
+            old_blocks = page['block_hashes']
+            old_content_checksum = page['content_checksum']
+            page['checksum'] = checksum
+            page['etag'], page['last_modified'] = response_validators(response)
+            page['failures'] = 0
+
+            # Fingerprint the blocks of new and changed pages, to localize the next change
+            blocks = None
+            if parsed is not None:
+                # Already fingerprinted by the parse pool
+                blocks = parsed['blocks']
+            elif checksum != old_checksum:
+                start = time.perf_counter()
+                try:
+                    blocks = page_blocks(''.join(html), ignore, selector)
+                except Exception as e:
+                    print(f"webscraper.py: check_fund(): Unable to fingerprint blocks of {urls[i]}. Exception: {e}")
+                stats['parse'] += time.perf_counter() - start
+            if checksum != old_checksum:
+                page['block_hashes'] = ' '.join(blocks['hashes']) if blocks else None
+                page['content_checksum'] = blocks['content_checksum'] if blocks else None
+                if blocks:
+                    # Archived by `checkpoint_funds`, see `snapshot_store.save_snapshots`
+                    page['snapshot'] = blocks['text']
 
-            if not old_checksums[i]:
+            if not old_checksum:
                 need_update = True
+                stats['result'] = 'new'
                 print(f"{fund['name']}, {fund['status'].upper()} FUND: URL {i+1}: Adding new checksum.")
-            elif checksums[i] != old_checksums[i]:
+            elif checksum == old_checksum:
+                stats['result'] = 'unchanged'
+                print(f"{fund['name']}, {fund['status'].upper()} FUND: URL {i+1}: Checksums match.")
+            elif ignore and blocks and old_content_checksum and blocks['content_checksum'] == old_content_checksum:
+                # Only ignored blocks changed
                 need_update = True
-                urls_to_check.add(urls[i])
+                stats['result'] = 'ignored'
 
                 if log:
-                    log.write(f"CHECK: {fund['name']}, {urls[i]}\n\n")
+                    log.write(f"AUTO-CLEAR: {fund['name']}, {urls[i]}: Only ignored blocks changed\n\n")
+
+                print(f"{fund['name']}, {fund['status'].upper()} FUND: URL {i+1}: Updating checksum. Only ignored blocks changed.")
+            else:
+                need_update = True
+                stats['result'] = 'changed'
+                summary = changed_blocks_summary(old_blocks, blocks)
+                if page['needs_check'] and page['changed_blocks']:
+                    page['changed_blocks'] = merge_changed_blocks(page['changed_blocks'], summary)
+                else:
+                    page['changed_blocks'] = summary
+                page['needs_check'] = True
+
+                if log:
+                    log.write(f"CHECK: {fund['name']}, {urls[i]}\n{summary}\n\n")
                 
                 print(f"{fund['name']}, {fund['status'].upper()} FUND: URL {i+1}: Updating checksum. Check required.")
-            else:
-                print(f"{fund['name']}, {fund['status'].upper()} FUND: URL {i+1}: Checksums match.")
+            schedule_page(page, changed=stats['result'] == 'changed')
+
+        if metrics:
+            metrics.record_url(urls[i], stats)
     
     if not failed_connect:
         fund['access_failures'] = 0
+        if prev_access_failures:
+            need_update = True
     
     if need_update:
-        fund['checksum'] = DELIM.join(checksums)
         funds_to_update.append(fund)
     
+    urls_to_check = [url for url in urls if pages[url]['needs_check']]
     if urls_to_check:
         fund['status'] = CHECK
         fund['urls_to_check'] = DELIM.join(urls_to_check)
+        fund['changed_blocks'] = fund_changed_blocks(fund)
     
     if fund['status'] == CHECK:
         funds_to_check.append(fund)
 
-def main(
+def _check_fund_buffered(
+    fund: Fund,
+    scheduler: HostScheduler | None =None,
+    pool: SessionPool | None =None,
+    metrics: RunMetrics | None =None,
+    parser: ParsePool | None =None
+) -> tuple[str, list[Fund], list[Fund]]:
+    """Run `check_fund` on `fund` with its own audit log buffer and result lists.
+
+    Args:
+        fund: The fund to check, with its pages attached
+        scheduler: The per-host scheduler to request through
+        pool: The session pool to request through
+        metrics: The run metrics to record url stats in
+        parser: The process pool to parse pages in
+    Returns:
+        A tuple of the buffered audit log text, the funds to check, and the funds to update
+    """
+    buf = StringIO()
+    funds_to_check = []
+    funds_to_update = []
+    check_fund(buf, fund, funds_to_check, funds_to_update, scheduler, pool, metrics, parser)
+    return buf.getvalue(), funds_to_check, funds_to_update
+
+def iter_check_results(
+    funds: list[Fund],
+    workers: int =CHECK_WORKERS,
+    scheduler: HostScheduler | None =None,
+    pool: SessionPool | None =None,
+    metrics: RunMetrics | None =None,
+    parser: ParsePool | None =None,
+    stop: threading.Event | None =None
+) -> Iterator[tuple[Fund, str, list[Fund], list[Fund]]]:
+    """Check each fund in `funds` using up to `workers` concurrent checks, yielding results in the order of `funds`.
+
+    Funds are started in host-interleaved order so that concurrent checks spread across
+    hosts, while `scheduler` keeps each host within its politeness limits.
+
+    Checks that have not started are cancelled if `stop` is set or the caller stops
+    reading results. The checks already running are left to finish, but their results are
+    not yielded.
+
+    Args:
+        See `check_funds`
+    Yields:
+        A tuple for each fund of the fund, its audit log text, and the funds to check and
+        to update among it (see `check_fund`)
+    """
+    with ThreadPoolExecutor(max_workers=workers) if workers > 1 else nullcontext() as executor:
+        if executor is None:
+            results = (_check_fund_buffered(fund, scheduler, pool, metrics, parser) for fund in funds)
+            futures = []
+        else:
+            check = partial(_check_fund_buffered, scheduler=scheduler, pool=pool, metrics=metrics, parser=parser)
+            futures = [None] * len(funds)
+            for i in interleave_by_host(funds):
+                futures[i] = executor.submit(check, funds[i])
+            results = (future.result() for future in futures)
+
+        try:
+            for fund in funds:
+                if stop is not None and stop.is_set():
+                    break
+                text, to_check, to_update = next(results)
+                yield fund, text, to_check, to_update
+        finally:
+            for future in futures:
+                future.cancel()
+
+def check_funds(
+    log: TextIOWrapper,
+    funds: list[Fund],
+    funds_to_check: list[Fund],
+    funds_to_update: list[Fund],
+    workers: int =CHECK_WORKERS,
+    scheduler: HostScheduler | None =None,
+    pool: SessionPool | None =None,
+    conn: sqlite3.Connection | None =None,
+    checkpoint_every: int =CHECKPOINT_FUNDS,
+    metrics: RunMetrics | None =None,
+    parser: ParsePool | None =None,
+    stop: threading.Event | None =None
+) -> bool:
+    """Check each fund in `funds` for page changes, using up to `workers` concurrent checks.
+
+    Funds are checked by `iter_check_results`. Audit log lines and the contents of
+    `funds_to_check` and `funds_to_update` are written in the order of `funds`, so the
+    output matches that of calling `check_fund` serially.
+
+    If `conn` is given, results are saved to the database as funds finish, in batches of
+    `checkpoint_every` funds, see `checkpoint_funds`.
+
+    With a `parser`, the `workers` threads only fetch pages, and the pages are parsed in
+    the parser's worker processes, so that parsing is not limited to one core.
+
+    Args:
+        log: The open audit log file to write to
+        funds: A list of funds / rows in the database, with their pages attached
+        funds_to_check: A list of funds that need to be checked
+        funds_to_update: A list of funds that need to be updated
+        workers: The maximum number of funds checked at once; 1 or less checks serially
+        scheduler: The per-host scheduler to request through, or None to request directly
+        pool: The session pool to request through, or None to use one-off connections
+        conn: An open connection to an sqlite3 database to save results to, or None
+        checkpoint_every: The number of finished funds to save at once
+        metrics: The run metrics to record url stats in
+        parser: The process pool to parse pages in, or None to parse in the check threads
+        stop: An event that, when set, stops the check before the funds not yet checked
+    Returns:
+        True if every fund was checked, False if `stop` stopped the check early
+    """
+    done = []
+    done_to_update = []
+    checked = 0
+    for fund, text, to_check, to_update in iter_check_results(funds, workers, scheduler, pool, metrics, parser, stop):
+        checked += 1
+        log.write(text)
+        funds_to_check.extend(to_check)
+        funds_to_update.extend(to_update)
+        if conn is None:
+            continue
+        done.append(fund)
+        done_to_update.extend(to_update)
+        if len(done) >= checkpoint_every:
+            checkpoint_funds(conn, log, done, done_to_update)
+            done = []
+            done_to_update = []
+    if done:
+        checkpoint_funds(conn, log, done, done_to_update)
+    return checked == len(funds)
+
+def _check_shard_locally(
+    funds: list[Fund],
+    metrics: RunMetrics | None =None
+) -> dict[str, Any]:
+    """Check the funds of a shard in this process, returning a result like a shard worker's.
+
+    Args:
+        funds: The funds of the shard, with their pages attached
+        metrics: The run metrics to record url stats in
+    Returns:
+        A shard result, see `shard_worker.run_shard`
+    """
+    pool = SessionPool()
+    results = []
+    try:
+        for fund, text, to_check, to_update in iter_check_results(funds, CHECK_WORKERS, HostScheduler(), pool, metrics):
+            results.append({'fund': fund, 'log': text, 'to_check': bool(to_check), 'to_update': bool(to_update)})
+    finally:
+        pool.close()
+    return {'results': results, 'urls': [], 'connections': pool.stats()}
+
+def check_funds_sharded(
     conn: sqlite3.Connection,
-    log: TextIOWrapper
-) -> None:
-    """Execute inputs, scrape urls, update database, and generate output files.
+    log: TextIOWrapper,
+    funds: list[Fund],
+    funds_to_check: list[Fund],
+    funds_to_update: list[Fund],
+    shards: int =SHARDS,
+    shard_dir: str =SHARD_DIR,
+    launch: bool =SHARD_LAUNCH_LOCAL,
+    timeout: float =SHARD_TIMEOUT,
+    metrics: RunMetrics | None =None
+) -> dict[str, int]:
+    """Check `funds` in `shards` worker processes, possibly on other hosts, and merge their results.
 
-    Compare html from each scraped url with saved data in database. Update and mark
-    database entries when changes in html occur.
+    Funds are split into shards by a hash of their id (see `shard.shard_of`), and each
+    shard is written to `shard_dir` for its worker to check (see `shard_worker.py`). With
+    `launch`, a local worker process is started for each shard; otherwise the workers are
+    expected to be running `shard_worker.py serve` on hosts that share `shard_dir`.
+
+    The results of each shard are saved to the database as soon as they arrive, see
+    `checkpoint_funds`. A shard that does not report back within `timeout` seconds, or
+    whose local worker fails, is checked in this process instead. Audit log lines and the
+    contents of `funds_to_check` and `funds_to_update` are written in the order of
+    `funds`, so the output matches that of `check_funds`.
+
+    Each worker has its own `HostScheduler`, so per-host limits apply per shard.
+
+    Args:
+        conn: An open connection to an sqlite3 database to save results to
+        log: The open audit log file to write to
+        funds: A list of funds / rows in the database, with their pages attached
+        funds_to_check: A list of funds that need to be checked
+        funds_to_update: A list of funds that need to be updated
+        shards: The number of shards to split `funds` into
+        shard_dir: The directory shared by this process and the shard workers
+        launch: Start a local worker process for each shard
+        timeout: The number of seconds to wait for the shard workers
+        metrics: The run metrics to record url stats in
+    Returns:
+        The HTTP connection counts of all shards, see `SessionPool.stats`
+    """
+    run_id = uuid.uuid4().hex
+    groups = split_shards(funds, shards)
+    os.makedirs(shard_dir, exist_ok=True)
+    # Inputs left by an earlier run would be checked again by serving workers
+    clear_shard_dir(shard_dir)
+
+    procs = {}
+    pending = set()
+    for i, group in enumerate(groups):
+        if not group:
+            continue
+        write_shard_input(shard_dir, run_id, i, group)
+        pending.add(i)
+        if launch:
+            procs[i] = launch_shard_worker(shard_dir, i)
+    log.write(f"INFO: Checking {len(funds)} funds in {len(pending)} shards\n\n")
+
+    results = {}
+    stats = {'requests': 0, 'connections': 0, 'reused': 0}
+
+    def merge(i: int, result: dict[str, Any]) -> None:
+        checked = []
+        checked_to_update = []
+        for res in result['results']:
+            fund = res['fund'] if isinstance(res['fund'], Fund) else fund_from_record(res['fund'])
+            results[fund['id']] = (fund, res['log'], res['to_check'], res['to_update'])
+            checked.append(fund)
+            if res['to_update']:
+                checked_to_update.append(fund)
+        checkpoint_funds(conn, log, checked, checked_to_update)
+        if metrics:
+            for record in result['urls']:
+                metrics.record_url(record['url'], record)
+        for key in stats:
+            stats[key] += result['connections'][key]
+        pending.discard(i)
+
+    try:
+        deadline = time.monotonic() + timeout
+        while pending and time.monotonic() < deadline:
+            for i in sorted(pending):
+                # Look for the worker's exit before its result, in case it finishes in between
+                exited = i in procs and procs[i].poll() is not None
+                result = read_shard_result(shard_dir, i, run_id)
+                if result is not None:
+                    merge(i, result)
+                    remove_file(shard_path(shard_dir, i, 'result'))
+                elif exited:
+                    log.write(f"WARNING: Shard {i} worker exited with code {procs[i].returncode}. Checking its {len(groups[i])} funds locally\n\n")
+                    remove_file(shard_path(shard_dir, i, 'input'))
+                    merge(i, _check_shard_locally(groups[i], metrics))
+            if pending:
+                time.sleep(SHARD_POLL_INTERVAL)
+
+        for i in sorted(pending):
+            log.write(f"WARNING: Shard {i} did not report back within {timeout} seconds. Checking its {len(groups[i])} funds locally\n\n")
+            remove_file(shard_path(shard_dir, i, 'input'))
+            merge(i, _check_shard_locally(groups[i], metrics))
+    finally:
+        for proc in procs.values():
+            if proc.poll() is None:
+                proc.terminate()
+            proc.wait()
+
+    for fund in funds:
+        checked, text, to_check, to_update = results[fund['id']]
+        log.write(text)
+        if to_check:
+            funds_to_check.append(checked)
+        if to_update:
+            funds_to_update.append(checked)
+    return stats
+
+def execute_inputs(
+    conn: sqlite3.Connection,
+    log: TextIOWrapper
+) -> set[str]:
+    """Execute the commands of the input files in `INFILE_DIR` and commit them.
 
     Args:
         conn: An open connection to an sqlite3 database
         log: The open audit log file to write to
+    Returns:
+        The set of tables requested with `REQ` commands
     """
     inputs = queue_inputs(log)
 
@@ -315,56 +1257,198 @@ def main(
     table_reqs = set()
     for item in inputs:
         exec_cmd(conn, log, item, table_reqs)
+    conn.commit()
+    return table_reqs
+
+def load_funds(
+    conn: sqlite3.Connection
+) -> list[Fund]:
+    """Load every fund in the database with its pages attached, see `attach_fund_pages`."""
+    funds = util.dbtable_to_records(conn, FUNDS_TABLE, row_factory=util.db_record_factory(Fund))
+    attach_fund_pages(funds, util.dbtable_to_records(conn, FUND_URLS_TABLE))
+    return funds
+
+def run_checks(
+    conn: sqlite3.Connection,
+    log: TextIOWrapper,
+    metrics: RunMetrics | None =None,
+    pool: SessionPool | None =None,
+    scheduler: HostScheduler | None =None,
+    parser: ParsePool | None =None,
+    stop: threading.Event | None =None
+) -> tuple[list[Fund], list[Fund], list[Fund], bool]:
+    """Check every fund that is due, save the results, and prune old page versions.
+
+    Funds already checked by an interrupted run are skipped, see `journal_fund_ids`. The
+    session pool, scheduler and parse pool are created for the call unless given, e.g. by
+    a long-running `daemon.Daemon` that keeps them between runs.
 
+    If `stop` is set during the check, the funds not yet checked are skipped and the
+    check journal is kept, so that the next call resumes where this one stopped.
+
+    Args:
+        conn: An open connection to an sqlite3 database
+        log: The open audit log file to write to
+        metrics: The run metrics to record url stats in
+        pool: The session pool to request through
+        scheduler: The per-host scheduler to request through
+        parser: The process pool to parse pages in
+        stop: An event that stops the check early when set. Not supported with `SHARDS`
+    Returns:
+        A tuple of all funds, the funds to check, the funds updated, and True if every
+        fund due was checked (False if `stop` stopped the check early)
+    """
     log.write('---\nCHECKING FUNDS\n---\n\n')
 
-    funds = util.dbtable_to_records(conn, FUNDS_TABLE)
+    funds = load_funds(conn)
     funds_to_check = []
     funds_to_update = []
 
-    for item in funds:
-        check_fund(log, item, funds_to_check, funds_to_update)
-    
-    if funds_to_update:
+    # Skip funds already checked by an interrupted run; their results are in the database.
+    # A run interrupted more than `CHECK_JOURNAL_MAX_HOURS` ago is not resumed.
+    cutoff = journal_cutoff()
+    try:
+        stale = clear_check_journal(conn, before=cutoff)
+    except sqlite3.Error as e:
+        log.write(f"DATABASE ERROR: Unable to clear check journal: {e}\n\n")
+    else:
+        if stale:
+            log.write(f"INFO: Discarded {stale} check journal entries older than {CHECK_JOURNAL_MAX_HOURS} hours\n\n")
+    done_ids = journal_fund_ids(conn, cutoff)
+    if done_ids:
+        log.write(f"INFO: Resuming interrupted run. Skipping {len(done_ids)} funds already checked\n\n")
+    funds_left = []
+    for fund in funds:
+        if fund['id'] not in done_ids:
+            funds_left.append(fund)
+        elif fund['status'] == CHECK:
+            # As `check_fund` decides for the funds it checks
+            funds_to_check.append(fund)
+
+    # Skip funds whose pages have been stable for long enough, see `check_scheduler`
+    funds_left, funds_not_due = select_due_funds(funds_left)
+    log.write(f"INFO: Funds due for a check: {len(funds_left)}/{len(funds_left) + len(funds_not_due)}\n\n")
+
+    finished = True
+    if SHARDS > 1:
+        stats = check_funds_sharded(conn, log, funds_left, funds_to_check, funds_to_update, shards=SHARDS, metrics=metrics)
+    else:
+        own_pool = pool is None
+        own_parser = parser is None and PARSE_WORKERS > 0 and bool(funds_left)
+        pool = pool or SessionPool()
+        parser = ParsePool(PARSE_WORKERS) if own_parser else parser
+        stats_before = pool.stats()
+        try:
+            finished = check_funds(log, funds_left, funds_to_check, funds_to_update, scheduler=scheduler or HostScheduler(), pool=pool, conn=conn, metrics=metrics, parser=parser, stop=stop)
+        finally:
+            if own_pool:
+                pool.close()
+            if own_parser:
+                parser.close()
+        stats = {key: value - stats_before[key] for key, value in pool.stats().items()}
+    log.write(f"INFO: HTTP connections: {stats['connections']} opened, {stats['reused']}/{stats['requests']} requests reused a connection\n\n")
+    if metrics:
+        metrics.write_slowest_hosts(log)
+
+    if not finished:
+        log.write('INFO: Check stopped early. The next check resumes with the funds not yet checked\n\n')
+    else:
         try:
-            util.records_update_dbtable(conn, FUNDS_TABLE, ['status', 'checksum', 'urls_to_check', 'access_failures'], funds_to_update)
+            clear_check_journal(conn)
         except sqlite3.Error as e:
-            conn.rollback()
-            log.write(f"DATABASE ERROR: Fatal error when updating database: {e}\n\n")
-        except Exception as e:
-            log.write(f"ERROR: Occurred when updating database: {e}\n\n")
+            log.write(f"DATABASE ERROR: Unable to clear check journal: {e}\n\n")
 
-    if funds_to_check:
-        util.records_to_xlsx(funds_to_check, OUTFILE_USER_PATH, OUTPUT_COLS, sheet_name='Funds to Check')
+        try:
+            pruned = prune_snapshots(conn)
+            if pruned:
+                log.write(f"INFO: Pruned {pruned} archived page versions\n\n")
+        except sqlite3.Error as e:
+            log.write(f"DATABASE ERROR: Unable to prune page snapshots: {e}\n\n")
 
     log.write(f"INFO: Updated funds: {len(funds_to_update)}/{len(funds)}\n\n")
     log.write(f"INFO: Funds to check: {len(funds_to_check)}/{len(funds)}\n\n")
+    return funds, funds_to_check, funds_to_update, finished
+
+def write_outputs(
+    conn: sqlite3.Connection,
+    funds_to_check: list[Fund],
+    table_reqs: set[str],
+    user_output: bool =True
+) -> None:
+    """Write the funds to check to `OUTFILE_USER_PATH`, and the requested tables to `OUTFILE_ADMIN_PATH`.
+
+    Args:
+        conn: An open connection to an sqlite3 database
+        funds_to_check: The funds that need a manual check
+        table_reqs: The set of tables requested with `REQ` commands
+        user_output: Write `OUTFILE_USER_PATH`; the funds to check are still included in
+            the admin output
+    """
+    if funds_to_check and user_output:
+        util.records_to_xlsx(funds_to_check, OUTFILE_USER_PATH, OUTPUT_COLS, sheet_name='Funds to Check')
 
     if table_reqs:
-        conn_backup = sqlite3.connect(DATABASE_BACKUP)
-        with pd.ExcelWriter(OUTFILE_ADMIN_PATH, engine='openpyxl') as writer:
-            if funds_to_check:
-                util.records_to_xlsx(funds_to_check, writer, OUTPUT_COLS, sheet_name='Funds to Check')
-            for req in table_reqs:
-                conn_tmp = conn
-                sheet_name = f"Table {req}"
-                table_name = str(req)
-                
-                # check if requested table is from the backup db
-                if table_name.find(f"backup{DELIM}") == 0:
-                    conn_tmp = conn_backup
-                    table_name = table_name.replace(f"backup{DELIM}", '')
-                    sheet_name = f"Backup Table {table_name}"
-
-                if req == FUNDS_TABLE and conn_tmp == conn:
-                    util.records_to_xlsx(funds, writer, sheet_name=sheet_name)
-                else:
-                    util.records_to_xlsx(util.dbtable_to_records(conn_tmp, table_name), writer, sheet_name=sheet_name)
-        conn_backup.close()
+        # Tables are streamed into a write-only workbook, without loading them into memory
+        conn_backup = None
+        wb = openpyxl.Workbook(write_only=True)
+        if funds_to_check:
+            util.rows_to_xlsx(([fund.get(col) for col in OUTPUT_COLS] for fund in funds_to_check), OUTPUT_COLS, wb, sheet_name='Funds to Check')
+        for req in table_reqs:
+            conn_tmp = conn
+            sheet_name = f"Table {req}"
+            table_name = str(req)
+        
+            # check if requested table is from the backup db
+            if table_name.find(f"backup{DELIM}") == 0:
+                if conn_backup is None:
+                    conn_backup = db_connect(DATABASE_BACKUP, readonly=True)
+                conn_tmp = conn_backup
+                table_name = table_name.replace(f"backup{DELIM}", '')
+                sheet_name = f"Backup Table {table_name}"
+            if table_name == SNAPSHOTS_TABLE:
+                # Show the previous and current version of each url to check, not the compressed archive
+                records = snapshot_records(conn_tmp, funds_to_check)
+                sheet_name = 'Backup Page Versions' if conn_tmp is conn_backup else 'Page Versions'
+                util.rows_to_xlsx(([rec[col] for col in SNAPSHOT_OUTPUT_COLS] for rec in records), SNAPSHOT_OUTPUT_COLS, wb, sheet_name=sheet_name)
+                continue
+
+            util.dbtable_to_xlsx(conn_tmp, table_name, wb, sheet_name=sheet_name)
+        wb.save(OUTFILE_ADMIN_PATH)
+        if conn_backup is not None:
+            conn_backup.close()
+
+def main(
+    conn: sqlite3.Connection,
+    log: TextIOWrapper,
+    metrics: RunMetrics | None =None
+) -> None:
+    """Execute inputs, scrape urls, update database, and generate output files.
+
+    Compare html from each scraped url with saved data in database. Update and mark
+    database entries when changes in html occur.
+
+    Args:
+        conn: An open connection to an sqlite3 database
+        log: The open audit log file to write to
+        metrics: The run metrics to record phase times and url stats in
+    """
+    metrics = metrics or RunMetrics()
+
+    with metrics.phase('execute_inputs'):
+        table_reqs = execute_inputs(conn, log)
+
+    with metrics.phase('check_funds'):
+        funds, funds_to_check, funds_to_update, _ = run_checks(conn, log, metrics)
+
+    with metrics.phase('write_outputs'):
+        write_outputs(conn, funds_to_check, table_reqs)
 
 if __name__ == '__main__':
-    conn = sqlite3.connect(DATABASE)
+    conn = db_connect(DATABASE)
+    migrate_db(conn)
     auditlog = open(AUDITLOG_PATH, 'w')
-    main(conn, auditlog)
+    metrics = RunMetrics()
+    main(conn, auditlog, metrics)
     auditlog.close()
     conn.close()
+    metrics.write_json(RUN_SUMMARY_PATH)